@@ -13,6 +13,13 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord, Longitude, Latitude
 
 from star import Star
+from voxel_cube import VoxelCube
+from sector_cube import SectorCube
+from los_fit import profile_matrix, poly_fit, poly_eval
+from cone_index import ConeIndex
+from multiorder import MultiOrderMap
+from gal_coord import eq2gal
+from pixel_index import NSIDE_HI, hires_pixels, pixels_at
 
 
 ###############################################
@@ -40,34 +47,28 @@ def Read_H5(file, name):
     f.close()
     return(data)
 
-def PixelCoord(Nside, ra, dec):
+def PixelCoord(Nside, ra, dec, file=None):
     """
-    Make file with Healpix coordinates for the given Nside. Also return the 
-    array with Healpix coordinates.
+    Get the Healpix coordinates (RING) of the stars for the given Nside. The
+    pixels are derived by bit shifting NESTED indices at Nside 4096, which
+    are read from file if given and it exists, else computed and written.
     
     Input:
     - Nside, int. The Nside to make Healpix coordinates from.
+    - ra, array. Longitude angle in radians
+    - dec, array. Latitude angle in radians
+    - file, string. Optional .h5 file caching the Nside 4096 NESTED indices
     
     Return:
     - pixpos, array. Array with pixel coordinates in Healpix
     """
     
-    #ra = Read_H5('Data/RightAscension_v2.h5', 'ra')
-    #dec = Read_H5('Data/Declination_v2.h5', 'dec')
-    #print(ra, dec)
-    #c = SkyCoord(l=ra*u.radian, b=dec*u.radian, frame='galactic')
-    
-    #c.galactic
-    #print(c)
-    #print(Longitude(ra, unit=u.degree))
     dec = np.pi/2.0 - dec
-    Nstars = len(ra)
-    pixpos = hp.pixelfunc.ang2pix(Nside, dec, ra)
-    
-    #f = h5py.File('Data/SPC_Nside_{}.h5'.format(Nside), 'w')
-    #f.create_data_set('Healpix coordinates', data=pixpos.astype(int))
-    #f.close()
-    
+    if Nside > NSIDE_HI:
+        pixpos = hp.pixelfunc.ang2pix(Nside, dec, ra)
+    else:
+        pix_hi = hires_pixels(dec, ra, file=file)
+        pixpos = pixels_at(pix_hi, Nside)
     return(pixpos)
 
 def xyz_position(dist, ra, dec):
@@ -107,36 +108,11 @@ def parallax2dist(p, p_err):
 
 def Cel2Gal(ra, dec):
     """
-    Transform Ra and Dec to galactic coordinates from celestial.
-    """
-
-    deg = np.pi/180
-    """
-    el0 = 32.93191857 * deg
-    r0 = 282.859481208 * deg
-    d0 = 62.8717488056 * deg
-
-    l1 = np.cos(dec)*np.cos(ra - r0)
-    l2 = np.sin(dec)*np.sin(d0) + np.cos(dec)*np.cos(ra-r0)*np.cos(d0)
-    l3 = np.sin(dec)*np.cos(d0) - np.cos(dec)*np.sin(ra-r0)*np.sin(d0)
+    Transform Ra and Dec to galactic coordinates from celestial. Input and
+    output angles in radians.
     """
-    Ag = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],\
-                   [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],\
-                   [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]])
-    #print(Ag[1,0], Ag[0,1])
-    #print(Ag)
-    r1 = np.cos(ra)*np.cos(dec)
-    r2 = np.cos(ra)*np.sin(dec)
-    r3 = np.sin(dec)
-
-    l1 = r1*Ag[0,0] + r2*Ag[0,1] + r3*Ag[0,2]
-    l2 = r1*Ag[1,0] + r2*Ag[1,1] + r3*Ag[1,2]
-    l3 = r1*Ag[2,0] + r2*Ag[2,1] + r3*Ag[2,2]
-    #print(l1, l2, l3)
-    b = np.arctan2(l3, (np.sqrt(l1**2 + l2**2)))
-    l = (np.arctan2(l1, l2))
-    #print(b, l)
-    return(l, b)
+    l, b = eq2gal(np.degrees(ra), np.degrees(dec))
+    return(np.radians(l), np.radians(b))
 #l, b = Cel2Gal(0,0)
 #print(np.arctan2(0,1))
 #sys.exit()    
@@ -182,10 +158,11 @@ class Extinction():
         #print(self.ra[:10])
         #print(np.min(self.dec), np.max(self.dec))
         print('Get Healpix coordinates for the stars')
-        self.pixpos = PixelCoord(Nside, self.ra, self.dec)
+        self.pixpos = PixelCoord(Nside, self.ra, self.dec,\
+                                 'Data/Pixel_eq_nest4096_v2.h5')
         l = self.longitude*np.pi/180.
         b = self.latitude*np.pi/180.
-        self.gal_pixpos = PixelCoord(Nside, l, b)
+        self.gal_pixpos = PixelCoord(Nside, l, b, 'Data/Pixel_gal_nest4096_v2.h5')
         self.dec = np.pi/2 - self.dec 
         #print(self.pixpos)        
         #print(self.ra*180/np.pi)
@@ -204,6 +181,8 @@ class Extinction():
         #hp.mollview(self.map, coord=['C','G'])
         self.m = np.argwhere(self.map > 0)
         self.unique_pixel = np.unique(self.pixpos)
+        self.fine_cube = None
+        self.cone_idx = None
 
         #self.xyz = xyz_position(self.dist, self.ra, self.dec)
         #t0 = time.time()
@@ -216,100 +195,45 @@ class Extinction():
     
     def get_GalCoord(self, alpha, delta):
         """
-        Coordinate transformation from ICRS to galactic xyz coord, following 
-        Gaia DR2 documentation (3.1.7). Then get healpix angles from this. 
-        Unfortunately only one star at the time :/
+        Coordinate transformation from ICRS to galactic coord, following 
+        Gaia DR2 documentation (3.1.7). Vectorised over all stars.
         Input:
-        - alpha. scalar. Right ascension angle in deg
-        - delta, scalar. Declination angle in deg
+        - alpha. array. Right ascension angle in radians
+        - delta, array. Declination angle in radians
         Return:
-        - alpha. scalar. longitude in deg
-        - delta. scalar. latitude in deg 
-        """
-        #print(np.shape(alpha))
-        Ag = np.empty((3,3,len(alpha)))
-        Ag1 = np.array([[-0.0548755604162154, -0.8734370902348850, \
-                         -0.4838350155487132],\
-            [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],\
-            [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]])
-        #print(np.shape(Ag))
-        for i in range(3):
-            for j in range(3):
-                Ag[i,j,:] = Ag1[i,j]
-        #print(Ag[:,:,0])
-    
-        r = np.array([[np.cos(alpha)*np.cos(delta)],\
-                      [np.sin(alpha)*np.cos(delta)],\
-                      [np.sin(delta)]])
-        #print(r[:,:,0])
-        #print(np.einsum('ijk, jlk->ilk', Ag, r))  
-        rgal = np.einsum('ijk, jlk->ilk', Ag, r)
-        alpha1, delta1 = hp.pixelfunc.vec2ang(rgal, lonlat=True)
-    
+        - alpha. array. longitude in deg
+        - delta. array. latitude in deg 
+        """
+        alpha1, delta1 = eq2gal(np.degrees(alpha), np.degrees(delta))
         return(alpha1, delta1)
-        #return(rgal)
 
-    def xyzExtinction(self, Rmax=3000, box_size=100):
+    def xyzExtinction(self, Rmax=3000, box_size=100, filename=None):
         """
         Make a 3d map of the extinction of the stars in Euclidian coordinates.
+        All stars within the cube are binned into voxels in one pass, then the
+        three planes through the Sun are plotted.
+        Input:
+        - Rmax, scalar. Half width of the cube in pc
+        - box_size, scalar. Voxel size in pc
+        - filename, string. If given, write the cube to this .h5 file
+        Return:
+        - cube, VoxelCube. The voxel cube with counts, mean Ag and mean r
         """
-
-        #ind = np.where(self.dist < 100)[0]
-        xyz = xyz_position(self.dist, self.ra, self.dec)
-        
-        x = np.arange(-Rmax, Rmax+10, box_size)
-        y = np.arange(-Rmax, Rmax+10, box_size)
-        X, Y = np.meshgrid(x, y)
-        
-        #print(xyz_new)
-        print(x, len(x))
-        
+        t0 = time.time()
+        cube = VoxelCube(Rmax, box_size)
+        cube.from_catalogue(self.dist, self.ra, self.dec, self.Ag)
+        print('Voxel cube of shape {} in {} s'.format(cube.shape, time.time()-t0))
+        if filename is not None:
+            cube.write(filename)
+
+        x = cube.edges
+        X, Y = np.meshgrid(x, x, indexing='ij')
         for k in range(3):
-            ind2 = np.where((self.dist < Rmax) & (xyz[:,k] >= 0) & (xyz[:,k] <= 10))[0]
-            print(len(ind2))
-            xyz_new = xyz[ind2, :]
-            Ag = self.Ag[ind2]
-            Ag_box = np.zeros((len(x)-1, len(y)-1))
-            
-            if k == 0:
-                k0 = 1
-                k1 = 2
-            elif k == 1:
-                k0 = 0
-                k1 = 2
-            else:
-                k0 = 0
-                k1 = 1
-        
-            for i in range(len(x)-1):
-                for j in range(len(y)-1):
-                    ind3 = np.where((xyz_new[:,k0]>x[i]) & (xyz_new[:,k0] < x[i+1]) \
-                                & (xyz_new[:,k1] > y[j]) & (xyz_new[:,k1] < y[j+1]))[0]
-                    #print(xyz_new[ind3])
-                    #print(Ag[ind3])
-                    if len(ind3) > 0:
-                        Ag_mean = np.mean(Ag[ind3])
-                        r_mean = np.mean(self.dist[ind3])
-                    else:
-                        Ag_mean = 0.0
-                        r_mean = 1.0
-                    #
-                    
-                    #print(i, j, x[i], y[j], Ag_mean)
-                    Ag_box[i,j] = Ag_mean
-            #
-            
-            #rint('i=', i)
-            #
             plt.figure(k)
-            #plt.plot(xyz_new[:,0], xyz_new[:,1], '.b')
-            #plt.plot(xyz_new[ind3,0], xyz_new[ind3,1], '.r')
-            #print(Ag_box, np.shape(Ag_box))
-            plt.pcolormesh(X,Y, Ag_box)
+            plt.pcolormesh(X, Y, cube.plane(k, box_size/2.))
             cb = plt.colorbar()
-        
-        
-    
+        return(cube)
+
     def Extinction_mapslice(self, slices1=4, A=False, CE=False):
         """
         Calculate the extinction in cones/cake pieces as function for right 
@@ -367,55 +291,56 @@ class Extinction():
     
     def piece_of_cake(self, phi, theta, delta):
         """
-        Calculate the mean extinction in a slice/cone sector. 
+        Calculate the mean extinction in a slice/cone sector. The stars are
+        binned once into a sector cube, or an existing finer cube is rebinned.
         Input:
-        - phi, array. 
-        - theta, array.
-        - delta, scalar.
+        - phi, array. Start longitude of the sectors in degrees
+        - theta, array. Start colatitude of the sectors in degrees
+        - delta, scalar. The sector width in degrees
         Return:
-        - Ag_list, nd array
+        - Ag_list, nd array. (len(phi), len(theta), Nbins), zero for sectors
+                             outside the sky
         """
-        radeg = self.ra*180.0/np.pi
-        decdeg = self.dec*180.0/np.pi + 90.0
-
+        t0 = time.time()
+        cube = self.sector_cube(delta)
+        i, j = cube.sector_index(phi, theta)
+        ok_i = np.nonzero(i >= 0)[0]
+        ok_j = np.nonzero(j >= 0)[0]
         Ag_list = np.zeros((len(phi), len(theta), self.Nbins))
         print(np.shape(Ag_list))
-        t0 = time.time()
-        for i in range(len(phi)): # right ascension loop
-            
-            for j in range(len(theta)): # declination loop
-                ind2 = np.where((radeg > phi[i]) & (radeg <= phi[i]+delta) &\
-                                (decdeg > theta[j]) & (decdeg <= theta[j]+delta))[0]
-                if len(ind2) > 0:
-                    rad = self.dist[ind2]
-                    Ag = self.Ag[ind2]
-                    #print(i, phi[i], theta[j], len(ind2), np.mean(Ag))
-
-                    for k in range(self.Nmaps): # distance loop
-                        ind3 = np.where((rad > self.bin[k]) & (rad <= self.bin[k+1]))[0]
-                        #Ag_mean2 = np.mean(Ag2[ind2])
-                        #print(self.bin[k+1], Ag_mean2)
-                        Ag_list[i, j, k+1] = np.mean(Ag[ind3])
-                        print(Ag_list[i,j,k+1])
-                    #end distance loop 
-                else:
-                    Ag = 0.0
-                    Ag_list[i, j, :] = 0.0
-                # end if
-                #print('Line of sight: ra=({},{}), dec=({},{})'.format(phi[i], phi[i]+delta,\
-                #                                                      theta[j],theta[j]+delta))
-                #print(np.mean(Ag_list[i, j, :]))
-            # end declination loop
-            t1 = time.time()
-            print('time so fra:', t1-t0)
-            print('RA = ({},{})'.format(phi[i], phi[i]+delta))
-            #print(Ag_list[i, :, :])
-        
-        # end right ascension loop
-        
+        Ag_list[np.ix_(ok_i, ok_j, np.arange(1, self.Nbins))] =\
+                                    cube.mean_Ag[np.ix_(i[ok_i], j[ok_j])]
+        print('time used:', time.time()-t0)
         return(Ag_list)
-        
-        
+
+    def sector_cube(self, delta, fine=None):
+        """
+        Get the (RA, Dec, distance) sector cube with sector width delta. If
+        fine is given, a cube with sector width fine is made and kept. Later
+        calls with delta a multiple of fine are rebinned from the kept cube
+        instead of binning the stars again.
+        Input:
+        - delta, scalar. The sector width in degrees
+        - fine, scalar. Optional, the width of the finer cube to keep.
+        Return:
+        - cube, SectorCube.
+        """
+        if (fine is not None) and ((self.fine_cube is None) or\
+                                   (self.fine_cube.dphi != fine)):
+            self.fine_cube = SectorCube(fine, fine, self.bin).\
+                from_catalogue(self.ra*180/np.pi, self.dec*180/np.pi,\
+                               self.dist, self.Ag)
+
+        if self.fine_cube is not None:
+            f = delta/self.fine_cube.dphi
+            if abs(f - np.round(f)) < 1e-9:
+                f = int(np.round(f))
+                return(self.fine_cube.rebin(f, f))
+
+        cube = SectorCube(delta, delta, self.bin).\
+            from_catalogue(self.ra*180/np.pi, self.dec*180/np.pi,\
+                           self.dist, self.Ag)
+        return(cube)
 
     def Extinction_map(self, A=False, CE=False):
         """
@@ -440,43 +365,26 @@ class Extinction():
             sys.exit()
 
         ##
-        # make arrays:
-        Fx_list = np.zeros((self.Nbins, len(self.m)))
-        Fx_los = np.zeros((self.Nbins, len(self.m)))
         print('Number of maps={}, from distance r={} pc to r={} pc'.\
           format(self.Nmaps, self.Rmin, self.Rmax))
 
         print(self.bin)
         print(np.max(self.dist), np.min(self.dist))
-        print(np.shape(Fx_list), self.Npix)
-        maps = []
-        # loop over distance:
+        # bin all stars once in (pixel, distance), bin i+1 is (bin[i], bin[i+1]]
         t0 = time.time()
+        Bin_ind = np.searchsorted(self.bin, self.dist)
+        R_mean, Fx_mean, N = profile_matrix(self.pixpos, Bin_ind, self.dist,\
+                                            Fx, self.Npix, self.Nbins+1)
+
+        # row 0 stays zero, as the stars at dist <= Rmin are not mapped
+        Fx_list = np.zeros((self.Nbins, len(self.unique_pixel)))
+        Fx_list[1:] = Fx_mean[self.unique_pixel, 1:self.Nbins].T
+        Fx_los = np.cumsum(Fx_list, axis=0)
+        maps = [Fx_mean[:, i+1] for i in range(self.Nmaps)]
         for i in range(self.Nmaps):
-            t00 = time.time()
-            ind1 = np.where((self.dist > self.bin[i]) & (self.dist <= self.bin[i+1]))[0]
-            print('--> Bin {} at distance {} pc'.format(i+1, self.bin[i+1]))
-            pixel = self.pixpos[ind1]
-            fx = Fx[ind1]
-            fx_l = Fx_low[ind1]
-            fx_u = Fx_upp[ind1]
-            print(len(ind1))
-            
-            Fx_list, Ag_in_pix = self.pixAnalysis(Fx_list, fx, pixel, i)
-            Fx_los[i+1, :] = np.sum(Fx_list, axis=0)
-            #print(Fx_list[i+1,:])
-            
-            m1, b = np.histogram(pixel, self.Npix, weights=Ag_in_pix)
-            
-            #m1b = m1/np.max(self.m)
-            #hp.mollview(m1, coord=['C','G'], nest=False, title='Stars from {}pc to {}pc'.\
-            #    format(self.bin[i], self.bin[i+1]), unit='Nstars')
-            print('Mean extinction in the map [mag/pix]:', np.sum(Ag_in_pix)/self.Npix)
-            
-            #self.plotMaps_total(pixel, fx, i)
-            maps.append(m1)
-            t11 = time.time()
-            print('Iteration time: {} s'.format(t11-t00))
+            print('--> Bin {} at distance {} pc, {} stars'.\
+                  format(i+1, self.bin[i+1], np.sum(N[:, i+1])))
+            print('Mean extinction in the map [mag/pix]:', np.mean(maps[i]))
         # end map loop
         t1 = time.time()
         print('Computation time: {} s'.format(t1-t0))
@@ -588,6 +496,7 @@ class Extinction():
             # call to star class to get Ag in a pixel
             # Ag[p,r] = Ag[p,r] + star  # 
             # n[p,r] = n[p,r]+1   # if (n > some number) in a bin: increase Nside
+            # -> done in AdaptiveMap()
             if i%1000==0:
                 t3 = time.time()
                 print('i=', i, t3-t1, aa)
@@ -599,6 +508,28 @@ class Extinction():
         """
         ######
 
+    def AdaptiveMap(self, threshold=50, Nside_min=8, Nside_max=1024,\
+                    filename=None):
+        """
+        Make a multi-order extinction map, where a NESTED pixel is split into
+        its four children while one of its distance bins has more than
+        threshold stars.
+        Input:
+        - threshold, integer. Maximum number of stars in a (pixel, bin)
+        - Nside_min, integer. The coarsest Nside
+        - Nside_max, integer. The finest Nside
+        - filename, string. If given, write the map to this .h5 file
+        Return:
+        - map, MultiOrderMap.
+        """
+        Bin_ind = np.searchsorted(self.bin, self.dist) - 1
+        map = MultiOrderMap.build(self.longitude, self.latitude, Bin_ind,\
+                                  self.dist, self.Ag, self.Nmaps, threshold,\
+                                  Nside_min, Nside_max)
+        if filename is not None:
+            map.write(filename)
+        return(map)
+
     def Ag_func(self, Ndraws):
         """
         Compute the 'mean' extinction along a sight line, to be able to parameterise it
@@ -702,10 +633,11 @@ class Extinction():
         plt.show()
         #"""
 
-    def Ag_los_fitcurve(self, angle_in=None, pixel_in=None):
+    def Ag_los_fitcurve(self, angle_in=None, pixel_in=None, ind_in=None):
         """
         Fit a curve to mean Ag along one line of sight. And find the derivative of 
-        Ag.
+        Ag. For angle input the stars are the ones within a 2.5 deg cone, found
+        from the cone index, or given directly with ind_in from a batch query.
      
         """
         
@@ -720,12 +652,10 @@ class Extinction():
             dlos = 2.5
             dec_in = angle_in[0]
             ra_in = angle_in[1]
-            l = self.longitude
-            b = 90 - self.latitude
-            print(np.min(l), np.min(b))  
-            print(np.max(l), np.max(b))
-            ind1 = np.where((b < dec_in + dlos) & (b > dec_in - dlos) &\
-                            (l > ra_in - dlos) & (l < ra_in + dlos))[0]
+            if ind_in is None:
+                ind1 = self.cone_index().cone(ra_in, 90 - dec_in, dlos)
+            else:
+                ind1 = ind_in
             coord = [dec_in, ra_in]
 
         else:
@@ -791,23 +721,20 @@ class Extinction():
     def Draw_pixel(self, Ndraws, Ag_array, R_array):
         
         pix_draw = np.random.choice(self.gal_pixpos, Ndraws)
-        Ag_poly = np.zeros((Ndraws, len(self.x)))
-        Ag_der = np.zeros((Ndraws, len(self.x)))
         coords = []
         for i, dp in enumerate(pix_draw):
             print('Drawn pixel:', dp)
             Ag_list, R_list, coord = self.Ag_los_fitcurve(pixel_in=dp)
             Ag_array[i,:] = Ag_list
             R_array[i,:] = R_list
-
-            fit = np.polyfit(R_list, Ag_list, 10)
-            fx = np.poly1d(fit)
-
-            Ag_poly[i,:] = fx(self.x)
-            dAg = self.derivation(fx, self.x)
-            Ag_der[i,:] = dAg
             coords.append(coord)
-            
+        #
+        # fit all drawn sight lines at once, and evaluate on self.x
+        coef, domain = poly_fit(R_array, Ag_array, 10, domain=(0, self.Rmax))
+        Ag_poly = poly_eval(coef, self.x, domain)
+        Ag_der = poly_eval(coef, self.x, domain, der=1)
+        for i, coord in enumerate(coords):
+            dAg = Ag_der[i,:]
             #print(R_list)
             #print(Ag_list)
             plt.figure(i)
@@ -833,15 +760,20 @@ class Extinction():
         Ntheta = len(theta)
         print(phi, len(phi))
         print(theta, len(theta))
-        Ag_poly = np.zeros((Nphi, Ntheta, len(self.x)))
-        Ag_der = np.zeros((Nphi, Ntheta, len(self.x)))
         c = ['k','purple','b','r','g','y','m','c','grey']
         m = ['.','^','x','*','^','+','d','v','o']
+
+        # find the stars of all sight lines in one cone query:
+        lon_los = np.repeat(phi, Ntheta)
+        lat_los = 90 - np.tile(theta, Nphi)
+        indptr, indices = self.cone_index().query(lon_los, lat_los, 2.5)
         for i in range(Nphi):
             print('=> phi:', phi[i])
             for j in range(Ntheta):
                 print('-', phi[i], theta[j])
-                Ag_list, R_list, coord = self.Ag_los_fitcurve(angle_in=[theta[j], phi[i]])
+                k = i*Ntheta + j
+                Ag_list, R_list, coord = self.Ag_los_fitcurve(angle_in=[theta[j], phi[i]],\
+                                                ind_in=indices[indptr[k]:indptr[k+1]])
                 Ag_array[i,j,:] = Ag_list
                 R_array[i, j,:] = R_list
                 # Merge last and first phi:
@@ -854,13 +786,6 @@ class Extinction():
                     R_array[-1, j,:] = (R0 + R1)/2
                     
                 #
-                fit = np.polyfit(R_list, Ag_list, 10)
-                fx = np.poly1d(fit)
-                dAg = self.derivation(fx, self.x)
-                
-                Ag_poly[i, j,:] = fx(self.x)
-                Ag_der[i, j, :] = dAg
-                
                 plt.figure(i)
                 plt.scatter(R_array[i, j,:], Ag_array[i,j,:], c=c[j], marker=m[j],\
                          label=r'$b={}$'.format(theta[j]))
@@ -872,18 +797,27 @@ class Extinction():
                 plt.savefig('Figures/Ag_points2_los{}.png'.format(phi[i]))
             #
 
-        #
+        # fit all sight lines in one call, and evaluate on self.x
+        Nlos = Nphi*Ntheta
+        coef, domain = poly_fit(R_array.reshape(Nlos, -1),\
+                                Ag_array.reshape(Nlos, -1), 10,\
+                                domain=(0, self.Rmax))
+        Ag_poly = poly_eval(coef, self.x, domain).reshape(Nphi, Ntheta, -1)
+        Ag_der = poly_eval(coef, self.x, domain, der=1).\
+                                            reshape(Nphi, Ntheta, -1)
                     
         return(Ag_poly, Ag_der)
         ###
 
-    def derivation(self, f, x):
+    def cone_index(self):
         """
-        Compute the derivative of Ag
+        The cone search index over the galactic positions of the stars, built
+        at the first call.
         """
-        h = 1e-5
-        return((f(x+h) - f(x-h))/(2*h))
-    
+        if self.cone_idx is None:
+            self.cone_idx = ConeIndex(self.longitude, self.latitude)
+        return(self.cone_idx)
+
 
 
     def Interpolate(self, r, fx, N, A=None):
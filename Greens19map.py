@@ -13,6 +13,9 @@ import h5py
 import sys, glob, time
 import pandas as pd
 
+from cone_index import ConeIndex
+from green19 import GreenMap, Rasteriser
+
 
 def main_los(Nside_gaia, greens_file):
     """
@@ -68,11 +71,17 @@ def main_los(Nside_gaia, greens_file):
 
     #lon_list = [45., 90., 135.,180., 225.]
     lon_list = [220.,225.,230]
-    for l in lon_list:
+    lat_plot = [65,70,75]  # polar angle of the sight lines, in degrees
+
+    # find the pixels of all sight lines in one cone query
+    index = ConeIndex(lon_gaia, 90 - lat_gaia)
+    lon_cone = np.repeat(lon_list, len(lat_plot))
+    lat_cone = 90 - np.tile(lat_plot, len(lon_list))
+    indptr, indices = index.query(lon_cone, lat_cone, delta)
+    for i, l in enumerate(lon_list):
         print('--> Plot for longitide = {}'.format(l))
-        ind = np.where((lon_gaia >= l - delta) & (lon_gaia < l + delta))[0]
-        plot_Ag_los(R[ind,:], Ag[ind,:], Ag_err[ind,:,:], lat_gaia[ind],\
-                    lon_gaia[ind], lat_los, l)
+        sl = slice(i*len(lat_plot), (i+1)*len(lat_plot) + 1)
+        plot_Ag_los(R, Ag, Ag_err, indptr[sl], indices, lat_plot, l)
 
         #plot_green_extinction(x_green[:ix_max], Al[:,:], Al_err[:,:],\
         #                    lon_green, lat_green, lat_los, l)
@@ -97,20 +106,20 @@ def load_gaia(Nside):
     theta, phi = hp.pixelfunc.pix2ang(Nside, pixels)
     return(Ag, Ag_err, R, pixels, Npix, theta, phi)
 
-def plot_Ag_los(R, Ag, Ag_err, theta, phi, lat_los, phi_in=90):
+def plot_Ag_los(R, Ag, Ag_err, indptr, indices, lat_los, phi_in=90):
     """
-    Plotting function for the data points of Gaia. Sight lines are of 5 sq.deg.
+    Plotting function for the data points of Gaia. Sight lines are cones of
+    radius 2.5 deg, given as CSR pixel lists from a cone query: the pixels of
+    sight line i are indices[indptr[i]:indptr[i+1]].
     """
 
     print('Plot Gaia los extinction')
-    lat_los = [65,70,75]
-    delta = 2.5
     color = ['b', 'r', 'g']#, 'm', 'purple']
     markers = ['x', '.', '^']#, '+', 'd']
     plt.figure('Greens vs Gaia extinction: l={}'.format(int(phi_in)))
 
     for i, b in enumerate(lat_los):
-        ind = np.where((theta >= b - delta) & (theta < b + delta))[0]
+        ind = indices[indptr[i]:indptr[i+1]]
 
         print('lat:', b)
         R_new = np.mean(R[ind,:], axis=0)
@@ -146,40 +155,62 @@ def Greens_los_reddening(file, lat_los, ind_x):
     """
 
     print('Load Greens map')
-    best_fit, pixel_info, samples = Read_GreensMap(file)
-    best_fit = best_fit[:,:ind_x]
-    samples = samples[:,:,:ind_x]
-
-    # Get maximum Nside of the map, find Npix
-    Nside_max = np.max(pixel_info['nside'])
-    Npix = hp.nside2npix(Nside_max)
-
-    # Convert to an usable format...
-    #Nsides = pixel_info['nside']
-    #pix_ind_n = pixel_info['healpix_index']
-    Nsides = np.int16(pixel_info['nside'])
-    pix_ind_n = np.int64(pixel_info['healpix_index'])
-
-    # convert to ringed and get theta, phi:
-    pix_ind_r, theta, phi = get_position(Nsides, pix_ind_n)
-    lon = phi * 180/np.pi
-    lat = theta * 180/np.pi
-
-    # cumulative reddening along each sight line
-    print('Calculate reddening')
-    t2 = time.time()
-    reddening = median(samples)#np.median(samples[:,:,:], axis=1)
-    t3 = time.time()
-    print('Time used in calculating reddening: {}s'.format(t3-t2))
-
-    print('Calculate error in reddening')
-    t4 = time.time()
-    E_err = sigma_E(samples[:,:,:])
-    t5 = time.time()
-    print('Calculating reddening error in: {}s'.format(t5-t4))
+    with GreenMap(file) as samples:
+        best_fit = samples.best_fit[:,:ind_x]
+        pixel_info = samples.pixel_info
+
+        # Get maximum Nside of the map, find Npix
+        Nside_max = np.max(pixel_info['nside'])
+        Npix = hp.nside2npix(Nside_max)
+
+        # Convert to an usable format...
+        #Nsides = pixel_info['nside']
+        #pix_ind_n = pixel_info['healpix_index']
+        Nsides = np.int16(pixel_info['nside'])
+        pix_ind_n = np.int64(pixel_info['healpix_index'])
+
+        # convert to ringed and get theta, phi:
+        pix_ind_r, theta, phi = get_position(Nsides, pix_ind_n)
+        lon = phi * 180/np.pi
+        lat = theta * 180/np.pi
+
+        # cumulative reddening along each sight line
+        print('Calculate reddening')
+        t2 = time.time()
+        reddening = median(samples, slice(0, ind_x))
+        t3 = time.time()
+        print('Time used in calculating reddening: {}s'.format(t3-t2))
+
+        print('Calculate error in reddening')
+        t4 = time.time()
+        E_err = sigma_E(samples, slice(0, ind_x))
+        t5 = time.time()
+        print('Calculating reddening error in: {}s'.format(t5-t4))
 
     return(reddening, E_err, lon, lat)
 
+def Greens_star_extinction(file, l, b, dist):
+    """
+    The reddening and extinction of Greens et.al 2019 to stars, interpolated
+    in distance modulus between the distance bins.
+
+    Parameters:
+    ----------
+    - file, string.     path and filename of the Greens map
+    - l, b, arrays.     Galactic coordinates of the stars in degrees
+    - dist, array.      Distance to the stars in pc
+
+    Return:
+    ----------
+    - reddening, array. The median reddening E(B-V) to each star
+    - E_err, array.     The standard deviation of the reddening
+    - Ag, array.        The extinction A_G to each star
+    """
+    with GreenMap(file) as samples:
+        reddening = samples.query(l, b, dist, 'median')
+        E_err = samples.query(l, b, dist, 'std')
+    return(reddening, E_err, Ebv2Ag(reddening))
+
 def plot_green_extinction(x, A_array, A_error, lon, lat, lat_los=None, l_in=0):
     """
     Plot los reddening for sight lines of size 5 square degrees
@@ -220,12 +251,10 @@ def plot_green_extinction(x, A_array, A_error, lon, lat, lat_los=None, l_in=0):
 ### Reading functions and helping function ###
 
 def Read_GreensMap(file):
-    f = h5py.File(file, 'r')
-    best_fit = np.asarray(f['/best_fit'])
-    pixel_info = np.asarray(f['pixel_info'])
-    samples = np.asarray(f['samples'])
-    f.close()
-    return(best_fit, pixel_info, samples)
+    # samples is read lazily, only the distance bins indexed are loaded. The
+    # caller closes it, or use 'with GreenMap(file) as samples:'
+    samples = GreenMap(file)
+    return(samples.best_fit, samples.pixel_info, samples)
 
 def Read_GaiaH5(file, name):
     f = h5py.File(file, 'r')
@@ -238,24 +267,13 @@ def get_position(Nsides, pixel_nest):
     theta, phi = hp.pixelfunc.pix2ang(Nsides, pix_r)
     return(pix_r, theta, phi)
 
-def median(samples):
-    # Compute the median values for each bin in each sight line.
-    E = np.empty((len(samples[:,0,0]), len(samples[0,0,:])))
-    i_prev = 0
-    for i in range(100000, len(samples[:,0,0])+1, 100000):
-        E[i_prev:i, :] = np.median(samples[i_prev:i,:,:], axis=1)
-        i_prev = i
-    return(E)
-
-def sigma_E(samples):
-    # compute the standard error of the samples,
-    #return(np.percentile(samples, [16, 84], axis=1))
-    sigma = np.empty((len(samples[:,0,0]), len(samples[0,0,:])))
-    i_prev = 0
-    for i in range(100000, len(samples[:,0,0])+1, 100000):
-        sigma[i_prev:i,:] = np.std(samples[i_prev:i,:,:], axis=1)
-        i_prev = i
-    return(sigma)
+def median(samples, dist_ind=slice(None)):
+    # The median values for each bin in each sight line, from the summary cube.
+    return(samples.summary('median', dist_ind))
+
+def sigma_E(samples, dist_ind=slice(None)):
+    # The standard deviation of the samples, from the summary cube.
+    return(samples.summary('std', dist_ind))
 
 def Ebv2Ag(reddening, Rvec=2.617):
     """
@@ -310,8 +328,8 @@ def construct_pixel_values(Nside, Npix, pix_ind, Nsides, samples, dist_ind=-1):
     - Npix, integer.        The number of Healpix pixels in the map.
     - pixel_info, nd array. Arrays containing information of the pixels. need
                             nsides and pixel index
-    - samples, nd array.    Array containg the sampling data for each sight line
-                            and distance bins.
+    - samples, GreenMap.    The sampling data for each sight line and distance
+                            bins, the median is read from its summary cube.
     - dist_ind, integer.    The index of the distance bin to evaluate.
                             Default is -1.
 
@@ -321,31 +339,12 @@ def construct_pixel_values(Nside, Npix, pix_ind, Nsides, samples, dist_ind=-1):
                             evaluation distance.
     """
 
-    pixel_val = np.empty(Npix, dtype='f8')
-    pixel_val[:] = np.nan
-
-    EBV_far_median = np.median(samples[:,:,dist_ind], axis=1)
-    # fill in the sampled map
-    #for Ns in np.unique(pixel_info['nside']):
-    for Ns in np.unique(Nsides):
-        # Get the indices of all pixels at current Nside level
-        print('Get pixel values for Nside {} at distance index {}'.format(Ns,dist_ind))
-        #ind = pixel_info['nside'] == Ns
-        ind = Nsides == Ns
-        # get the reddening of each selected pixel
-        pix_val_n = EBV_far_median[ind]
-
-        # Determine nested index of each selected pixel in sampled map
-        mult_factor = (Nside/Ns)**2
-        #pix_ind_n = pixel_info['healpix_index'][ind]*mult_factor
-        pix_ind_n = pix_ind[ind]*mult_factor
-        # write the selected pixels into the sampled map
-        for offset in range((mult_factor)):
-            pixel_val[pix_ind_n+offset] = pix_val_n[:]
-
+    EBV_far_median = samples.summary('median', dist_ind)
+    # expand each sight line to its sub pixels at Nside
+    pixel_val = Rasteriser(pix_ind, Nsides, Nside).cube(EBV_far_median)
     return(pixel_val)
 
-def Greens_maps(file, ind, ind2=None, dist_ind=None):
+def Greens_maps(file, ind, ind2=None, dist_ind=None, Nside_out=None):
     """
     Plot the sky map of reddening.
 
@@ -355,60 +354,49 @@ def Greens_maps(file, ind, ind2=None, dist_ind=None):
     - ind, list.            List of bin indices for which bins to store
     - dist_ind, int/list.   If int make one map. If list, make several maps with
                             the given distance indices. Index max=120
+    - Nside_out, integer.   Nside of the maps, default is the largest Nside of
+                            the Greens map.
     """
     print('load Greens data')
-    best_fit, pixel_info, samples = Read_GreensMap(file)
-    Nsides = np.int16(pixel_info['nside'])
-    pix_ind = np.int64(pixel_info['healpix_index'])
-    x, mu = distance_array()
-    #ind = np.where((x >= 100) & (x <= 300))[0]
-    #if np.max(ind) < 60:
-    #    ind_max = 2*np.max(ind)
-    #    bins = [np.min(ind), np.max(ind), ind_max]
-    #else:
-    #bins = np.array([ind_min, ind_max])
-
-    bins = [np.min(ind), np.max(ind)]
-    if ind2 != None:
-        bins.append(np.min(ind2))
-        bins.append(np.max(ind2))
-
-    print(x[bins])
-    print(bins)
-    Nbins = len(best_fit[0,:])
-
-    #print(bins, Nbins)
-    Nside_max = np.max(pixel_info['nside'])
-    Npix = hp.pixelfunc.nside2npix(Nside_max)
-    prev_map = np.zeros(Npix)
-    print(Nside_max, Npix)
+    with GreenMap(file) as samples:
+        pixel_info = samples.pixel_info
+        Nsides = np.int16(pixel_info['nside'])
+        pix_ind = np.int64(pixel_info['healpix_index'])
+        x, mu = distance_array()
+        #ind = np.where((x >= 100) & (x <= 300))[0]
+        #if np.max(ind) < 60:
+        #    ind_max = 2*np.max(ind)
+        #    bins = [np.min(ind), np.max(ind), ind_max]
+        #else:
+        #bins = np.array([ind_min, ind_max])
+
+        bins = [np.min(ind), np.max(ind)]
+        if ind2 != None:
+            bins.append(np.min(ind2))
+            bins.append(np.max(ind2))
+
+        print(x[bins])
+        print(bins)
+        Nbins = samples.Nbins
+
+        #print(bins, Nbins)
+        if Nside_out is None:
+            Nside_out = np.max(pixel_info['nside'])
+        Npix = hp.pixelfunc.nside2npix(Nside_out)
+        print(Nside_out, Npix)
+
+        # all bins rasterised in one pass
+        dist_inds = [min(dist_ind, Nbins-1) for dist_ind in bins]
+        print('Make sky maps at distances {}'.format(x[dist_inds]))
+        pixel_vals = samples.maps(dist_inds, Nside_out)
 
-    #for dist_ind in range(0, Nbins+1, 10):
+    prev_map = np.zeros(Npix)
     maps = []
-    for dist_ind in bins:
-        print('Bin number {}'.format(dist_ind))
-        #sys.exit()
-        print('Make sky map at distance {}'.format(x[dist_ind]))
-        if dist_ind == Nbins:
-            dist_ind = Nbins-1
-        pixel_val = construct_pixel_values(Nside_max, Npix, pix_ind, Nsides,\
-                    samples, dist_ind)
-
-        #pixel_val = hp.pixelfunc.nest2ring(Nside_max, pixel_val)
-
+    for pixel_val in pixel_vals:
         curr_map = pixel_val - prev_map
         maps.append(curr_map)
-        #curr_map = Ebv2Ag(curr_map)
-
-        #greens_map = hp.pixelfunc.ud_grade(curr_map, 64)
-        #hp.mollview(curr_map, nest=True, title='Extinction')
-
-        #hp.mollview(np.log(curr_map), nest=True, title='log of Reddening',\
-        #            rot=(130., 0.))
 
         prev_map = curr_map
-
-    #
     return(maps)
 
 def compare_Greens_Gaia(Nside, greens_file, xmin, xmax, xmin2=None, xmax2=None):
@@ -428,94 +416,118 @@ def compare_Greens_Gaia(Nside, greens_file, xmin, xmax, xmin2=None, xmax2=None):
 
     Return:
     -----------
+    - stats, dict.          Residual statistics of each interval, see
+                            compare_intervals().
+    """
+    intervals = [(xmin, xmax)]
+    if (xmin2 is not None) and (xmax2 is not None):
+        intervals.append((xmin2, xmax2))
+
+    Ag_maps, Av_maps, stats = compare_intervals(Nside, greens_file, intervals)
+    for i, (x0, x1) in enumerate(intervals):
+        plot_comparison(Ag_maps[i], Av_maps[i], x0, x1, Nside, nest=True)
+    return(stats)
+
+def interval_bins(x, intervals):
+    """
+    The first and last index of x within each distance interval,
+    [xmin, xmax], for all intervals at once.
+    """
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    inside = (x[None,:] >= intervals[:,0,None]) & (x[None,:] <= intervals[:,1,None])
+    if not np.all(np.any(inside, axis=1)):
+        print('Distance interval without bins:', intervals[~np.any(inside, axis=1)])
+        sys.exit()
+    first = np.argmax(inside, axis=1)
+    last = len(x) - 1 - np.argmax(inside[:,::-1], axis=1)
+    return(first, last)
+
+def compare_intervals(Nside, greens_file, intervals, Ag_cut=0.5, Rvec=2.617):
     """
+    Compare the differential extinction of Gaia and Greens et.al 2019 in
+    several distance intervals, loading the Gaia profiles and the Greens map
+    once. The Greens maps of all interval edges are rasterised together at
+    Nside, and the differential maps of all intervals are made by indexing.
+    The Gaia data use 'Ag > Ag_cut, else Ag = 0', because of the large
+    uncertainty.
 
+    Parameters:
+    -----------
+    - Nside, integer.       The resolution of the Gaia maps.
+    - greens_file, string.  Filename of the greens map.
+    - intervals, list.      List of (xmin, xmax) distance intervals in pc.
+    - Ag_cut, scalar.       The smallest Gaia extinction used.
+    - Rvec, scalar.         Extinction vector converting the Greens reddening
+                            to A_G, see Ebv2Ag().
+
+    Return:
+    -----------
+    - Ag_maps, ndarray.     (Nintervals, Npix) Gaia extinction in each interval,
+                            NESTED, 0 below Ag_cut.
+    - Av_maps, ndarray.     (Nintervals, Npix) Greens reddening in each
+                            interval, NESTED.
+    - stats, dict.          Arrays over the intervals of: the distance limits,
+                            the number of compared pixels, and the mean,
+                            median and std of the residual Ag - A_Greens, the
+                            median ratio Ag/A_Greens and the correlation.
+    """
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
     x, mu = distance_array()
     print('Compare extincion between Gaia and Greens.')
-    print('Compare for distances between: {} pc and {} pc'.format(xmin, xmax))
 
     # Load gaia maps:
-    Npix = hp.pixelfunc.nside2npix(Nside)
     Ag, Ag_err, R, pixels, Npix, theta, phi = load_gaia(Nside)
     Rmean = np.mean(R, axis=0)
 
-    ind2 = np.where((x >= xmin) & (x <= xmax))[0]
-    ind22 = np.where((x >= xmin2) & (x <= xmax2))[0]
-
-    ind1 = np.where((Rmean >= xmin) & (Rmean <= xmax))[0]
-    ind12 = np.where((Rmean >= xmin2) & (Rmean <= xmax2))[0]
-
-    #cut = Ag/Ag_err > 3 recalc the error to error of mean, not mean of error.
-    #Ag_diff = []
-    #ind_min_gaia = []
-    #ind_max_gaia = []
-    #ind_min_green = []
-    #ind_max_green = []
-
-    """
-    if isinstance(xmin, list) and isinstance(xmax, list):
-        print('ok')
-        xmin = np.sort(xmin)
-        xmax = np.sort(xmax)
-
-        for i in range(len(xmin)):
-            ind_min_gaia.append(np.min(np.where(Rmean >= xmin[i])))
-            ind_max_gaia.append(np.max(np.where(Rmean <= xmax[i])))
-            ind_min_green.append(np.min(np.where(x >= xmin[i])))
-            ind_max_green.append(np.max(np.where(x <= xmax[i])))
-
-        for i in range(len(xmin)):
-            diff = Ag[:,ind_max_gaia[i]] - Ag[:,ind_min_gaia[i]]
-            Ag_diff.append(diff)
-        #sys.exit()
-    else:
-        ind2 = np.where((x >= xmin) & (x <= xmax))[0]
-        ind1 = np.where((Rmean >= xmin) & (Rmean <= xmax))[0]
-        ind_min_gaia = np.min(ind1)
-        ind_max_gaia = np.max(ind1)
-        ind_min_green = np.min(ind2)
-        ind_max_green = np.max(ind2)
-
-        Ag_diff = Ag[:,ind_max_gaia] - Ag[:,ind_min_gaia]
-
-    """
-    # load Greens maps:
-    Av_maps = Greens_maps(greens_file, ind2)
-    print(len(Av_maps))
-
-    Ag_diff = Ag[:,np.max(ind1)] - Ag[:,np.min(ind1)]
-    if (xmin2 != None) and (xmax2 != None):
-        Ag_diff2 = Ag[:, np.max(ind12)] - Ag[:, np.min(ind12)]
-        R_bins = [np.min(ind1), np.max(ind1), np.min(ind12), np.max(ind12)]
-        print(R_bins)
-        print(Rmean[R_bins])
-    else:
-        R_bins = [np.min(ind1), np.max(ind1)]
-        print(R_bins)
-        print(Rmean[R_bins])
-    #"""
-
-    # down grade the Greens maps.
-    dgrade_maps = []
-    #Av_new = hp.pixelfunc.ud_grade(Av_maps, Nside, order_out='RING')
-    c = 0
-    for m in Av_maps:
-        c += 1
-        m_new = hp.pixelfunc.ud_grade(m, Nside, order_in='NESTED', order_out='NESTED')
-        dgrade_maps.append(m_new)
-        print(c-1)
-
-    #
-    plot_comparison(Ag_diff, dgrade_maps[1], xmin, xmax, Nside)
-    #plot_comparison(Ag_diff2, dgrade_maps[3], xmin2, xmax2, Nside)
-
-
-def plot_comparison(Ag, Av, xmin, xmax, Nside):
+    # the edge bins of all intervals, Gaia and Greens
+    g0, g1 = interval_bins(Rmean, intervals)
+    s0, s1 = interval_bins(x, intervals)
+    for i in range(len(intervals)):
+        print('{} pc to {} pc: Gaia bins {}, {}, Greens bins {}, {}'.\
+              format(intervals[i,0], intervals[i,1], g0[i], g1[i], s0[i], s1[i]))
+
+    # Gaia differential extinction, ring to nested ordering
+    ring = hp.nest2ring(Nside, np.arange(Npix))
+    Ag_diff = (Ag[:,g1] - Ag[:,g0]).T[:,ring]
+    Ag_maps = np.where(Ag_diff > Ag_cut, Ag_diff, 0.)
+
+    # Greens reddening at all edge bins, rasterised once at Nside
+    edges, inv = np.unique(np.append(s0, s1), return_inverse=True)
+    with GreenMap(greens_file) as samples:
+        edge_maps = samples.maps(edges, Nside)
+    Av_maps = edge_maps[inv[len(s0):]] - edge_maps[inv[:len(s0)]]
+
+    # residual statistics in the pixels with both maps
+    stats = {'xmin': intervals[:,0], 'xmax': intervals[:,1],\
+             'N': np.zeros(len(intervals), dtype=int)}
+    for key in ['mean', 'median', 'std', 'ratio', 'corr']:
+        stats[key] = np.full(len(intervals), np.nan)
+    for i in range(len(intervals)):
+        A_green = Ebv2Ag(Av_maps[i], Rvec)
+        cond = np.isfinite(A_green) & (A_green != 0) & (Ag_maps[i] > Ag_cut)
+        res = Ag_maps[i,cond] - A_green[cond]
+        stats['N'][i] = np.sum(cond)
+        if stats['N'][i] > 1:
+            stats['mean'][i] = np.mean(res)
+            stats['median'][i] = np.median(res)
+            stats['std'][i] = np.std(res)
+            stats['ratio'][i] = np.median(Ag_maps[i,cond]/A_green[cond])
+            stats['corr'][i] = np.corrcoef(Ag_maps[i,cond], A_green[cond])[0,1]
+        print('{} pc to {} pc: N={}, residual mean={}, median={}, std={}, ratio={}, corr={}'.\
+              format(intervals[i,0], intervals[i,1], stats['N'][i],\
+                     stats['mean'][i], stats['median'][i], stats['std'][i],\
+                     stats['ratio'][i], stats['corr'][i]))
+    return(Ag_maps, Av_maps, stats)
+
+
+def plot_comparison(Ag, Av, xmin, xmax, Nside, nest=False):
+    # Ag is in RING ordering unless nest, Av in NESTED
     Npix = hp.nside2npix(Nside)
     Ag_new = np.zeros(Npix)
     print(np.shape(Ag_new), np.shape(Ag))
     Ag_new[np.where(Ag > 0.5)] = Ag[np.where(Ag > 0.5)]
-    Ag_new = hp.pixelfunc.reorder(Ag_new, r2n=True)
+    if not nest:
+        Ag_new = hp.pixelfunc.reorder(Ag_new, r2n=True)
 
     hp.mollview(Av, nest=True, title='Greens, {}pc to {}pc'.\
                 format(int(xmin), int(xmax)))
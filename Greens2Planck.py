@@ -11,8 +11,10 @@ import sys, time
 
 import convert_units
 #from Greens19maps import distance_array, Greens_maps
-from mcmc_sampler import MetropolisHastings, mh_step, proposal_rule
 from functools import partial
+from green19 import GreenMap, Rasteriser
+from nest_grade import ud_grade, pyramid
+from scaling_fit import grid_posterior, gaussian_log_prior
 
 ##### Functions #####
 
@@ -20,29 +22,22 @@ def load_planck_map(file):
     m857, hdr = hp.fitsfunc.read_map(file, h=True)
     return(m857)
 
-def fix_resolution(map, Nside_in=0, ordering='RING'):
+def fix_resolution(map, Nside_in=0, ordering='RING', order_out=None,\
+                   badval=hp.UNSEEN):
     sides = [8,16,32,64,128]
-    maps = []
-    smaps = []
     t0 = time.time()
     if Nside_in > 0:
         print('Fix resolution to Nside={}'.format(Nside_in))
-        m = hp.pixelfunc.ud_grade(map, Nside_in, order_in=ordering,\
-                                order_out=ordering)
+        m = ud_grade(map, Nside_in, order_in=ordering, order_out=order_out,\
+                     badval=badval)
         return(m)
 
     else:
-        for Ns in Nsides:
-            t1 = time.time()
-            print('Fix resolution to Nside={}'.format(Ns))
-            m = hp.pixelfunc.ud_grade(map, Ns, order_in=ordering,\
-                                    order_out=ordering)
-            maps.append(m)
-
-            t2 = time.time()
-
-            print('Interation time: {}s, total time: {}s'.format((t2-t1), (t2-t0)))
-        #
+        # all resolutions in one pass
+        print('Fix resolution to Nside={}'.format(sides))
+        maps = pyramid(map, sides, order_in=ordering, order_out=order_out,\
+                       badval=badval)
+        print('Total time: {}s'.format(time.time() - t0))
         return(maps)
 
 def smoothing(map, Nside):
@@ -51,12 +46,10 @@ def smoothing(map, Nside):
     return(smap)
 
 def Read_GreensMap(file):
-    f = h5py.File(file, 'r')
-    best_fit = np.asarray(f['/best_fit'])
-    pixel_info = np.asarray(f['pixel_info'])
-    samples = np.asarray(f['samples'])
-    f.close()
-    return(best_fit, pixel_info, samples)
+    # samples is read lazily, only the distance bins indexed are loaded. The
+    # caller closes it, or use 'with GreenMap(file) as samples:'
+    samples = GreenMap(file)
+    return(samples.best_fit, samples.pixel_info, samples)
 
 def distance_array():
     """
@@ -80,8 +73,8 @@ def construct_pixel_values(Nside, Npix, pix_ind, Nsides, samples, dist_ind=-1):
     - Npix, integer.        The number of Healpix pixels in the map.
     - pixel_info, nd array. Arrays containing information of the pixels. need
                             nsides and pixel index
-    - samples, nd array.    Array containg the sampling data for each sight line
-                            and distance bins.
+    - samples, GreenMap.    The sampling data for each sight line and distance
+                            bins, the median is read from its summary cube.
     - dist_ind, integer.    The index of the distance bin to evaluate.
                             Default is -1.
 
@@ -91,32 +84,12 @@ def construct_pixel_values(Nside, Npix, pix_ind, Nsides, samples, dist_ind=-1):
                             evaluation distance.
     """
 
-    pixel_val = np.empty(Npix, dtype='f8')
-    pixel_val[:] = np.nan
-
-    EBV_far_median = np.median(samples[:,:,dist_ind], axis=1)
-    # fill in the sampled map
-    #for Ns in np.unique(pixel_info['nside']):
-    for Ns in np.unique(Nsides):
-        # Get the indices of all pixels at current Nside level
-        print('Get pixel values for Nside {} at distance index {}'.\
-                format(Ns,dist_ind))
-
-        ind = Nsides == Ns
-        # get the reddening of each selected pixel
-        pix_val_n = EBV_far_median[ind]
-
-        # Determine nested index of each selected pixel in sampled map
-        mult_factor = (Nside/Ns)**2
-
-        pix_ind_n = pix_ind[ind]*mult_factor
-        # write the selected pixels into the sampled map
-        for offset in range((mult_factor)):
-            pixel_val[pix_ind_n+offset] = pix_val_n[:]
-
+    EBV_far_median = samples.summary('median', dist_ind)
+    # expand each sight line to its sub pixels at Nside
+    pixel_val = Rasteriser(pix_ind, Nsides, Nside).cube(EBV_far_median)
     return(pixel_val)
 
-def Greens_maps(file, ind, ind2=None, dist_ind=None):
+def Greens_maps(file, ind, ind2=None, dist_ind=None, Nside_out=None):
     """
     Create sky map of reddening.
 
@@ -126,43 +99,42 @@ def Greens_maps(file, ind, ind2=None, dist_ind=None):
     - ind, list.            List of bin indices for which bins to store
     - dist_ind, int/list.   If int make one map. If list, make several maps with
                             the given distance indices. Index max=120
+    - Nside_out, integer.   Nside of the maps, default is the largest Nside of
+                            the Greens map.
     """
     print('load Greens data')
-    best_fit, pixel_info, samples = Read_GreensMap(file)
-    Nsides = np.int16(pixel_info['nside'])
-    pix_ind = np.int64(pixel_info['healpix_index'])
-    x, mu = distance_array()
+    with GreenMap(file) as samples:
+        pixel_info = samples.pixel_info
+        Nsides = np.int16(pixel_info['nside'])
+        pix_ind = np.int64(pixel_info['healpix_index'])
+        x, mu = distance_array()
+
+        bins = [np.min(ind), np.max(ind)]
+        if ind2 is not None:
+            bins.append(np.min(ind2))
+            bins.append(np.max(ind2))
+
+        print(x[bins])
+        print(bins)
+        Nbins = samples.Nbins
+
+        if Nside_out is None:
+            Nside_out = np.max(pixel_info['nside'])
+        Npix = hp.pixelfunc.nside2npix(Nside_out)
+        print(Nside_out, Npix)
+
+        # all bins rasterised in one pass
+        dist_inds = [min(dist_ind, Nbins-1) for dist_ind in bins]
+        print('Make sky maps at distances {}'.format(x[dist_inds]))
+        pixel_vals = samples.maps(dist_inds, Nside_out)
 
-    bins = [np.min(ind), np.max(ind)]
-    if ind2 is not None:
-        bins.append(np.min(ind2))
-        bins.append(np.max(ind2))
-
-    print(x[bins])
-    print(bins)
-    Nbins = len(best_fit[0,:])
-
-    Nside_max = np.max(pixel_info['nside'])
-    Npix = hp.pixelfunc.nside2npix(Nside_max)
     prev_map = np.zeros(Npix)
-    print(Nside_max, Npix)
-
     maps = []
-    for dist_ind in bins:
-        print('Bin number {}'.format(dist_ind))
-        print('Make sky map at distance {}'.format(x[dist_ind]))
-        if dist_ind == Nbins:
-            dist_ind = Nbins-1
-        pixel_val = construct_pixel_values(Nside_max, Npix, pix_ind, Nsides,\
-                    samples, dist_ind)
-
+    for pixel_val in pixel_vals:
         curr_map = pixel_val - prev_map
         maps.append(curr_map)
 
         prev_map = curr_map
-
-        #hp.mollview(pixel_val, nest=True)
-    #
     return(maps)
 
 def Analyse_maps(fileplanck, fileGreens, Nside_in=0):
@@ -186,10 +158,9 @@ def Analyse_maps(fileplanck, fileGreens, Nside_in=0):
     hp.mollview(np.log10(map857), title='Planck 857 GHz', unit='MJy/sr')
     plt.savefig('Figures/green_vs_planck/planck857_{}.png'.format(Nside_in))
 
-    mapGreens = np.nan_to_num(map_greens[1])
-    mapGreens = fix_resolution(mapGreens, Nside_in, 'NESTED')
-    #mapGreens = np.nan_to_num(mapGreens)
-    mapGreens_r = hp.pixelfunc.reorder(mapGreens, n2r=True)
+    # uncovered (NaN) pixels are left out of the mean, and 0 if all are
+    mapGreens_r = fix_resolution(map_greens[1], Nside_in, 'NESTED', 'RING',\
+                                 badval=0.)
     #smapGreens = smoothing(mapGreens_r, Nside_in)
     hp.mollview(mapGreens_r, title='Greens reddening full', unit='mag')
     plt.savefig('Figures/green_vs_planck/greens_{}.png'.format(Nside_in))
@@ -212,8 +183,9 @@ def Analyse_maps(fileplanck, fileGreens, Nside_in=0):
     #print(Greens_data)
     #plt.show()
 
-    maxlike_a_g, a_g_array = sampler(Planck_model, Greens_data, 10.)
-    print(maxlike_a_g, np.mean(a_g_array))
+    post = fit_scaling(Planck_model, Greens_data, 10.)
+    maxlike_a_g = post['map'][0,0]
+    print(maxlike_a_g, post['mean'][0,0])
     #ind2 = np.where(newmap==0)[0]
     new_model = model_function(maxlike_a_g, mapGreens_r)
     diff_map = newmap - new_model
@@ -226,124 +198,47 @@ def Analyse_maps(fileplanck, fileGreens, Nside_in=0):
 
     plt.show()
 
-def sampler(model, data, a_g0, Niter=1000):
+def fit_scaling(model, data, sigma=10.):
     """
-    Sampling routine to sample the convertion factor between Greens et.al 2019
-    reddening map to Planck maps. Assuming the relationsip
-    planck_map = a_g*greens_map + "some more".
+    Fit the convertion factor between Greens et.al 2019 reddening map to
+    Planck maps. Assuming the relationsip planck_map = a_g*greens_map, with
+    Gaussian likelihood and a positive Gaussian prior, the posterior of a_g is
+    evaluated on a grid from the sums over the pixels. Several Planck bands
+    and Greens distance slices are fitted at once, with the prior of each
+    band from the mean and standard deviation of that band.
 
     Parameters:
     -----------
-    - model, array_like.    Planck map
-    - data, array_like.     Greens et.al. 2019 map
-    a_g0, scalar.           the convertion factor between Greens and Planck.
+    - model, array_like.    Planck map, (Npix,) or (Nbands, Npix)
+    - data, array_like.     Greens et.al. 2019 map, (Npix,) or (Nslices, Npix)
+    - sigma, scalar.        The uncertainty of the Planck map.
 
     Return:
     -----------
+    - post, dict.           The posterior of a_g for each (band, slice), see
+                            scaling_fit.grid_posterior().
     """
+    t0 = time.time()
+    # prior per band, shaped (Nbands, 1, 1) to broadcast over the slices
+    # and the grid
+    bands = np.atleast_2d(model)
+    mean0 = np.mean(bands, axis=-1)[:,None,None]  # ??? how to define this one?
+    sigma0 = np.std(bands, axis=-1)[:,None,None]
+    print(mean0.ravel(), sigma0.ravel())
+
+    log_prior = partial(gaussian_log_prior, mu=mean0, sigma=sigma0)
+    post = grid_posterior(data, model, sigma, log_prior=log_prior,\
+                          prior_range=(np.clip(mean0 - 10*sigma0, 0, None)[...,0],\
+                                       (mean0 + 10*sigma0)[...,0]))
+    print('Posterior of a_g: mean {}, std {}, max {}, in {} ms'.\
+          format(post['mean'], post['std'], post['map'], (time.time()-t0)*1e3))
 
-    mean0 = np.mean(model)  # ??? how to define this one?
-    sigma0 = np.std(model)
-    print(mean0, sigma0)
-
-    accept = np.zeros(Niter)
-    params = np.zeros(Niter)
-
-    model_func = partial(model_function, data=data)
-    log_like = partial(logLikelihood, data=model)
-    log_prior = partial(logPrior, mu=mean0, sigma=sigma0)
-    print('----')
-    # initialize
-    curr_param = np.random.normal(mean0, sigma0) # > 0
-    while curr_param < 0:
-        curr_param = np.random.normal(mean0, sigma0)
-        print('-', curr_param)
-
-    curr_model = model_func(curr_param)
-    curr_like = log_like(curr_model)
-    curr_prior = log_prior(curr_param)
-    print(curr_param, curr_like, curr_prior)
-    cm1 = model_func(curr_param*2)
-    cm2 = model_func(curr_param*5)
-    cm3 = model_func(160.0)
-    print('-', curr_param*2, log_like(cm1))
-    print('-', curr_param*5, log_like(cm2))
-    print('-', curr_param*10, log_like(cm3))
-    #sys.exit()
-    # sampling:
-    counter = 0
-    steplength = 1.
-    maxlike = -10
-    mean = mean0
-    sigma = sigma0
-    maxlike_param = curr_param
-    print('-----')
-    for i in range(Niter):
-        prop_param = np.random.normal(mean, sigma*steplength)
-
-        # MetropolisHastings step
-        accept[i], params[i], maxlike, maxlike_param = mh_step(log_like,\
-                                            log_prior, model_func, prop_param,\
-                                            curr_param, curr_like, curr_prior,\
-                                            maxlike, maxlike_param)
-
-        #
-        curr_model_new = model_func(params[i])
-        curr_like = log_like(curr_model_new)
-        curr_prior = log_prior(params[i])
-        mean = params[i]
-        if i%100==0:
-            print(i, prop_param, maxlike, maxlike_param, curr_like, curr_prior)
-
-        if accept[i] == True:
-            counter += 1
-
-        if (i+1)/50==0:
-            if counter/float(i+1) < 0.2:
-                steplength /= 2.
-            elif counter/float(i+1) > 0.5:
-                steplength *= 2.
-            else:
-                pass
-        #
-        if (i+1)%1000==0:
-            sigma = np.std(params[:i])
-    #
-    print(counter, counter/float(Niter), maxlike)
-    plt.figure()
-    plt.hist(params, bins=30)
     plt.figure()
-    plt.plot(params)
-    return(maxlike_param, params)
-
-def mh_step(log_like, log_prior, model_func, prop_param, curr_param, curr_like,\
-            curr_prior, maxlike, maxlike_param):
-
-    #
-    prop_model = model_func(prop_param)
-    prop_like = log_like(prop_model)
-    prop_prior = log_prior(prop_param)
-
-    # posterior analysis
-    post_old = curr_like + curr_prior
-    post_new = prop_like + prop_prior
-
-    # acceptable testing:
-    a = np.exp(post_new - post_old)
-    draw = np.random.uniform(0,1)
-    #print('-', prop_param, curr_param, prop_like, a)
-    if (a > draw) and (a < np.inf):
-        accept = True
-        curr_param = prop_param
-        if prop_like > maxlike:
-            maxlike = prop_like
-            maxlike_param = curr_param
-
-    else:
-        accept = False
-        curr_param = curr_param
-    #
-    return(accept, curr_param, maxlike, maxlike_param)
+    for a, pdf in zip(post['a'].reshape(-1, post['a'].shape[-1]),\
+                      post['pdf'].reshape(-1, post['pdf'].shape[-1])):
+        plt.plot(a, pdf)
+    plt.xlabel(r'$a_g$')
+    return(post)
 
 def model_function(a_g, data, c=0.0):
     """
@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import healpy as hp
 import time
+
+import alm_cache
 ###########################
 """
 Program to plot thermal dust map from planck for different Nsides.
@@ -32,13 +34,15 @@ def fix_resolution(map, Nside_in=0):
         return(m)
 
     else:
+        # smooth from the alm of the finest map, transformed once
+        m_max = hp.pixelfunc.ud_grade(map, max(Nsides))
         for Ns in Nsides:
             t1 = time.time()
             print('Fix resolution to Nside={}'.format(Ns))
             m = hp.pixelfunc.ud_grade(map, Ns)
             maps.append(m)
 
-            smap = smoothing(m, Ns)
+            smap = smoothing(m_max, Ns, Nside_out=Ns, cached=True)
             smaps.append(smap)
 
             cl, el = power_spectrum(smap)
@@ -49,6 +53,7 @@ def fix_resolution(map, Nside_in=0):
             #tot_time = t2-t0
             print('Interation time: {}s, total time: {}s'.format((t2-t1), (t2-t0)))
         #
+        alm_cache.cache.clear()
 
     return(maps)
 
@@ -58,10 +63,11 @@ def power_spectrum(map):
     el = np.arange(len(cl))
     return(cl, el)
 
-def smoothing(map, Nside):
-
+def smoothing(map, Nside, Nside_out=None, cached=False):
+    # with cached the alm of map are kept, so other Nside and beams need no
+    # new map2alm
     FWHM = 2.5*64/(Nside)*(np.pi/180) # need radians!
-    smap = hp.sphtfunc.smoothing(map, fwhm=FWHM, iter=3)
+    smap = alm_cache.smoothing(map, FWHM, Nside_out, iter=3, cached=cached)
     return(smap)
 
 def plot_powspec(cl, el):
@@ -0,0 +1,185 @@
+"""
+Module for keeping the sparse smoothing kernels of the tomography maps on
+disk, so an analysis run again on the same star mask does not rebuild them.
+The kernels are stored as compressed .npz sparse matrices, keyed by a hash of
+the mask pixels, Nside, the smoothing resolution and the kernel type. An index
+file records the size and last use of each kernel and the hit/miss counts, and
+the least recently used kernels are removed when the store grows above
+max_bytes.
+
+Several runs may share the store. The index is re-read and merged under a
+file lock before it is written, files are written to per process temporary
+files and renamed in place, and kernel files missing from the index are
+counted from the directory, so the store stays below max_bytes.
+"""
+
+import numpy as np
+import hashlib
+import json
+import fcntl
+import glob
+import tempfile
+import os, time
+from contextlib import contextmanager
+from scipy import sparse
+
+##########################
+
+class KernelCache():
+    """
+    Disk store of sparse kernels.
+    Contain functions:
+    - key(), the key of a kernel
+    - get(), the stored kernel or None
+    - put(), store a kernel, evicting old ones if the store is too large
+    - stats(), hits, misses, number and size of the stored kernels
+    - clear()
+    Input:
+    - path, string. The directory of the store
+    - max_bytes, scalar. The largest total size of the stored kernels
+    """
+    def __init__(self, path='Data/kernel_cache/', max_bytes=2e9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(path, 'index.json')
+        self.lock_file = os.path.join(path, 'index.lock')
+        self.index = self._read_index()
+        # changes since the index was last written, merged in _save_index()
+        self._hits = 0
+        self._misses = 0
+        self._used = {}
+
+    @staticmethod
+    def key(mask, Nside, res, kind):
+        """
+        Input:
+        - mask, array. The pixels of the kernel rows, in order
+        - Nside, integer. The map resolution
+        - res, scalar. The smoothing FWHM in arcmin
+        - kind, string. The kernel type, e.g. 'gauss4.0'
+        """
+        h = hashlib.sha1(np.ascontiguousarray(mask, dtype=np.int64).tobytes())
+        return('{}_N{}_res{}_{}'.format(h.hexdigest()[:20], int(Nside),\
+                                        float(res), kind))
+
+    def _file(self, key):
+        return(os.path.join(self.path, key + '.npz'))
+
+    def _read_index(self):
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                return(json.load(f))
+        return({'hits': 0, 'misses': 0, 'entries': {}})
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_file, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write(self, file, write):
+        # write to a temporary file of this process, then rename in place
+        tmp = tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp',\
+                                          delete=False)
+        try:
+            with tmp:
+                write(tmp)
+            os.replace(tmp.name, file)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+
+    def _save_index(self, keep=None):
+        """
+        Merge the changes of this process into the index on disk, sync the
+        entries with the kernel files in the directory, evict if the store is
+        too large and write the index.
+        """
+        with self._lock():
+            index = self._read_index()
+            index['hits'] += self._hits
+            index['misses'] += self._misses
+            entries = index['entries']
+            for k, e in self._used.items():
+                if k in entries:
+                    e['last_used'] = max(e['last_used'], entries[k]['last_used'])
+                entries[k] = e
+            self._hits, self._misses, self._used = 0, 0, {}
+
+            on_disk = {os.path.basename(f)[:-4] for f in\
+                       glob.glob(os.path.join(self.path, '*.npz'))}
+            for k in set(entries) - on_disk:
+                del entries[k]
+            for k in on_disk - set(entries):
+                file = self._file(k)
+                entries[k] = {'bytes': os.path.getsize(file),\
+                              'last_used': os.path.getmtime(file)}
+            self.index = index
+            self._evict(keep)
+            self._write(self.index_file,\
+                        lambda f: f.write(json.dumps(index, indent=1).encode()))
+
+    def get(self, key):
+        file = self._file(key)
+        try:
+            kernel = sparse.load_npz(file).tocsr()
+        except (OSError, ValueError):
+            # not stored, or removed by another run
+            self._misses += 1
+            return(None)
+        self._hits += 1
+        self._used[key] = {'bytes': os.path.getsize(file),\
+                           'shape': list(kernel.shape),\
+                           'nnz': int(kernel.nnz),\
+                           'last_used': time.time()}
+        self._save_index()
+        return(kernel)
+
+    def put(self, key, kernel):
+        os.makedirs(self.path, exist_ok=True)
+        file = self._file(key)
+        kernel = sparse.csr_matrix(kernel)
+        self._write(file, lambda f: sparse.save_npz(f, kernel, compressed=True))
+        self._used[key] = {'bytes': os.path.getsize(file),\
+                           'shape': list(kernel.shape),\
+                           'nnz': int(kernel.nnz),\
+                           'last_used': time.time()}
+        self._save_index(keep=key)
+
+    def _evict(self, keep=None):
+        # remove the least recently used kernels until the store fits
+        entries = self.index['entries']
+        total = sum(e['bytes'] for e in entries.values())
+        for k in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            total -= entries[k]['bytes']
+            if os.path.isfile(self._file(k)):
+                os.remove(self._file(k))
+            del entries[k]
+            print('Removed smoothing kernel {} from the cache'.format(k))
+
+    def stats(self):
+        entries = self.index['entries']
+        hits = self.index['hits'] + self._hits
+        misses = self.index['misses'] + self._misses
+        N = hits + misses
+        return({'hits': hits, 'misses': misses,\
+                'hit_rate': hits/float(N) if N > 0 else None,\
+                'kernels': len(entries),\
+                'bytes': sum(e['bytes'] for e in entries.values())})
+
+    def clear(self):
+        with self._lock():
+            for file in glob.glob(os.path.join(self.path, '*.npz')):
+                os.remove(file)
+            self.index = {'hits': 0, 'misses': 0, 'entries': {}}
+            self._hits, self._misses, self._used = 0, 0, {}
+            self._write(self.index_file,\
+                        lambda f: f.write(json.dumps(self.index, indent=1).encode()))
@@ -12,8 +12,14 @@ import scipy.optimize as spo
 from astropy import units as u_
 from astropy.coordinates import SkyCoord
 
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
 import convert_units as cu
 import tools_mod as tools
+from nest_grade import ud_grade
 
 
 ######################################
@@ -85,7 +91,8 @@ def select_stars(l_in, b_in, lim=0.16):
     target_cond = stars.separation(target_center).deg < lim
     return(target_cond)
 
-def tomo_map(data, Nside=2048, starsel='all', part='all', distcut=360):
+def tomo_map(data, Nside=2048, starsel='all', part='all', distcut=360,\
+             greens_file=None):
     """
     Make healpix map for the given Nside for the tomography data
 
@@ -93,6 +100,8 @@ def tomo_map(data, Nside=2048, starsel='all', part='all', distcut=360):
     -----------
     - data, ndarray.    All of the data array.
     - Nside, integer.   The resolution of the map to make, default is 2048
+    - greens_file, string. If given, correct q, u for the extinction beyond
+                        the stars with this Green19 map.
 
     Return:
     -------
@@ -186,11 +195,15 @@ def tomo_map(data, Nside=2048, starsel='all', part='all', distcut=360):
                                           theta_gal, np.radians(data[:,5]))
 
     # correct for extinction:
-    #correction = tools.extinction_correction(l, b, data[:,10])
-    #q_gal = q_gal*correction
-    #u_gal = u_gal*correction
-    q_err = sq_gal#*correction
-    u_err = su_gal#*correction
+    if greens_file is not None:
+        l, b = tools.convert2galactic(data[:,0], data[:,1])
+        correction = tools.extinction_correction(l, b, data[:,10], greens_file)
+        q_gal = q_gal*correction
+        u_gal = u_gal*correction
+        sq_gal = sq_gal*correction
+        su_gal = su_gal*correction
+    q_err = sq_gal
+    u_err = su_gal
     
     psi = 0.5*np.arctan2(-u_gal, q_gal)
     
@@ -235,10 +248,11 @@ def tomo_map(data, Nside=2048, starsel='all', part='all', distcut=360):
     #sys.exit()
     return(p_map, q_map, u_map, [sigma_p,sigma_q,sigma_u,sigma_psi], r_map, pix)
 
-def pix2star_tomo(data, Nside, starsel='all'):
+def pix2star_tomo(data, Nside, starsel='all', greens_file=None):
     """
     Method where the pixels are asigned to a star. Remove stars closer 
-    than 360 pc, since not polarised.
+    than 360 pc, since not polarised. If greens_file is given, correct q, u
+    for the extinction beyond the stars with this Green19 map.
     """
     # Select stars
     if starsel == 'all':
@@ -294,14 +308,18 @@ def pix2star_tomo(data, Nside, starsel='all'):
                                           evpa, np.radians(data[:,5]))
     #print(len(q_gal), len(u_gal), len(evpa), '.')
     # correct for extinction:
-    #correction = tools.extinction_correction(l, b, data[:,10])
-    #q_gal = q_gal*correction
-    #u_gal = u_gal*correction
+    if greens_file is not None:
+        l, b = tools.convert2galactic(data[:,0], data[:,1])
+        correction = tools.extinction_correction(l, b, data[:,10], greens_file)
+        q_gal = q_gal*correction
+        u_gal = u_gal*correction
+        sq_gal = sq_gal*correction
+        su_gal = su_gal*correction
     j = np.where(u_gal == np.max(u_gal))[0]
     #print(j, u_gal[j], l[j], b[j], data[j,10], data[j,4])
     #print(np.mean(u_gal), np.mean(data[:,4]))
-    q_err = sq_gal#*correction
-    u_err = su_gal#*correction
+    q_err = sq_gal
+    u_err = su_gal
 
     #q_err = data[:,7]
     #u_err = data[:,9]
@@ -371,8 +389,8 @@ def C_ij(file, Nside):
     
     Nside_old = 2048
     C_ij_in = tools.Read_H5(file, 'C_ij')
-    C_ij_new = hp.ud_grade(C_ij_in, Nside, order_in='RING', order_out='RING',\
-                           power=2)
+    C_ij_new = ud_grade(C_ij_in, Nside, order_in='RING', order_out='RING',\
+                        power=2)
     
     return(C_ij_new)
 
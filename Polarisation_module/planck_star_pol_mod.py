@@ -300,9 +300,8 @@ def main_pl(starfile, planckfile=None, dustfile=None, Cij_file=None, \
         #
         # Need to include reddening on q and u. Do that in the making? Large std on dpsi
         # smooth fractional pol.
-        u_map = smooth.smooth_tomo_map(u_map, mask, Nside, 15)
-        q_map = smooth.smooth_tomo_map(q_map, mask, Nside, 15)
-        p_map = smooth.smooth_tomo_map(p_map, mask, Nside, 15)
+        smoother = smooth.TomoSmoother(mask, Nside, 15, cache=True)
+        u_map, q_map, p_map = smoother.smooth([u_map, q_map, p_map])
 
         dPsi = tools.delta_psi(Q[mask], q_map[mask], U[mask], u_map[mask],\
                                plot=False, name='test')
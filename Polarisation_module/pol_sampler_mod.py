@@ -7,13 +7,21 @@ import numpy as np
 import healpy as hp
 import tools_mod as tools
 import matplotlib.pyplot as plt
-import sys, time
+import sys, time, os
 from functools import partial
 
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
+import shared_arrays
+from shared_arrays import SharedArrays
+
 
 
 def QU_sampler(QU, qu, x_mean, x_err, mask, data_mean,\
-               Nside=256, Niter=1000, R_Pp=None):
+               Nside=256, Niter=1000, R_Pp=None, processes=None):
     """
     Input:
     - QU, 2d array of submm polarization (2, Npix)
@@ -21,6 +29,8 @@ def QU_sampler(QU, qu, x_mean, x_err, mask, data_mean,\
     - x_mean, seq. of mean parameters values to be fitted. 
                    (R_Pp, Qbkgr, Ubkgr)
     ...
+    - processes, integer. If given, sample the pixels over a process pool
+                   of this size, with the maps in shared memory.
     Return:
     QU stat and background. list of arrays
     """
@@ -69,35 +79,30 @@ def QU_sampler(QU, qu, x_mean, x_err, mask, data_mean,\
     plt.colorbar()
     """
     t0 = time.time()
-    for i, pix in enumerate(pixels[mask]):
-        t01 = time.time()
-        
-        # Initiate functions:
-        log_like = partial(logLike, data=QU[:,pix])
-        log_prior = partial(logPrior, mu=data_mean, sigma=x_err)
-        func = partial(QU_func, qu=qu[:,pix])
-        
-        # Initialize:
-        params0, model0, loglike0, logprior0 = Initialize(log_like,\
-                                                          log_prior,\
-                                                          func, x_mean,\
-                                                          cov0)
-
-        # Metropolis Hastrings:
-        params_maxL[:,pix], params[:,:,pix] = MH(log_like, log_prior,\
-                                                 func, params0, model0,\
-                                                 loglike0, logprior0,\
-                                                 x_mean, cov0, burnin, Niter)
-
-        #
-        print(QU[:,pix], QU_func(params_maxL[:,pix], qu[:,pix]))
-        #QU_model[:,pix] = QU_func(params_maxL[:,pix], qu[:,pix])
-        #QU_err[:,pix] = None
-        #print(np.mean(params[:,:,pix],axis=0), np.std(params[:,:,pix],axis=0))
-        t11 = time.time()
-        print('Sampling time for pixel {}: {} s'.format(pix, t11-t01))
-        print('-->')
-        #break
+    if processes is None:
+        for i, pix in enumerate(pixels[mask]):
+            t01 = time.time()
+            params_maxL[:,pix], params[:,:,pix] = sample_pixel(QU[:,pix],\
+                                                    qu[:,pix], x_mean, x_err,\
+                                                    data_mean, cov0, burnin,\
+                                                    Niter)
+            print(QU[:,pix], QU_func(params_maxL[:,pix], qu[:,pix]))
+            t11 = time.time()
+            print('Sampling time for pixel {}: {} s'.format(pix, t11-t01))
+            print('-->')
+    else:
+        # the pixels are sampled by pool workers reading QU and qu from
+        # shared memory
+        tasks = [(pix, x_mean, x_err, data_mean, cov0, burnin, Niter)\
+                 for pix in pixels[mask]]
+        with SharedArrays() as shared:
+            shared.publish('QU', QU)
+            shared.publish('qu', qu)
+            with shared.pool(processes) as pool:
+                out = pool.map(_sample_shared_pixel, tasks)
+        for task, (p_maxL, p) in zip(tasks, out):
+            params_maxL[:,task[0]] = p_maxL
+            params[:,:,task[0]] = p
     #
     t2 = time.time()
     print('Total sampling time: {} s'.format(t2-t0))
@@ -153,6 +158,37 @@ def QU_sampler(QU, qu, x_mean, x_err, mask, data_mean,\
     #"""
     return None
 
+def sample_pixel(QU_pix, qu_pix, x_mean, x_err, data_mean, cov0, burnin,\
+                 Niter):
+    """
+    Sample the parameters of one pixel with Metropolis Hastings.
+    Return:
+    - params_maxL, array. The maximum likelihood parameters
+    - params, array. (Niter, Nparams) the chain
+    """
+    # Initiate functions:
+    log_like = partial(logLike, data=QU_pix)
+    log_prior = partial(logPrior, mu=data_mean, sigma=x_err)
+    func = partial(QU_func, qu=qu_pix)
+
+    # Initialize:
+    params0, model0, loglike0, logprior0 = Initialize(log_like, log_prior,\
+                                                      func, x_mean, cov0)
+
+    # Metropolis Hastrings:
+    return(MH(log_like, log_prior, func, params0, model0, loglike0,\
+              logprior0, x_mean, cov0, burnin, Niter))
+
+def _sample_shared_pixel(args):
+    """
+    Pool task, sample one pixel of the shared QU and qu maps.
+    """
+    pix, x_mean, x_err, data_mean, cov0, burnin, Niter = args
+    QU = shared_arrays.get('QU')
+    qu = shared_arrays.get('qu')
+    return(sample_pixel(QU[:,pix], qu[:,pix], x_mean, x_err, data_mean,\
+                        cov0, burnin, Niter))
+
 def Initialize(log_like, log_prior, model_func, mean, cov):
     """
     Initialization of the parameters and functions.
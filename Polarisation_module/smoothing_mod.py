@@ -8,30 +8,124 @@ import matplotlib.pyplot as plt
 import h5py
 import sys, time, glob, os
 import scipy.optimize as spo
+from scipy import sparse
+from scipy.spatial import cKDTree
 
 from astropy import units as u_
 from astropy.coordinates import SkyCoord
 
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
 import convert_units as cu
 import tools_mod as tools
+import alm_cache
+from nest_grade import ud_grade
+from kernel_cache import KernelCache
 
 ##################################################
 
-def smoothing(map, Nside, iter=3, res=15):
+def smoothing(map, Nside, iter=3, res=15, Nside_out=None, cached=False):
     """
-    Function to smooth a map to 15 arcseconds.
+    Function to smooth a map to 15 arcseconds. With cached the alm of the map
+    are kept, so smoothing it again to another resolution or Nside only needs
+    the inverse transform.
     Parameters:
     -----------
     - map, array.       The map to smooth
     - Nside, integer.   The resolution of the map.
     - iter, integer.    The number of iterations the smoothing does. default = 3
+    - Nside_out, integer. The resolution of the smoothed map, default Nside.
+    - cached, bool.     Keep the alm in alm_cache.cache, default False. Clear
+                        the cache when done with the map.
     Return:
     - smap, array.      The smoothed map
     """
     FWHM = (np.sqrt(float(res)**2 - 5.**2)/60.) * (np.pi/180) # 15 arcmin
-    smap = hp.sphtfunc.smoothing(map, fwhm=FWHM, iter=iter)
+    smap = alm_cache.smoothing(map, FWHM, Nside_out, iter=iter, cached=cached)
     return(smap)
 
+class TomoSmoother():
+    """
+    Real space Gaussian smoothing of maps known only in the pixels of mask,
+    as the tomography maps. The neighbours within nsigma standard deviations
+    of each mask pixel are found with a KD-tree on the unit vectors, with the
+    true angular distance, and the row normalised Gaussian weights are stored
+    as a sparse (Nmask, Nmask) kernel. The kernel is built once and applied to
+    any number of maps in one sparse matrix product.
+    Contain functions:
+    - smooth(), smooth one or several maps
+    Input:
+    - mask, array.      The pixels with data, in RING ordering. Repeated
+                        pixels, one per star, are allowed.
+    - Nside, integer.   The resolution of the maps. default is 2048
+    - res, scalar.      The FWHM of the smoothing in arcmin. default is 15
+    - nsigma, scalar.   Neighbours further away than nsigma standard
+                        deviations are left out, weight < exp(-nsigma^2/2).
+    - cache, KernelCache/bool. Disk store of kernels, the kernel is read from
+                        it if built before for the same mask, Nside, res and
+                        nsigma. True uses the store in 'Data/kernel_cache/',
+                        relative to the working directory. Default is False,
+                        always build the kernel.
+    """
+    def __init__(self, mask, Nside=2048, res=15, nsigma=4., cache=False):
+        t0 = time.time()
+        self.mask = np.asarray(mask, dtype=np.int64)
+        self.Nside = Nside
+        self.Npix = hp.nside2npix(Nside)
+        if cache is True:
+            cache = KernelCache()
+        key = None
+        if cache:
+            key = cache.key(self.mask, Nside, res, 'gauss{}'.format(float(nsigma)))
+            self.kernel = cache.get(key)
+            if self.kernel is not None:
+                print('Smoothing kernel read from cache in {} s, {}'.\
+                      format(time.time()-t0, cache.stats()))
+                return
+
+        s = (float(res)/60.)*(np.pi/180.)/np.sqrt(8.*np.log(2.))
+        vec = np.array(hp.pix2vec(Nside, self.mask)).T
+        tree = cKDTree(vec)
+        chord = 2*np.sin(min(nsigma*s, np.pi)/2.)
+        D = tree.sparse_distance_matrix(tree, chord, output_type='coo_matrix')
+        # chord to angular distance, pixels at the same position get weight 1
+        r = 2*np.arcsin(np.clip(D.data/2., 0, 1))
+        K = sparse.csr_matrix((np.exp(-0.5*(r/s)**2), (D.row, D.col)),\
+                              shape=(len(self.mask), len(self.mask)))
+        norm = np.asarray(K.sum(axis=1)).ravel()
+        self.kernel = (sparse.diags(1./norm) @ K).tocsr()
+        print('Smoothing kernel of {} pixels, {} weights, built in {} s'.\
+              format(len(self.mask), self.kernel.nnz, time.time()-t0))
+        if key is not None:
+            cache.put(key, self.kernel)
+
+    def smooth(self, maps):
+        """
+        Smooth maps with the kernel.
+        Input:
+        - maps, array/list. One map or a list of maps, each of length Npix or
+                            of length Nmask (the values in the mask pixels)
+        Return:
+        - smaps, array/list. The smoothed maps of length Npix, 0 outside mask
+        """
+        single = np.ndim(maps[0]) == 0
+        if single:
+            maps = [maps]
+        X = np.array([m if len(m) == len(self.mask) else np.asarray(m)[self.mask]\
+                      for m in maps]).T
+        Y = self.kernel @ X
+        smaps = []
+        for i in range(Y.shape[1]):
+            smap = np.zeros(self.Npix)
+            smap[self.mask] = Y[:,i]
+            smaps.append(smap)
+        if single:
+            return(smaps[0])
+        return(smaps)
+
 def smooth_tomo_map(in_map, mask, Nside=2048, res=15):
     """
     Smooth the tomography maps using realspace smoothing.
@@ -41,49 +135,18 @@ def smooth_tomo_map(in_map, mask, Nside=2048, res=15):
     - in_map, array.    The tomography map to be smoothed in real space. Have
                         the same length as mask
     - mask, array.      The unique pixels in the tomography map.
-    - l, array.         longitude angles in degrees, same length as mask
-    - b, array.         latitude angles in degrees, same length as mask
     - Nside, integer.   The resolution of the map. default is 2048
+    - res, scalar.      The smoothing FWHM in arcmin. default is 15
 
     Return:
     -----------
     - smap. array.      The smoothed map with length Npix
+
+    For several maps on the same mask, use TomoSmoother(mask).smooth(maps).
     """
-    Npix = hp.nside2npix(Nside)
-    N_map = np.zeros(Npix)
-    smap = np.zeros(Npix)
-
-    b, l = hp.pix2ang(Nside, mask)
-    #print((l)*180./np.pi, 90-(b)*180./np.pi)
-    #sys.exit()
-    phi = l
-    theta = np.pi/2. - b
-    #print(phi*180/np.pi)
-    s = (float(res)/60.)*(np.pi/180.)/np.sqrt(8.*np.log(2.))
-    #print(s)
-    #print(mask)
-    for p in mask:
-
-        # smoothing:
-        #print(phi*180/np.pi)
-        r = dist2neighbours(p, phi, theta, Nside)
-        #print(r)
-        #print(in_map[p])
-        if len(in_map) == len(mask):
-            I1 = np.sum(in_map * np.exp(-0.5*(r/s)**2))
-        else:
-            I1 = np.sum(in_map[mask] * np.exp(-0.5*(r/s)**2))
-        I2 = np.sum(np.exp(-0.5*(r/s)**2))
-
-        smap[p] = I1/I2
-        #print(I1, I2, smap[p])
-        #sys.exit()
-    #
-    #print(smap[mask])
-    #sys.exit()
-    return(smap)
+    return(TomoSmoother(mask, Nside, res).smooth(in_map))
 
-def smooth_maps(maps, Nside, iterations=3, res=15):
+def smooth_maps(maps, Nside, iterations=3, res=15, Nside_out=None):
     """
     Smooth a list of maps.
 
@@ -92,6 +155,8 @@ def smooth_maps(maps, Nside, iterations=3, res=15):
     - maps, list.           A list of maps to be smoothed.
     - Nside, integer.       The resolution of the maps.
     - iterations, integer.  The number of iterations the smoothing happens.
+    - Nside_out, integer.   The resolution of the smoothed maps, synthesised
+                            directly from the alm. Default is Nside.
 
     Return:
     -----------
@@ -103,7 +168,8 @@ def smooth_maps(maps, Nside, iterations=3, res=15):
     for i in range(len(maps)):
         t1 = time.time()
         print('Smooth map {}'.format(i))
-        m = smoothing(maps[i], Nside, iter=iterations, res=res)
+        m = smoothing(maps[i], Nside, iter=iterations, res=res,\
+                      Nside_out=Nside_out)
         out_maps.append(m)
         t2 = time.time()
         print('smoothing time map {}: {}s'.format(i, t2-t1))
@@ -112,6 +178,31 @@ def smooth_maps(maps, Nside, iterations=3, res=15):
     print('Total smoothing time: {}'.format(t3-t0))
     return(out_maps)
 
+def smooth_IQU(maps, Nside, iterations=3, res=15, Nside_out=None):
+    """
+    Smooth I, Q and U maps together, with one polarised transform where Q, U
+    are spin-2 fields, instead of three scalar transforms. healpy runs the
+    transforms with OpenMP threads, set by OMP_NUM_THREADS.
+
+    Parameters:
+    -----------
+    - maps, array.          The I, Q, U maps, (3, Npix) in RING ordering.
+    - Nside, integer.       The resolution of the maps.
+    - iterations, integer.  The number of iterations the smoothing happens.
+    - res, scalar.          The smoothing resolution in arcmin.
+    - Nside_out, integer.   The resolution of the smoothed maps, default Nside.
+
+    Return:
+    -----------
+    - smaps, array.         The smoothed I, Q, U maps, (3, Npix).
+    """
+    t0 = time.time()
+    FWHM = (np.sqrt(float(res)**2 - 5.**2)/60.) * (np.pi/180)
+    smaps = alm_cache.smoothing(np.asarray(maps)[:3], FWHM, Nside_out,\
+                                iter=iterations, pol=True)
+    print('IQU smoothing time: {}s'.format(time.time()-t0))
+    return(smaps)
+
 def Write_smooth_map(maps, name, Nside=2048, res=15, iterations=3):
     """
     Write a smoothed map to file, using only the tomography pixels
@@ -128,9 +219,8 @@ def Write_smooth_map(maps, name, Nside=2048, res=15, iterations=3):
     """
     print(len(maps))
     if len(maps) == 4:
-        smap = smooth_maps(maps, Nside, iterations, res=res)
-        pl_maps = smap[0:3]
-        dust_map = smap[-1]
+        pl_maps = smooth_IQU(maps[0:3], Nside, iterations, res=res)
+        dust_map = smoothing(maps[-1], Nside, iter=iterations, res=res)
 
         print('Writing planck maps:')
         #hp.fitsfunc.write_map('Data/{}_Nside{}_smoothed{}arcmin.fits'.\
@@ -346,11 +436,14 @@ def Read_H5(filename, name, shape):
         return(maps)
 
 
-def smooth(file, Nside=256, res=15, band=353):
+def smooth(file, Nside=256, res=15, band=353, cov=False):
     """
     Smooth a map from fits file to a given resolution, 
     degrade to given Nside = 256 (default), 
     write new map to h5 file. unit 217: Kcmb, unit 143: Kcmb
+    The I, Q, U maps are smoothed with one polarised transform. If cov, the
+    covariance maps C_II, C_QI, C_UI, C_QQ, C_QU, C_UU (fields 4 to 9) are
+    smoothed, degraded with power 2 and written to a 'C_ij' file, in uK^2.
     """
     
     maps, hdr = hp.fitsfunc.read_map(file, field=None, h=True)
@@ -359,10 +452,9 @@ def smooth(file, Nside=256, res=15, band=353):
     Ns_map_in = hp.get_nside(maps[0])
     print(Ns_map_in)
     # smooth the map:
-    #if len(map[:,0]) <= 3:
-    smaps = smooth_maps(maps, Ns_map_in)
-    #else:
-    #    smaps = smooth_maps(maps[:3,:], Ns_map_in)
+    smaps = smooth_IQU(maps[:3], Ns_map_in, res=res)
+    if cov:
+        C_ij = smooth_maps(maps[4:10], Ns_map_in, res=res)
     # degrade to given Nside:
     if Nside == Ns_map_in:
         new_maps = smaps
@@ -372,8 +464,9 @@ def smooth(file, Nside=256, res=15, band=353):
     print(np.shape(new_maps))
     # Write map to h5 file:
     write_H5(new_maps*1e6, 'IQU', Nside, res=res, band=band)
-    
-    pass
+    if cov:
+        C_ij = ud_grade(C_ij, Nside, order_in='RING', order_out='RING', power=2)
+        write_H5(C_ij*1e12, 'C_ij', Nside, res=res, band=band)
 
 """
 f3 = '/mn/stornext/u3/hke/bratli/comm_polfrac_353delta.fits'
@@ -387,6 +480,5 @@ f2 = 'Data/HFI_SkyMap_143-field-IQU_2048_R3.00_full.fits'
 #smooth(f3, Nside=256, res=15, band='353comm') # p_s, q_s, u_s
 #smooth(f4, Nside=256, res=15, band='gnilc')   # p_s, q_s, u_s
 #smooth(f5, Nside=256, res=15, band='353npipe')# IQU, Kcmb
-smooth(f6, Nside=256, res=15, band='353Sroll')# IQU+Cij, Kcmb, Kcmb^2. 
-#Need to fix Cij here, wrong power Cij*(Ns_in/Ns_out)^2
+smooth(f6, Nside=256, res=15, band='353Sroll', cov=True)# IQU+Cij, Kcmb, Kcmb^2. 
 #"""
@@ -95,9 +95,9 @@ def main(planckfile, dustfile, tomofile, colnames, names, pol, res,\
         u_map = -u_map # to Healpix convention
         mask = np.unique(pix)
         print(len(mask))
-        u_smap = smooth.smooth_tomo_map(u_map, mask, Nside, res)
-        q_smap = smooth.smooth_tomo_map(q_map, mask, Nside, res)
-        p_smap = smooth.smooth_tomo_map(p_map, mask, Nside, res)
+        # one smoothing kernel for the three maps, kept on disk for later runs
+        smoother = smooth.TomoSmoother(mask, Nside, res, cache=True)
+        u_smap, q_smap, p_smap = smoother.smooth([u_map, q_map, p_map])
         print('Tomography maps smoothed')
         print(np.mean(q_smap[mask]), np.mean(dust_smap[mask]), np.mean(Q_smap[mask]))
         dPsi = np.full(len(u_map), hp.UNSEEN)
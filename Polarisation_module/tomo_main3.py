@@ -70,9 +70,8 @@ def main(planckfile, dustfile, tomofile, colnames, names, pol, res,\
     Us = U_smap[mask]
     dust = dust_smap[mask]
     # modify the smoothing
-    u_smap = smooth.smooth_tomo_map(u, mask, Nside, res)
-    q_smap = smooth.smooth_tomo_map(q, mask, Nside, res)
-    p_smap = smooth.smooth_tomo_map(p, mask, Nside, res)
+    smoother = smooth.TomoSmoother(mask, Nside, res, cache=True)
+    u_smap, q_smap, p_smap = smoother.smooth([u, q, p])
     u = u_smap[mask]
     q = q_smap[mask]
     p = p_smap[mask]
@@ -13,7 +13,14 @@ import scipy.integrate as integrate
 from astropy import units as u_
 from astropy.coordinates import SkyCoord
 
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
 import convert_units as cu
+import gal_coord as gal
+from green19 import GreenMap, mu_bins
 
 
 
@@ -21,7 +28,8 @@ import convert_units as cu
 
 def convert2galactic(ra, dec):
     """
-    Function to convert coordinates into galactic coordinates
+    Function to convert coordinates into galactic coordinates. The result is
+    cached, so the same catalogue columns are only transformed once.
 
     Parameters:
     -----------
@@ -34,12 +42,7 @@ def convert2galactic(ra, dec):
     - lon, array. The longitude galactic coordinates
     - lat, array. The latitude galactic coordinates
     """
-    coord = SkyCoord(ra=ra*u_.deg, dec=dec*u_.deg, frame='icrs')
-    coord_gal = coord.galactic
-
-    lon = coord_gal.l.value
-    lat = coord_gal.b.value
-
+    lon, lat = gal.galactic_columns(ra, dec)
     return(lon, lat)
 
 def get_theta_gal(ra, dec, polang, aG=122.93200023, dG=27.12843):
@@ -104,7 +107,7 @@ def rotate_pol(ra, dec, p, q, u, polang):
     - u_gal, array.         The u polarisation in galactic coord.
     """
 
-    l, b = convert2galactic(ra, dec)
+    l, b, theta_gal, diff = gal.eq2gal_polangle(ra, dec, polang)
     #"""
     # use astropy for this: Vincent use this!
     ag = 192.86948 # wiki
@@ -112,10 +115,9 @@ def rotate_pol(ra, dec, p, q, u, polang):
     theta_gal1, diff1 = get_theta_gal(ra, dec, polang, aG=ag, dG=dg) # 1.
     print('-----')
 
-    # method of RoboPol: (Raphael) I use this!
-    ln = 122.93200023  # vincent
-    bn = 27.12843      # vincent
-    theta_gal, diff = get_theta_gal(l, b, polang, aG=ln, dG=bn) # 2. best corr
+    # method of RoboPol: (Raphael) I use this! theta_gal and diff are from
+    # eq2gal_polangle above, with the north celestial pole at l=122.932,
+    # b=27.128 as in get_theta_gal(l, b, polang, aG=ln, dG=bn).
 
     print('----')
     q_gal_raf = p*np.cos(2.*theta_gal)
@@ -386,39 +388,34 @@ def sample_QU_err(p, I, x, e_p, e_I, e_x):
                   + (2*p*I*e_x*np.cos(2*x))**2)
     return(e_Q, e_U)
 
-def extinction_correction(l, b, dist):
+def extinction_correction(l, b, dist, file='Data/bayestar2019.h5', d_ref=None):
     """
-    Correction for extinction, using extinction data from Green19
-    Work in galactic coordinated.
-    """
-    N = len(l)
-    correction = np.zeros(N)
-    
-    # Get extinction data
-    file1 = np.load('Data/Av_los_RoboPol.npz')
-    
-    x = (file1['r'])
-    ind = np.where(x > 360)[0]
-    x = x[ind]
-    lat = file1['b'][ind]
-    lon = file1['l'][ind]
-    Av = file1['Av'][:,ind]
-    Av_err = file1['err'][:,ind]
-
-    r_pol = np.sqrt(l**2 + b**2)
-    r_Av = np.sqrt(lon**2 + lat**2)
-    
-    for i, r in enumerate(r_pol):
-        temp1 = np.sqrt((r - r_Av)**2)
-        temp2 = np.abs(dist[i] - x)
+    Correction for extinction, using extinction data from Green19, the ratio
+    of the reddening to the reference distance and to the star. Work in
+    galactic coordinated.
+
+    Parameters:
+    -----------
+    - l, b, arrays.     Galactic coordinates of the stars in degrees.
+    - dist, array.      Distance to the stars in pc.
+    - file, string.     The Green19 map.
+    - d_ref, scalar.    The reference distance in pc, default is the farthest
+                        distance bin, 63 kpc.
 
-        ind1 = np.where(temp1 == np.min(temp1))[0]
-        ind2 = np.where(temp2 == np.min(temp2))[0]
+    Return:
+    -----------
+    - correction, array. E(B-V)(d_ref)/E(B-V)(dist), 1 where not defined.
+    """
+    if d_ref is None:
+        d_ref = 10**((mu_bins[-1] + 5)/5.)
+    with GreenMap(file) as greens:
+        E_star = greens.query(l, b, dist)
+        E_ref = greens.query(l, b, d_ref)
 
-        correction[i] = Av[ind1,-1]/Av[ind1,ind2]
-    #
+    correction = np.ones(len(E_star))
+    ok = E_star > 0
+    correction[ok] = E_ref[ok]/E_star[ok]
     return(correction)
-        
 
 def sigma(s_in, N):
     """
@@ -5,22 +5,32 @@ The main program for sampling and fitting models to the planck data.
 import numpy as np
 import healpy as hp
 import matplotlib.pyplot as plt
-import sys, time
+import sys, time, os
 #import h5py
 from functools import partial
 import convert_units as cu
 
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
+
 # import the modules
 from comp_intensity_mod import Model
-from metropolis_mod import Initialize, MetropolisHastings
+from metropolis_mod import Initialize, MetropolisHastings, sample_pixel,\
+                           sample_shared_pixel
+from shared_arrays import SharedArrays
 from stat_mod import logLikelihood, logPrior, Cov
 import planck_map_mod as planck
 import result_mod as res
 
-def main(Nside, Gibbs_steps, pfiles, nu, mean, err, data_mean):
+def main(Nside, Gibbs_steps, pfiles, nu, mean, err, data_mean, processes=None):
     """
     Main function to run sampling module. First load data, initial guess values,
-    Run Gibbs sampling with MH, print and plot results
+    Run Gibbs sampling with MH, print and plot results. If processes is
+    given, the pixels of each Gibbs step are sampled over a process pool, with
+    the data in shared memory.
     """
     Npix = hp.nside2npix(Nside)
     t0 = time.time()
@@ -57,88 +67,91 @@ def main(Nside, Gibbs_steps, pfiles, nu, mean, err, data_mean):
     # arrays to store values:
     params_array = np.zeros((Gibbs_steps, Npix, len(mean)))
     maxL_params_list = np.zeros((Gibbs_steps, len(mean)))
-    for i in range(Gibbs_steps):
-        #print(' ')
-        print('-- Gibbs step: {} --'.format(i))
-        t2 = time.time()
-        print('Calculate "T, beta_d, A_cmb, A_s, beta_s", given "b"')
-        for pix in range(len(data[0,:])):
-            ii = np.where(data[:,pix] < -1e4)[0]
-            if len(ii) > 0:
-                print(ii, data[:,pix])
-                continue
-            # set up input functions
-            log_like = partial(logLikelihood, data=data[:,pix])
+    # the pool and shared memory are released also if a step fails
+    shared, pool = None, None
+    try:
+        # publish the data once to the pool workers:
+        if processes is not None:
+            shared = SharedArrays()
+            shared.publish('data', data)
+            pool = shared.pool(processes)
+
+        for i in range(Gibbs_steps):
+            #print(' ')
+            print('-- Gibbs step: {} --'.format(i))
+            t2 = time.time()
+            print('Calculate "T, beta_d, A_cmb, A_s, beta_s", given "b"')
             log_prior = partial(logPrior, mu=data_mean[1:], sigma=data_err[1:])
             Model_func = partial(Model, b=mean_b)
-
-            # Initialize the parameters, model, etc.
+            if processes is None:
+                for pix in range(len(data[0,:])):
+                    ii = np.where(data[:,pix] < -1e4)[0]
+                    if len(ii) > 0:
+                        print(ii, data[:,pix])
+                        continue
+                    # sample parameters:
+                    params, par_maxL = sample_pixel(nu, data[:,pix], log_prior,\
+                                                    Model_func, sigma, x1_mean,\
+                                                    cov0, mean_b)
+                    params_array[i, pix, 1:] = params
+            else:
+                # sample the pixels in the pool, the data is in shared memory
+                good = np.where(np.all(data >= -1e4, axis=0))[0]
+                tasks = [(pix, nu, log_prior, Model_func, sigma, x1_mean, cov0,\
+                          mean_b) for pix in good]
+                for pix, (params, par_maxL) in zip(good,\
+                                        pool.map(sample_shared_pixel, tasks)):
+                    params_array[i, pix, 1:] = params
+            # end pixel loop
+            #print(params)
+            maxL_params_list[i, 1:] = par_maxL
+            x1_mean = par_maxL + np.random.normal(np.zeros(len(par_maxL)),\
+                                                    np.fabs(par_maxL)/30.)
+            print('Calculate "b" given "T, beta_d, A_cmb, A_s, beta_s"')
+            print(params_array[i,:,1:])
+
+            # set up new input functions
+            log_like = partial(logLikelihood, data=np.mean(data, axis=1)) #       ??
+            log_prior = partial(logPrior, mu=data_mean[:1], sigma=data_err[:1])
+            Model_func = partial(Model, T=params[0], beta_d=params[1],\
+                                A_cmb=params[2], A_s=params[3], beta_s=params[4])
+
+            # Initialize:
             params0, model0, loglike0, logprior0 = Initialize(nu, log_like,\
                                                         log_prior, Model_func,\
-                                                        x1_mean, cov0, mean_b)
-            # test initial values, if init log like is less than -1e4, make new
-            # initial values. because bad parameters.
-            ll0 = loglike0
+                                                        mean_b, cov_b0, x1_mean)
+            # test initial values:
             c = 0
             while loglike0 < -1e4:
-                #print('hei', pix)
                 c += 1
                 params0, model0, loglike0, logprior0 = Initialize(nu, log_like,\
-                                                        log_prior, Model_func,\
-                                                        x1_mean, cov0, mean_b)
-                if c == 10:
+                                                            log_prior, Model_func,\
+                                                            mean_b, cov_b0, x1_mean)
+                if c > 10:
                     break
                 #
-            # sample parameters:
-            params, par_maxL = MetropolisHastings(nu, log_like, log_prior,\
-                                        Model_func, sigma, params0, model0,\
-                                        loglike0, logprior0, x1_mean, cov0,\
-                                        len(x1_mean), mean_b)
-            params_array[i, pix, 1:] = params
-        # end pixel loop
-        #print(params)
-        maxL_params_list[i, 1:] = par_maxL
-        x1_mean = par_maxL + np.random.normal(np.zeros(len(par_maxL)),\
-                                                np.fabs(par_maxL)/30.)
-        print('Calculate "b" given "T, beta_d, A_cmb, A_s, beta_s"')
-        print(params_array[i,:,1:])
-
-        # set up new input functions
-        log_like = partial(logLikelihood, data=np.mean(data, axis=1)) #       ??
-        log_prior = partial(logPrior, mu=data_mean[:1], sigma=data_err[:1])
-        Model_func = partial(Model, T=params[0], beta_d=params[1],\
-                            A_cmb=params[2], A_s=params[3], beta_s=params[4])
-
-        # Initialize:
-        params0, model0, loglike0, logprior0 = Initialize(nu, log_like,\
-                                                    log_prior, Model_func,\
-                                                    mean_b, cov_b0, x1_mean)
-        # test initial values:
-        c = 0
-        while loglike0 < -1e4:
-            c += 1
-            params0, model0, loglike0, logprior0 = Initialize(nu, log_like,\
-                                                        log_prior, Model_func,\
-                                                        mean_b, cov_b0, x1_mean)
-            if c > 10:
-                break
-            #
-        # Sample b
-        b, maxL_b = MetropolisHastings(nu, log_like, log_prior, Model_func,\
-                                sigma, params0, model0, loglike0, logprior0,\
-                                mean_b, cov_b0, len(mean_b), params)
-        params_array[i,:,0] = b
-        mean_b = maxL_b + np.random.normal(0, 0.25)
-        maxL_params_list[i, 0] = maxL_b
-
-        # update the covariace matrix for each 10th Gibbs step.
-        #if (i+1)%10 == 0:
-        #    cov = np.cov(maxL_params_list[:i, 1:].T)
-        #    cov_b = np.std(maxL_params_list[:i, 0])
-        #    print(cov, cov_b)
-        t3 = time.time()
-        print('Gibbs sample iteration time: {}s'.format(t3-t2))
-    # end Gibbs loop
+            # Sample b
+            b, maxL_b = MetropolisHastings(nu, log_like, log_prior, Model_func,\
+                                    sigma, params0, model0, loglike0, logprior0,\
+                                    mean_b, cov_b0, len(mean_b), params)
+            params_array[i,:,0] = b
+            mean_b = maxL_b + np.random.normal(0, 0.25)
+            maxL_params_list[i, 0] = maxL_b
+
+            # update the covariace matrix for each 10th Gibbs step.
+            #if (i+1)%10 == 0:
+            #    cov = np.cov(maxL_params_list[:i, 1:].T)
+            #    cov_b = np.std(maxL_params_list[:i, 0])
+            #    print(cov, cov_b)
+            t3 = time.time()
+            print('Gibbs sample iteration time: {}s'.format(t3-t2))
+        # end Gibbs loop
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if shared is not None:
+            shared.close()
     t4 = time.time()
     print('*** Sampling time: {}s, {}min'.format(t4-t1, (t4-t1)/60.))
 
@@ -6,8 +6,17 @@ Initialization function.
 import numpy as np
 #import healpy as hp
 #import matplotlib.pyplot as plt
-import sys, time
+import sys, time, os
 #import h5py
+from functools import partial
+
+# the shared helper modules (shared_arrays, gal_coord, green19, nest_grade,
+# alm_cache) are in the repository root
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if _root not in sys.path:
+    sys.path.append(_root)
+from stat_mod import logLikelihood
+import shared_arrays
 np.random.seed(249)
 
 def Initialize(nu, log_like, log_prior, Model_func, mean, cov, const):
@@ -245,3 +254,49 @@ def proposal_rule(cov, mean=None):
     else:
         params = np.random.normal(mean, cov)
     return(params)
+
+def sample_pixel(nu, data_pix, log_prior, Model_func, sigma, mean, cov, const):
+    """
+    Initialize and sample the parameters of one pixel. If the initial log
+    likelihood is less than -1e4, new initial values are drawn, at most 10
+    times.
+
+    Parameters:
+    -----------
+    - nu, array.            The frequencies
+    - data_pix, array.      The data of the pixel at each frequency
+    - log_prior, function.  As Initialize()
+    - Model_func, function. As Initialize()
+    - sigma, scalar.        The noise of the data
+    - mean, array.          The mean of the parameters to sample
+    - cov, array.           The covariance of the parameters
+    - const, array.         The constant parameters
+
+    Return:
+    -----------
+    - params, par_maxL. As MetropolisHastings()
+    """
+    log_like = partial(logLikelihood, data=data_pix)
+    params0, model0, loglike0, logprior0 = Initialize(nu, log_like, log_prior,\
+                                                      Model_func, mean, cov,\
+                                                      const)
+    c = 0
+    while loglike0 < -1e4:
+        c += 1
+        params0, model0, loglike0, logprior0 = Initialize(nu, log_like,\
+                                                    log_prior, Model_func,\
+                                                    mean, cov, const)
+        if c == 10:
+            break
+    return(MetropolisHastings(nu, log_like, log_prior, Model_func, sigma,\
+                              params0, model0, loglike0, logprior0, mean, cov,\
+                              len(mean), const))
+
+def sample_shared_pixel(args):
+    """
+    Pool task, sample_pixel() for one pixel of the shared 'data' array of
+    shape (Nfreq, Npix).
+    """
+    pix = args[0]
+    data = shared_arrays.get('data')
+    return(sample_pixel(args[1], data[:,pix], *args[2:]))
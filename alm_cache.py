@@ -0,0 +1,121 @@
+"""
+Module for caching the spherical harmonic coefficients (alm) of maps, so a
+map smoothed with several beams or written out at several Nside is transformed
+to harmonic space once. The alm are kept in an LRU cache keyed by a hash of
+the map content, lmax, the number of iterations and whether the transform is
+polarised. A new beam or output Nside then costs only the inverse transform.
+
+The alm of a large map are large (about 300 MB for one map at Nside 2048), so
+the cache is bounded by bytes and is opt-in: smoothing() only keeps the alm
+with cached=True, for callers that smooth the same map several times, which
+should clear() the cache when done.
+"""
+
+import numpy as np
+import healpy as hp
+import hashlib
+from collections import OrderedDict
+
+##########################
+
+class AlmCache():
+    """
+    LRU cache of map2alm results.
+    Contain functions:
+    - alm(), the alm of maps, transformed if not in the cache
+    - smoothing(), smooth maps as healpy.smoothing, from the cached alm
+    - clear()
+    Input:
+    - maxsize, integer. Number of alm sets kept
+    - max_bytes, scalar. The largest total size of the kept alm
+    """
+    def __init__(self, maxsize=8, max_bytes=1e9):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(maps, lmax, iter, pol):
+        # hash the contiguous buffer in place, without a copy of the maps
+        h = hashlib.sha1(memoryview(maps).cast('B'))
+        h.update(str((maps.shape, maps.dtype.str, lmax, iter, pol)).encode())
+        return(h.hexdigest())
+
+    def alm(self, maps, lmax=None, iter=3, pol=False):
+        """
+        The alm of maps, RING ordered (Npix,) or (Nmaps, Npix). UNSEEN pixels
+        are set to zero by map2alm.
+        Input:
+        - maps, ndarray. The maps
+        - lmax, integer. Default 3*Nside-1
+        - iter, integer. Number of iterations of map2alm
+        - pol, bool. If True, maps is I, Q, U with spin-2 Q, U
+        Return:
+        - alm, ndarray. As returned by healpy.map2alm
+        """
+        maps = np.ascontiguousarray(maps, dtype=float)
+        k = self.key(maps, lmax, iter, pol)
+        if k in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(k)
+            return(self._cache[k])
+        self.misses += 1
+        alm = hp.map2alm(maps, lmax=lmax, iter=iter, pol=pol)
+        if alm.nbytes <= self.max_bytes:
+            self._cache[k] = alm
+            self.nbytes += alm.nbytes
+            while len(self._cache) > self.maxsize or self.nbytes > self.max_bytes:
+                self.nbytes -= self._cache.popitem(last=False)[1].nbytes
+        return(alm)
+
+    def smoothing(self, maps, fwhm, Nside_out=None, lmax=None, iter=3,\
+                  pol=False):
+        """
+        Smooth maps with a Gaussian beam, as healpy.smoothing, using the
+        cached alm. The smoothed maps can be synthesised directly at another
+        Nside. Pixels that are UNSEEN in the input stay UNSEEN if Nside_out
+        is the input Nside.
+        Input:
+        - maps, ndarray. RING ordered (Npix,) or (Nmaps, Npix)
+        - fwhm, scalar. The beam FWHM in radians
+        - Nside_out, integer. Nside of the output, default the input Nside
+        - lmax, iter, pol, see alm()
+        Return:
+        - smaps, ndarray. The smoothed maps
+        """
+        maps = np.ascontiguousarray(maps, dtype=float)
+        alm = self.alm(maps, lmax, iter, pol)
+        return(_synthesis(maps, alm, fwhm, Nside_out, pol))
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+def _synthesis(maps, alm, fwhm, Nside_out, pol):
+    # smooth the alm of maps and make the maps at Nside_out
+    Nside_in = hp.npix2nside(maps.shape[-1])
+    if Nside_out is None:
+        Nside_out = Nside_in
+    salm = hp.smoothalm(alm, fwhm=fwhm, pol=pol, inplace=False)
+    smaps = hp.alm2map(salm, Nside_out, pol=pol)
+    if Nside_out == Nside_in:
+        smaps[hp.mask_bad(maps)] = hp.UNSEEN
+    return(smaps)
+
+# shared cache of the module functions
+cache = AlmCache()
+
+def smoothing(maps, fwhm, Nside_out=None, lmax=None, iter=3, pol=False,\
+              cached=False):
+    """
+    Smooth maps as AlmCache.smoothing(). With cached=True the alm are kept in
+    the shared cache, else they are freed after the call.
+    """
+    if cached:
+        return(cache.smoothing(maps, fwhm, Nside_out, lmax, iter, pol))
+    maps = np.ascontiguousarray(maps, dtype=float)
+    alm = hp.map2alm(maps, lmax=lmax, iter=iter, pol=pol)
+    return(_synthesis(maps, alm, fwhm, Nside_out, pol))
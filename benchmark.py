@@ -0,0 +1,155 @@
+"""
+Benchmark of the extinction map pipeline on a synthetic catalogue. Each stage
+(catalogue load, pixelisation, (pixel, bin) aggregation, sight line fitting and
+map output) is timed, and the throughput and peak memory are written to a JSON
+file, so scaling regressions are visible when the code changes.
+
+Run as: python benchmark.py Nstars (Nside) (Niter) (path)
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+import json, os, sys, time
+import platform, resource, tracemalloc
+
+from synthetic_catalogue import make_catalogue
+from pixel_index import hires_pixels, pixels_at
+from los_fit import profile_matrix, fit_mask, poly_fit, mcmc
+from extinction_map import ExtinctionMap
+
+##########################
+
+def run_stage(results, name, Nitems, func, *args):
+    """
+    Time one stage and measure its peak traced memory.
+
+    Parameters:
+    -----------
+    - results, dict.    The results, the stage is added with key name.
+    - name, string.     Name of the stage.
+    - Nitems, integer.  Number of items (stars or sight lines) handled, to
+                        give the throughput.
+    - func, function.   The stage, called as func(*args).
+
+    Return:
+    -----------
+    - out, the return value of func.
+    """
+    print('Run stage: {}'.format(name))
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = func(*args)
+    dt = time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {'time_s': dt, 'items': int(Nitems),\
+                     'items_per_s': Nitems/dt if dt > 0 else None,\
+                     'peak_MB': peak/1024.**2}
+    print('- {} s, {} items/s, peak {} MB'.format(round(dt, 3),\
+          int(Nitems/dt) if dt > 0 else None, round(peak/1024.**2, 1)))
+    return(out)
+
+def load(path):
+    """
+    Read the columns used by the map making, as Make_Map does.
+    """
+    cat = {}
+    for file, name in [('Parallax', 'parallax'), ('Parallax_error', 'parallax_error'),\
+                       ('Extinction', 'a_g_val'), ('gal_longitude', 'l'),\
+                       ('gal_latitude', 'b')]:
+        f = h5py.File(path + file + '_v2.h5', 'r')
+        cat[name] = np.asarray(f[name])
+        f.close()
+    return(cat)
+
+def pixelise(cat, Nside):
+    theta = np.pi/2. - np.radians(cat['b'])
+    phi = np.radians(cat['l'])
+    pix_hi = hires_pixels(theta, phi)
+    return(pixels_at(pix_hi, Nside))
+
+def aggregate(cat, pixpos, bins, Npix):
+    dist = 1000./(cat['parallax'] + 0.029)
+    Bin_ind = np.searchsorted(bins, dist)
+    return(profile_matrix(pixpos, Bin_ind, dist, cat['a_g_val'], Npix,\
+                          len(bins)+1))
+
+def output(params, bins, filename):
+    Ag_map = ExtinctionMap(params)
+    for r in bins[1:]:
+        Ag_map.slice(r)
+    Ag_map.write(filename)
+    return(Ag_map)
+
+def benchmark(Nstars, Nside=64, Niter=200, path='Data/synthetic/', Rmax=3000,\
+              seed=0):
+    """
+    Run all stages on a synthetic catalogue of Nstars stars, made first if the
+    catalogue in path has another size, and write the results to
+    'benchmark_N<Nstars>_Nside<Nside>.json' in path.
+
+    Parameters:
+    -----------
+    - Nstars, integer.  Number of stars.
+    - Nside, integer.   Resolution of the map.
+    - Niter, integer.   Number of MCMC steps of the sight line fit.
+    - path, string.     Directory of the synthetic catalogue.
+    - Rmax, scalar.     Largest distance in pc.
+    - seed, integer.    Seed of the catalogue.
+
+    Return:
+    -----------
+    - results, dict.    Time, throughput and peak memory of each stage.
+    """
+    Nstars = int(Nstars)
+    Npix = hp.nside2npix(Nside)
+    bins = np.arange(0, Rmax+10, 100)
+    results = {}
+
+    Nfile = 0
+    if os.path.isfile(path + 'Index_v2.h5'):
+        f = h5py.File(path + 'Index_v2.h5', 'r')
+        Nfile = len(f['indices'])
+        f.close()
+    if Nfile != Nstars:
+        run_stage(results, 'generate', Nstars, make_catalogue, Nstars, path,\
+                  Rmax, 0.46, None, seed)
+
+    cat = run_stage(results, 'load', Nstars, load, path)
+    pixpos = run_stage(results, 'pixelise', Nstars, pixelise, cat, Nside)
+    R, Ag_mean, N = run_stage(results, 'aggregate', Nstars, aggregate, cat,\
+                              pixpos, bins, Npix)
+    mask = fit_mask(N)
+    run_stage(results, 'fit_poly', Npix, poly_fit, R, Ag_mean, 4, None, mask)
+    params, params_err, rate = run_stage(results, 'fit_mcmc', Npix, mcmc, R,\
+                                         Ag_mean, mask, Niter)
+    run_stage(results, 'output', Npix, output, params, bins,\
+              path + 'benchmark_map.h5')
+
+    summary = {'Nstars': Nstars, 'Nside': Nside, 'Nbins': len(bins)+1,\
+               'Niter': Niter, 'stages': results,\
+               'total_time_s': sum(s['time_s'] for s in results.values()),\
+               'max_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.,\
+               'numpy': np.__version__, 'python': platform.python_version(),\
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    filename = path + 'benchmark_N{}_Nside{}.json'.format(Nstars, Nside)
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Benchmark written to {}'.format(filename))
+    return(summary)
+
+
+#########################################
+#                calls                  #
+#########################################
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print('Need input arguments: Nstars (Nside) (Niter) (path)')
+        sys.exit()
+    Nstars = int(float(sys.argv[1]))
+    Nside = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    Niter = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    path = sys.argv[4] if len(sys.argv) > 4 else 'Data/synthetic/'
+    benchmark(Nstars, Nside, Niter, path)
@@ -0,0 +1,318 @@
+"""
+Module for out-of-core (pixel, distance bin) reductions of the star catalogue.
+The catalogue columns are streamed from the .h5 files in row blocks, and each
+block is reduced to mergeable statistics (count, sum, sum of squares, min and
+max per pixel and bin). The partial statistics are merged, in order, either in
+one process or over a process pool, so the catalogue never has to fit in
+memory. The statistics can be stored, and batches of new or removed stars
+applied to them, with a record of the catalogue versions they reflect.
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+import multiprocessing as mp
+import hashlib, json
+import time
+
+##########################
+
+class PixelBinStats():
+    """
+    Mergeable statistics of some star quantities per (pixel, distance bin).
+    Contain functions:
+    - add(), add a block of stars
+    - remove(), remove a block of stars
+    - merge(), merge the statistics of another set of stars
+    - apply(), add or remove a catalogue version, recorded in versions
+    - mean(), std(), the mean and standard deviation of a quantity
+    - profile(), the mean distance and extinction, as los_fit.profile_matrix
+    - write(), read()
+    Input:
+    - Npix, integer.    Number of pixels
+    - Nbins, integer.   Number of distance bins
+    - names, sequence.  Names of the quantities, default ('Ag', 'dist')
+    """
+    def __init__(self, Npix, Nbins, names=('Ag', 'dist')):
+        self.Npix = Npix
+        self.Nbins = Nbins
+        self.names = tuple(names)
+        self.versions = []
+        self.N = np.zeros((Npix, Nbins), dtype=np.int64)
+        self.sum = {}
+        self.sumsq = {}
+        self.min = {}
+        self.max = {}
+        for q in self.names:
+            self.sum[q] = np.zeros((Npix, Nbins))
+            self.sumsq[q] = np.zeros((Npix, Nbins))
+            self.min[q] = np.full((Npix, Nbins), np.inf)
+            self.max[q] = np.full((Npix, Nbins), -np.inf)
+
+    def add(self, pix, Bin_ind, values):
+        """
+        Add a block of stars. Stars outside the bins 0 to Nbins-1 are skipped.
+        Cells with an unknown (NaN) min/max after remove() get the min/max of
+        the added stars.
+        Input:
+        - pix, array. The pixel of each star
+        - Bin_ind, array. The distance bin of each star
+        - values, dict. Array of each quantity, for each star
+        """
+        ind = (Bin_ind >= 0) & (Bin_ind < self.Nbins)
+        flat = pix[ind].astype(np.int64)*self.Nbins + Bin_ind[ind]
+        size = self.Npix*self.Nbins
+        self.N += np.bincount(flat, minlength=size).reshape(self.Npix, self.Nbins)
+
+        # sort once for the min/max of all quantities
+        order = np.argsort(flat, kind='stable')
+        key, first = np.unique(flat[order], return_index=True)
+        for q in self.names:
+            v = np.asarray(values[q])[ind].astype(np.float64)
+            self.sum[q] += np.bincount(flat, weights=v, minlength=size).\
+                                            reshape(self.Npix, self.Nbins)
+            self.sumsq[q] += np.bincount(flat, weights=v**2, minlength=size).\
+                                            reshape(self.Npix, self.Nbins)
+            if len(key) > 0:
+                vmin = self.min[q].reshape(-1)
+                vmax = self.max[q].reshape(-1)
+                vmin[key] = np.fmin(vmin[key], np.minimum.reduceat(v[order], first))
+                vmax[key] = np.fmax(vmax[key], np.maximum.reduceat(v[order], first))
+        return(self)
+
+    def remove(self, pix, Bin_ind, values):
+        """
+        Remove a block of stars that was added before. The count and sums are
+        subtracted. The min/max can not be undone, so they are set to NaN in
+        the cells where a removed star was at the min or max, until the
+        statistics are reduced again from the catalogue.
+        Raise ValueError, and change nothing, if a (pixel, bin) would get
+        fewer than zero stars, as the block was not added.
+        """
+        ind = (Bin_ind >= 0) & (Bin_ind < self.Nbins)
+        flat = pix[ind].astype(np.int64)*self.Nbins + Bin_ind[ind]
+        size = self.Npix*self.Nbins
+        dN = np.bincount(flat, minlength=size).reshape(self.Npix, self.Nbins)
+        if np.any(dN > self.N):
+            raise ValueError('Can not remove {} stars from (pixel, bin) cells '\
+                             'that do not have them, the block was not added'.\
+                             format(np.sum(np.clip(dN - self.N, 0, None))))
+        self.N -= dN
+        for q in self.names:
+            v = np.asarray(values[q])[ind].astype(np.float64)
+            self.sum[q] -= np.bincount(flat, weights=v, minlength=size).\
+                                            reshape(self.Npix, self.Nbins)
+            self.sumsq[q] -= np.bincount(flat, weights=v**2, minlength=size).\
+                                            reshape(self.Npix, self.Nbins)
+            vmin = self.min[q].reshape(-1)
+            vmax = self.max[q].reshape(-1)
+            lost = flat[(v <= vmin[flat]) | (v >= vmax[flat])]
+            vmin[lost] = np.nan
+            vmax[lost] = np.nan
+
+        # empty cells start over
+        empty = (self.N == 0)
+        for q in self.names:
+            self.sum[q][empty] = 0.
+            self.sumsq[q][empty] = 0.
+            self.min[q][empty] = np.inf
+            self.max[q][empty] = -np.inf
+        return(self)
+
+    def merge(self, other):
+        """
+        Merge the statistics of other into self.
+        """
+        self.N += other.N
+        for q in self.names:
+            self.sum[q] += other.sum[q]
+            self.sumsq[q] += other.sumsq[q]
+            self.min[q] = np.fmin(self.min[q], other.min[q])
+            self.max[q] = np.fmax(self.max[q], other.max[q])
+        return(self)
+
+    def apply(self, pix, Bin_ind, values, name, remove=False):
+        """
+        Add (or remove) a batch of stars, as one catalogue version. The batch
+        is identified by a hash of its values, and a batch already applied
+        the same way is skipped, so applying a version twice does nothing.
+        Input:
+        - pix, Bin_ind, values, as add()
+        - name, string. Name of the catalogue version, e.g. the file name
+        - remove, bool. If True remove the stars instead of adding them
+        Return:
+        - pixels, array. The pixels changed by the batch, empty if skipped
+        """
+        key = batch_key(pix, Bin_ind, values)
+        op = 'remove' if remove else 'add'
+        state = [v['op'] for v in self.versions if v['key'] == key]
+        if (len(state) > 0) and (state[-1] == op):
+            print('Version {} is already applied ({})'.format(name, op))
+            return(np.zeros(0, dtype=np.int64))
+        if remove:
+            self.remove(pix, Bin_ind, values)
+        else:
+            self.add(pix, Bin_ind, values)
+        self.versions.append({'name': name, 'key': key, 'op': op,\
+                              'Nstars': int(len(pix)),\
+                              'date': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        return(np.unique(pix))
+
+    def mean(self, q, pix=None):
+        """
+        The mean of quantity q per (pixel, bin), for all pixels or only pix.
+        """
+        N = self.N if pix is None else self.N[pix]
+        S = self.sum[q] if pix is None else self.sum[q][pix]
+        m = np.zeros(np.shape(N))
+        filled = N > 0
+        m[filled] = S[filled]/N[filled]
+        return(m)
+
+    def std(self, q, pix=None):
+        N = self.N if pix is None else self.N[pix]
+        S2 = self.sumsq[q] if pix is None else self.sumsq[q][pix]
+        filled = N > 0
+        m = self.mean(q, pix)
+        var = np.zeros(np.shape(N))
+        var[filled] = S2[filled]/N[filled] - m[filled]**2
+        return(np.sqrt(np.clip(var, 0, None)))
+
+    def profile(self, pix=None):
+        """
+        The mean distance, mean extinction and star count, the same arrays as
+        los_fit.profile_matrix(). If pix is given, only for those pixels.
+        """
+        N = self.N if pix is None else self.N[pix]
+        return(self.mean('dist', pix), self.mean('Ag', pix), N)
+
+    def write(self, filename):
+        """
+        Write the statistics and the version record to a .h5 file.
+        """
+        f = h5py.File(filename, 'w')
+        f.create_dataset('N', data=self.N, compression='gzip')
+        for q in self.names:
+            g = f.create_group(q)
+            g.create_dataset('sum', data=self.sum[q], compression='gzip')
+            g.create_dataset('sumsq', data=self.sumsq[q], compression='gzip')
+            g.create_dataset('min', data=self.min[q], compression='gzip')
+            g.create_dataset('max', data=self.max[q], compression='gzip')
+        f.attrs['names'] = json.dumps(self.names)
+        f.attrs['versions'] = json.dumps(self.versions)
+        f.close()
+
+    @classmethod
+    def read(cls, filename):
+        f = h5py.File(filename, 'r')
+        N = np.asarray(f['N'])
+        stats = cls(np.shape(N)[0], np.shape(N)[1], json.loads(f.attrs['names']))
+        stats.N = N
+        for q in stats.names:
+            stats.sum[q] = np.asarray(f[q]['sum'])
+            stats.sumsq[q] = np.asarray(f[q]['sumsq'])
+            stats.min[q] = np.asarray(f[q]['min'])
+            stats.max[q] = np.asarray(f[q]['max'])
+        stats.versions = json.loads(f.attrs['versions'])
+        f.close()
+        return(stats)
+
+def batch_key(pix, Bin_ind, values):
+    """
+    Hash identifying a batch of stars by its pixels, bins and values.
+    """
+    h = hashlib.sha1(np.ascontiguousarray(pix).tobytes())
+    h.update(np.ascontiguousarray(Bin_ind).tobytes())
+    for q in sorted(values):
+        h.update(np.ascontiguousarray(values[q]).tobytes())
+    return(h.hexdigest())
+
+def catalogue_length(path, file='Extinction', name='a_g_val'):
+    f = h5py.File(path + file + '_v2.h5', 'r')
+    N = len(f[name])
+    f.close()
+    return(N)
+
+def read_block(path, columns, start, stop):
+    """
+    Read rows start to stop of the catalogue columns.
+    Input:
+    - path, string. Directory of the '_v2.h5' files
+    - columns, sequence. (file name, data name) of the columns
+    Return:
+    - block, dict. The arrays with data name as key
+    """
+    block = {}
+    for file, name in columns:
+        f = h5py.File(path + file + '_v2.h5', 'r')
+        block[name] = f[name][start:stop]
+        f.close()
+    return(block)
+
+def gal_pixel_bins(block, Nside, bins):
+    """
+    Galactic RING pixel, distance bin and the quantities of a block of stars,
+    as computed by Make_Map.
+    """
+    theta = np.pi/2 - block['b']*np.pi/180
+    phi = block['l']*np.pi/180
+    pix = hp.ang2pix(Nside, theta, phi)
+    dist = 1000./(block['parallax'] + 0.029)
+    Bin_ind = np.searchsorted(bins, dist)
+    return(pix, Bin_ind, {'Ag': block['a_g_val'], 'dist': dist})
+
+gal_columns = [('Parallax', 'parallax'), ('Extinction', 'a_g_val'),\
+               ('gal_longitude', 'l'), ('gal_latitude', 'b')]
+
+def _reduce_range(args):
+    """
+    Read and reduce one row range, in a worker process or in the main process.
+    """
+    path, columns, start, stop, Nside, bins = args
+    pix, Bin_ind, values = gal_pixel_bins(read_block(path, columns, start,\
+                                                     stop), Nside, bins)
+    stats = PixelBinStats(hp.nside2npix(Nside), len(bins)+1)
+    return(stats.add(pix, Bin_ind, values))
+
+def reduce_catalogue(Nside, bins, path='Data/', chunksize=10000000,\
+                     processes=None):
+    """
+    Stream the catalogue in row blocks and reduce it to (pixel, bin)
+    statistics in galactic pixels. The blocks are merged in row order, so the
+    result does not depend on the number of processes.
+
+    Parameters:
+    -----------
+    - Nside, integer.   The map resolution.
+    - bins, array.      The distance bin edges, the stars are binned with
+                        np.searchsorted(bins, dist) into len(bins)+1 bins.
+    - path, string.     Directory of the '_v2.h5' files.
+    - chunksize, integer. Number of stars per block.
+    - processes, integer. Number of worker processes, None to reduce in this
+                        process.
+
+    Return:
+    -----------
+    - stats, PixelBinStats. The merged statistics.
+    """
+    t0 = time.time()
+    Nstars = catalogue_length(path)
+    tasks = [(path, gal_columns, i, min(i+chunksize, Nstars), Nside, bins)\
+             for i in range(0, Nstars, chunksize)]
+    stats = PixelBinStats(hp.nside2npix(Nside), len(bins)+1)
+    if processes is None:
+        for i, task in enumerate(tasks):
+            stats.merge(_reduce_range(task))
+            print('Block {} of {} reduced, time so far: {} s'.\
+                  format(i+1, len(tasks), time.time()-t0))
+    else:
+        with mp.Pool(processes) as pool:
+            for i, part in enumerate(pool.imap(_reduce_range, tasks)):
+                stats.merge(part)
+                print('Block {} of {} reduced, time so far: {} s'.\
+                      format(i+1, len(tasks), time.time()-t0))
+    stats.versions.append({'name': path, 'key': None, 'op': 'reduce',\
+                           'Nstars': int(Nstars),\
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    print('Reduced {} stars in {} s'.format(Nstars, time.time()-t0))
+    return(stats)
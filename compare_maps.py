@@ -12,6 +12,8 @@ import os, sys
 import scipy as sp
 import h5py
 
+import alm_cache
+
 #################################################
 
 
@@ -42,16 +44,18 @@ def fix_resolution(map, Nside_in=0):
         for Ns in Nsides:
             print('Fix resolution to Nside={}'.format(Ns))
             m = hp.pixelfunc.ud_grade(map, Ns)
-            smap = smoothing(map, Ns)
+            smap = smoothing(map, Ns, cached=True)
             maps.append(m)
             smaps.append(smap)
+        alm_cache.cache.clear()
 
         return(maps, smap)
     #
 
-def smoothing(map, Nside):
+def smoothing(map, Nside, cached=False):
+    # with cached the alm of map are kept, so other beams need no new map2alm
     FWHM = 2.5*(64/Nside) * (np.pi/180)
-    smap = hp.sphtfunc.smoothing(map, fwhm=FWHM, iter=3)
+    smap = alm_cache.smoothing(map, FWHM, iter=3, cached=cached)
     return(smap)
 
 def powerspectrum(map):
@@ -0,0 +1,75 @@
+"""
+Module with a spatial index for cone searches on the sky. The positions are
+stored as 3D unit vectors in a KD-tree, and a cone of angular radius a is a
+ball of chord radius 2*sin(a/2) around the unit vector of the cone centre.
+Many sight lines are answered in one call, returned as CSR style star lists.
+"""
+
+import numpy as np
+import time
+from scipy.spatial import cKDTree
+
+##########################
+
+def lonlat2vec(lon, lat):
+    """
+    Unit vectors of positions given in longitude and latitude, in degrees.
+    Return a (N, 3) array.
+    """
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    cos_lat = np.cos(lat)
+    return(np.stack([cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)],\
+                    axis=-1))
+
+class ConeIndex():
+    """
+    KD-tree of unit vectors for fast cone searches.
+    Contain functions:
+    - query(), star lists for many cones in one call, as CSR arrays
+    - cone(), the stars in one cone
+    Input:
+    - lon, array. Longitude of the objects, in degrees
+    - lat, array. Latitude of the objects, in degrees
+    - leafsize, integer. Leaf size of the KD-tree
+    """
+    def __init__(self, lon, lat, leafsize=64):
+        t0 = time.time()
+        self.Nobj = len(lon)
+        self.tree = cKDTree(lonlat2vec(lon, lat), leafsize=leafsize,\
+                            balanced_tree=False, compact_nodes=False)
+        print('Cone index over {} objects built in {} s'.\
+              format(self.Nobj, time.time()-t0))
+
+    def query(self, lon, lat, radius, workers=-1):
+        """
+        Find the objects inside cones of a given radius around many centres.
+        Input:
+        - lon, array. Longitude of the cone centres in degrees
+        - lat, array. Latitude of the cone centres in degrees
+        - radius, scalar/array. Angular radius of the cones in degrees
+        - workers, integer. Number of threads, -1 use all cores.
+        Return:
+        - indptr, array. The objects of cone i are indices[indptr[i]:indptr[i+1]]
+        - indices, array. The object indices of all cones, sorted per cone
+        """
+        vec = np.atleast_2d(lonlat2vec(lon, lat))
+        chord = 2*np.sin(np.radians(np.asarray(radius, dtype=float))/2.)
+        lists = self.tree.query_ball_point(vec, chord, workers=workers,\
+                                           return_sorted=True)
+        counts = np.array([len(l) for l in lists], dtype=np.int64)
+        indptr = np.zeros(len(lists)+1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        if indptr[-1] > 0:
+            indices = np.concatenate([np.asarray(l, dtype=np.int64)\
+                                      for l in lists])
+        else:
+            indices = np.zeros(0, dtype=np.int64)
+        return(indptr, indices)
+
+    def cone(self, lon, lat, radius):
+        """
+        The indices of the objects inside one cone.
+        """
+        indptr, indices = self.query([lon], [lat], radius)
+        return(indices)
@@ -0,0 +1,120 @@
+"""
+Module with a parametric extinction map. Only the fitted parameters of each
+pixel are stored, and the extinction is evaluated on demand at the requested
+distances, instead of storing a dense (Npix, Ndistances) array.
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+from collections import OrderedDict
+
+import los_fit
+
+##########################
+
+class ExtinctionMap():
+    """
+    Lazy extinction map, A_G(pixel, r) = func(r, params[pixel]).
+    Contain functions:
+    - slice(), full sky map at one distance, with LRU cache
+    - evaluate(), extinction for any set of distances and pixels
+    - write(), read(), store and load the parameters
+    Input:
+    - params, array.    (Npix, Nparams) array with fitted parameters per pixel
+    - func, function.   Function evaluating func(x, params) to a (Npix, Nx)
+                        array. Default is the power law in los_fit.
+    - params_err, array. Optional uncertainty of the parameters.
+    - cache_size, integer. Number of sky slices kept in the cache.
+    """
+    def __init__(self, params, func=los_fit.powlaw, params_err=None,\
+                 cache_size=16):
+        self.params = np.asarray(params)
+        self.params_err = params_err
+        self.func = func
+        self.Npix = len(self.params)
+        self.Nside = hp.npix2nside(self.Npix)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return(self.Npix)
+
+    def slice(self, r):
+        """
+        The full sky extinction map at distance r. The most recently used
+        slices are cached.
+        Input:
+        - r, scalar. The distance in pc
+        Return:
+        - map, array. The extinction in every pixel at distance r, UNSEEN
+                      in pixels without fitted parameters.
+        """
+        key = float(r)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return(self._cache[key])
+
+        self.misses += 1
+        map = self.func(np.array([key]), self.params)[:, 0]
+        map[~np.isfinite(map)] = hp.UNSEEN
+        map.setflags(write=False)
+        self._cache[key] = map
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return(map)
+
+    def evaluate(self, r, pix=None):
+        """
+        Evaluate the extinction at one or several distances.
+        Input:
+        - r, scalar/array. Distance(s) in pc
+        - pix, integer/array. Optional, pixels to evaluate in. Default is all.
+        Return:
+        - Ag, array. Shape (Npix,) for scalar r, else (Npix, len(r)), with
+                     Npix replaced by the number of selected pixels.
+        """
+        if np.ndim(r) == 0:
+            map = self.slice(r)
+            if pix is None:
+                return(map)
+            return(map[pix])
+
+        params = self.params if pix is None else self.params[np.atleast_1d(pix)]
+        Ag = self.func(np.asarray(r, dtype=float), params)
+        if (pix is not None) and (np.ndim(pix) == 0):
+            return(Ag[0])
+        return(Ag)
+
+    def __call__(self, r, pix=None):
+        return(self.evaluate(r, pix))
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def write(self, filename):
+        """
+        Write the parameters of the map to a .h5 file.
+        """
+        f = h5py.File(filename, 'w')
+        f.create_dataset('params', data=self.params)
+        if self.params_err is not None:
+            f.create_dataset('params_err', data=self.params_err)
+        f.attrs['Nside'] = self.Nside
+        f.close()
+
+    @classmethod
+    def read(cls, filename, func=los_fit.powlaw, cache_size=16):
+        """
+        Read a map written with write().
+        """
+        f = h5py.File(filename, 'r')
+        params = np.asarray(f['params'])
+        params_err = None
+        if 'params_err' in f:
+            params_err = np.asarray(f['params_err'])
+        f.close()
+        return(cls(params, func, params_err, cache_size))
@@ -0,0 +1,188 @@
+"""
+Module for transforming equatorial (ICRS) coordinates and polarisation angles
+to galactic coordinates with the rotation matrix A_G' from the Gaia DR2
+documentation (section 3.1.7). The transform is vectorised and done in chunks
+in float64. The galactic columns of a catalogue can be cached to file, so they
+are computed only once.
+
+Against astropy the positions agree to 0.025 arcsec on the sky. The longitude
+difference itself grows as 1/cos(b) towards the galactic poles, to arcseconds
+within 0.01 deg of a pole.
+"""
+
+import numpy as np
+import h5py
+import hashlib
+import os, time
+
+##########################
+
+# ICRS to galactic rotation matrix, r_gal = A_G r_icrs
+A_G = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],\
+                [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],\
+                [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]])
+
+# north celestial pole in galactic coordinates, in radians
+l_NCP = np.arctan2(A_G[1,2], A_G[0,2])
+b_NCP = np.arcsin(A_G[2,2])
+
+def eq2gal(ra, dec, chunksize=5000000):
+    """
+    Transform right ascension and declination to galactic coordinates.
+
+    Parameters:
+    -----------
+    - ra, array.        Right ascension in degrees
+    - dec, array.       Declination in degrees
+    - chunksize, integer. Number of objects transformed at a time, limits the
+                        memory used by temporary arrays.
+    Return:
+    -----------
+    - l, array.         Galactic longitude in degrees, [0, 360)
+    - b, array.         Galactic latitude in degrees, [-90, 90]
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    l = np.empty(len(ra))
+    b = np.empty(len(ra))
+    for i in range(0, len(ra), chunksize):
+        s = slice(i, i+chunksize)
+        a = np.radians(ra[s])
+        d = np.radians(dec[s])
+        cos_d = np.cos(d)
+        r = np.stack([cos_d*np.cos(a), cos_d*np.sin(a), np.sin(d)])
+        x, y, z = A_G @ r
+        l[s] = np.degrees(np.arctan2(y, x)) % 360.
+        b[s] = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return(l, b)
+
+def gal2eq(l, b, chunksize=5000000):
+    """
+    Transform galactic coordinates to right ascension and declination, the
+    inverse of eq2gal().
+
+    Parameters:
+    -----------
+    - l, array.         Galactic longitude in degrees
+    - b, array.         Galactic latitude in degrees
+    - chunksize, integer. Number of objects transformed at a time.
+    Return:
+    -----------
+    - ra, array.        Right ascension in degrees, [0, 360)
+    - dec, array.       Declination in degrees, [-90, 90]
+    """
+    l = np.atleast_1d(np.asarray(l, dtype=np.float64))
+    b = np.atleast_1d(np.asarray(b, dtype=np.float64))
+    ra = np.empty(len(l))
+    dec = np.empty(len(l))
+    for i in range(0, len(l), chunksize):
+        s = slice(i, i+chunksize)
+        lr = np.radians(l[s])
+        br = np.radians(b[s])
+        cos_b = np.cos(br)
+        r = np.stack([cos_b*np.cos(lr), cos_b*np.sin(lr), np.sin(br)])
+        x, y, z = A_G.T @ r
+        ra[s] = np.degrees(np.arctan2(y, x)) % 360.
+        dec[s] = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return(ra, dec)
+
+def polangle_offset(l, b):
+    """
+    The angle between north in the equatorial and in the galactic frame, at
+    galactic position (l, b). This is the position angle of the north
+    celestial pole seen from the object, equation 16 in Hutsemekers 1997.
+
+    Parameters:
+    -----------
+    - l, array.     Galactic longitude in degrees
+    - b, array.     Galactic latitude in degrees
+    Return:
+    -----------
+    - diff, array.  The angle to add to equatorial polarisation angles, in
+                    radians.
+    """
+    l = np.radians(l)
+    b = np.radians(b)
+    diff = np.arctan2(np.sin(l_NCP - l),\
+                      np.tan(b_NCP)*np.cos(b) - np.sin(b)*np.cos(l_NCP - l))
+    return(diff)
+
+def eq2gal_polangle(ra, dec, polang):
+    """
+    Transform positions and polarisation angles from equatorial to galactic
+    coordinates in one pass.
+
+    Parameters:
+    -----------
+    - ra, array.        Right ascension in degrees
+    - dec, array.       Declination in degrees
+    - polang, array.    Polarisation angle in equatorial coordinates, degrees
+    Return:
+    -----------
+    - l, b, arrays.     Galactic coordinates in degrees
+    - theta_gal, array. Polarisation angle in galactic coordinates, radians
+                        in [0, pi)
+    - diff, array.      The rotation angle between the frames, in radians
+    """
+    l, b = eq2gal(ra, dec)
+    diff = polangle_offset(l, b)
+    theta_gal = (np.radians(polang) + diff) % np.pi
+    return(l, b, theta_gal, diff)
+
+def galactic_columns(ra, dec, cache='Data/galactic_cache.h5', max_entries=4):
+    """
+    Galactic coordinates of a catalogue, read from the cache file if the same
+    (ra, dec) columns have been transformed before, else computed and added
+    to the cache. The columns are identified by a hash of their values. The
+    cache keeps the max_entries most recently used catalogues, the file is
+    rewritten without the others when a new one is added.
+
+    Parameters:
+    -----------
+    - ra, array.        Right ascension in degrees
+    - dec, array.       Declination in degrees
+    - cache, string.    The cache file. If None, no caching is done.
+    - max_entries, integer. Number of catalogues kept in the cache.
+    Return:
+    -----------
+    - l, b, arrays.     Galactic coordinates in degrees
+    """
+    if cache is None:
+        return(eq2gal(ra, dec))
+
+    ra = np.ascontiguousarray(ra, dtype=np.float64)
+    dec = np.ascontiguousarray(dec, dtype=np.float64)
+    key = hashlib.sha1(memoryview(ra).cast('B'))
+    key.update(memoryview(dec).cast('B'))
+    key = key.hexdigest()
+
+    keep = []
+    if os.path.isfile(cache):
+        f = h5py.File(cache, 'a')
+        if key in f:
+            l = np.asarray(f[key]['l'])
+            b = np.asarray(f[key]['b'])
+            f[key].attrs['last_used'] = time.time()
+            f.close()
+            return(l, b)
+        used = {k: f[k].attrs.get('last_used', 0.) for k in f}
+        keep = sorted(used, key=used.get)[len(used)-max_entries+1:]
+        f.close()
+
+    l, b = eq2gal(ra, dec)
+    # write the kept and the new catalogue to a new file, as h5py does not
+    # free the space of deleted groups
+    tmp = cache + '.{}.tmp'.format(os.getpid())
+    f = h5py.File(tmp, 'w')
+    if len(keep) > 0:
+        old = h5py.File(cache, 'r')
+        for k in keep:
+            old.copy(old[k], f, name=k)
+        old.close()
+    g = f.create_group(key)
+    g.create_dataset('l', data=l)
+    g.create_dataset('b', data=b)
+    g.attrs['last_used'] = time.time()
+    f.close()
+    os.replace(tmp, cache)
+    return(l, b)
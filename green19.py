@@ -0,0 +1,441 @@
+"""
+Module for lazy reading of the Green et.al. 2019 (bayestar2019) maps. The
+'samples' cube (sight lines x MCMC samples x 120 distance bins) is too large
+to load, so the .h5 file is kept open and only the requested distance bins are
+read, in row chunks. The most recently used bins are kept in an LRU cache.
+
+The per sight line statistics of the samples (median, standard deviation and
+16, 84 percentiles) in every distance bin are computed once by
+build_summary() and stored in a '<file>_summary.h5' file, which the map
+functions read instead of reducing the samples at every call. The summary is
+built explicitly, with 'python green19.py <file> (workers)', as it reads the
+whole samples cube.
+
+The sight lines are HEALPix pixels of different Nside (multi-order, NESTED).
+Rasteriser maps them onto a uniform Nside, for any number of distance bins
+at once, and PixelLookup finds the sight line of any sky position, used by
+GreenMap.query() for the reddening to stars at (l, b, d).
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+from scipy import sparse
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import os, sys, time
+
+##########################
+
+# the statistics of the summary cube, in the order of its last axis
+summary_stats = ['median', 'std', 'p16', 'p84']
+
+# distance modulus of the 120 distance bins, 63 pc to 63 kpc, as
+# distance_array() in Greens19map
+mu_bins = 5*np.log10(np.logspace(np.log10(63), np.log10(6.3e4), 120)) - 5
+
+def summary_file(file):
+    return(os.path.splitext(file)[0] + '_summary.h5')
+
+def _summarise(samples):
+    """
+    The statistics over the samples axis of a (rows, Nsamples, Nbins) block,
+    as a (rows, Nbins, 4) float32 array.
+    """
+    p50, p16, p84 = np.percentile(samples, [50, 16, 84], axis=1)
+    std = np.std(samples, axis=1)
+    return(np.stack([p50, std, p16, p84], axis=-1).astype(np.float32))
+
+def _source_id(file):
+    # size and modification time of the Green19 file, to detect a stale summary
+    st = os.stat(file)
+    return([int(st.st_size), int(st.st_mtime)])
+
+def build_summary(file, outfile=None, chunk_rows=20000, workers=4):
+    """
+    Compute the median, standard deviation and 16, 84 percentiles of the
+    samples of every sight line and distance bin, and store them as a
+    (Nsightlines, Nbins, 4) float32 dataset 'summary'. The row chunks are
+    read and written in the main thread, h5py serialises all file access,
+    and only the reductions run over a thread pool. The memory use is about
+    (workers+1)*chunk_rows sight lines. The summary is written to a temporary
+    file, renamed to outfile when complete.
+
+    Parameters:
+    -----------
+    - file, string.     The Green19 .h5 file.
+    - outfile, string.  The summary file, default is '<file>_summary.h5'.
+    - chunk_rows, integer. Number of sight lines reduced at a time.
+    - workers, integer. Number of threads.
+
+    Return:
+    -----------
+    - outfile, string.  The summary file.
+    """
+    t0 = time.time()
+    if outfile is None:
+        outfile = summary_file(file)
+    f = h5py.File(file, 'r')
+    samples = f['samples']
+    Nsightlines, Nsamples, Nbins = samples.shape
+
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(outfile)),\
+                                      suffix='.tmp', delete=False).name
+    try:
+        out = h5py.File(tmp, 'w')
+        summary = out.create_dataset('summary',\
+                                     (Nsightlines, Nbins, len(summary_stats)),\
+                                     dtype=np.float32,\
+                                     chunks=(min(chunk_rows, Nsightlines), Nbins,\
+                                             len(summary_stats)))
+        summary.attrs['stats'] = summary_stats
+        out.create_dataset('pixel_info', data=np.asarray(f['pixel_info']))
+
+        def write(pending):
+            start, stop, result = pending.popleft()
+            summary[start:stop] = result.result()
+            print('Summarised {} of {} sight lines, time so far: {} s'.\
+                  format(stop, Nsightlines, time.time()-t0))
+
+        pending = deque()
+        with ThreadPoolExecutor(workers) as pool:
+            for start in range(0, Nsightlines, chunk_rows):
+                stop = min(start + chunk_rows, Nsightlines)
+                pending.append((start, stop,\
+                                pool.submit(_summarise, samples[start:stop])))
+                if len(pending) > workers:
+                    write(pending)
+            while len(pending) > 0:
+                write(pending)
+        out.attrs['source'] = _source_id(file)
+        out.attrs['complete'] = True
+        out.close()
+        os.replace(tmp, outfile)
+    except BaseException:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        f.close()
+    print('Summary written to {} in {} s'.format(outfile, time.time()-t0))
+    return(outfile)
+
+class Rasteriser():
+    """
+    Map from the multi-order sight lines to a uniform NESTED map. Sight lines
+    at or below the map resolution fill their (Nside/Ns)^2 sub pixels, finer
+    sight lines are averaged into their parent pixel, weighted by area. The
+    map is a sparse (Npix, Nsightlines) operator built once.
+    Contain functions:
+    - cube(), the maps of one or several values per sight line
+    Input:
+    - pix_ind, array.   NESTED pixel index of each sight line
+    - Nsides, array.    Nside of each sight line
+    - Nside, integer.   Nside of the map, default is the largest in Nsides
+    """
+    def __init__(self, pix_ind, Nsides, Nside=None):
+        pix_ind = np.asarray(pix_ind, dtype=np.int64)
+        Nsides = np.asarray(Nsides, dtype=np.int64)
+        if Nside is None:
+            Nside = int(np.max(Nsides))
+        self.Nside = Nside
+        self.Npix = 12*Nside**2
+        self.Nsightlines = len(pix_ind)
+
+        # sight lines at or below Nside expand to m sub pixels, as the
+        # offsets 0..m-1 from pix*m
+        leaf = np.nonzero(Nsides <= Nside)[0]
+        m = (Nside//Nsides[leaf])**2
+        start = np.cumsum(m) - m
+        offset = np.arange(np.sum(m)) - np.repeat(start, m)
+        pix = np.repeat(pix_ind[leaf]*m, m) + offset
+        leaf = np.repeat(leaf, m)
+        w = np.ones(len(pix))
+
+        # finer sight lines fall in their parent pixel, by their area
+        fine = np.nonzero(Nsides > Nside)[0]
+        r = (Nsides[fine]//Nside)**2
+        leaf = np.append(leaf, fine)
+        pix = np.append(pix, pix_ind[fine]//r)
+        w = np.append(w, 1./r)
+
+        W = sparse.csr_matrix((w, (pix, leaf)), shape=(self.Npix, self.Nsightlines))
+        self.coverage = np.asarray(W.sum(axis=1)).ravel()
+        self.covered = self.coverage > 0
+        norm = np.zeros(self.Npix)
+        norm[self.covered] = 1./self.coverage[self.covered]
+        self.W = (sparse.diags(norm) @ W).astype(np.float32).tocsr()
+
+    def cube(self, values):
+        """
+        The maps of the sight line values, NaN where no sight line covers.
+        Input:
+        - values, ndarray. (Nsightlines,) or (Nsightlines, Nbins)
+        Return:
+        - maps, ndarray. (Npix,) or (Nbins, Npix)
+        """
+        values = np.asarray(values)
+        maps = np.asarray(self.W @ values.reshape(self.Nsightlines, -1))
+        maps[~self.covered] = np.nan
+        if values.ndim == 1:
+            return(maps[:,0])
+        return(np.ascontiguousarray(maps.T))
+
+class PixelLookup():
+    """
+    Find the multi-order sight line containing sky positions. Each sight line
+    covers a contiguous range of NESTED pixels at the largest Nside, so the
+    lookup is a binary search of the ranges.
+    Contain functions:
+    - find(), the sight line index of positions (l, b)
+    Input:
+    - pix_ind, array.   NESTED pixel index of each sight line
+    - Nsides, array.    Nside of each sight line
+    """
+    def __init__(self, pix_ind, Nsides):
+        pix_ind = np.asarray(pix_ind, dtype=np.int64)
+        Nsides = np.asarray(Nsides, dtype=np.int64)
+        self.Nside = int(np.max(Nsides))
+        m = (self.Nside//Nsides)**2
+        self.order = np.argsort(pix_ind*m)
+        self.start = (pix_ind*m)[self.order]
+        self.stop = self.start + m[self.order]
+
+    def find(self, l, b):
+        """
+        Input:
+        - l, b, arrays. Galactic coordinates in degrees
+        Return:
+        - leaf, array. Index of the sight line, -1 outside the map
+        """
+        theta = np.radians(90. - np.asarray(b))
+        phi = np.radians(np.asarray(l))
+        pix = hp.ang2pix(self.Nside, theta, phi, nest=True)
+        i = np.searchsorted(self.start, pix, side='right') - 1
+        ok = (i >= 0) & (pix < self.stop[np.clip(i, 0, None)])
+        leaf = np.full(np.shape(pix), -1, dtype=np.int64)
+        leaf[ok] = self.order[i[ok]]
+        return(leaf)
+
+class GreenMap():
+    """
+    Lazy view of the Green19 samples cube. Indexing as the full array,
+    samples[rows, samples, bins], reads only the distance bins asked for.
+    Contain functions:
+    - bin(), the (Nsightlines, Nsamples) samples of one distance bin, cached
+    - bins(), several distance bins, as (Nsightlines, Nsamples, len(bins))
+    - summary(), a statistic of the samples from the summary file
+    - maps(), uniform Nside maps of a statistic in several distance bins
+    - query(), a statistic at positions (l, b, d), interpolated in distance
+    - clear_cache(), close()
+    Input:
+    - file, string.     The Green19 .h5 file
+    - cache_size, integer. Number of distance bins kept in the cache
+    - chunk_rows, integer. Number of sight lines read per chunk
+    """
+    def __init__(self, file, cache_size=8, chunk_rows=100000):
+        self.file = file
+        self.f = h5py.File(file, 'r')
+        self.samples = self.f['samples']
+        self.best_fit = self.f['best_fit']
+        self.pixel_info = np.asarray(self.f['pixel_info'])
+        self.shape = self.samples.shape
+        self.Nsightlines, self.Nsamples, self.Nbins = self.shape
+        self.dtype = self.samples.dtype
+        self.ndim = 3
+        self.chunk_rows = chunk_rows
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._summary = None
+
+    def __len__(self):
+        return(self.Nsightlines)
+
+    def _read(self, dist_inds):
+        """
+        Read distance bins for all sight lines, in row chunks. h5py serialises
+        the reads, so they are done in one thread.
+        """
+        out = np.empty((self.Nsightlines, self.Nsamples, len(dist_inds)),\
+                       dtype=self.dtype)
+        for start in range(0, self.Nsightlines, self.chunk_rows):
+            stop = min(start + self.chunk_rows, self.Nsightlines)
+            out[start:stop] = self.samples[start:stop, :, dist_inds]
+        return(out)
+
+    def bins(self, dist_inds):
+        """
+        The samples of several distance bins. Bins not in the cache are read
+        together in one pass over the file.
+        Input:
+        - dist_inds, sequence. The distance bin indices, 0 to 119
+        Return:
+        - samples, ndarray. (Nsightlines, Nsamples, len(dist_inds))
+        """
+        dist_inds = [int(d) % self.Nbins for d in dist_inds]
+        missing = sorted(set(d for d in dist_inds if d not in self._cache))
+        self.hits += len(dist_inds) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            t0 = time.time()
+            data = self._read(missing)
+            print('Read distance bins {} in {} s'.format(missing, time.time()-t0))
+            for i, d in enumerate(missing):
+                self._cache[d] = np.ascontiguousarray(data[:,:,i])
+        for d in dist_inds:
+            self._cache.move_to_end(d)
+        out = np.stack([self._cache[d] for d in dist_inds], axis=-1)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return(out)
+
+    def bin(self, dist_ind):
+        """
+        The (Nsightlines, Nsamples) samples of one distance bin.
+        """
+        return(self.bins([dist_ind])[:,:,0])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        rows, samp, dist = key
+        if isinstance(dist, (int, np.integer)):
+            data = self.bin(dist)
+            return(data[rows, samp])
+        dist_inds = np.arange(self.Nbins)[dist]
+        data = self.bins(dist_inds)
+        return(data[rows, samp])
+
+    def _open_summary(self):
+        if self._summary is None:
+            sfile = summary_file(self.file)
+            build = 'build it with: python green19.py {}'.format(self.file)
+            if not os.path.isfile(sfile):
+                raise IOError('No summary file {}, {}'.format(sfile, build))
+            fs = h5py.File(sfile, 'r')
+            if not fs.attrs.get('complete', False):
+                fs.close()
+                raise IOError('Summary file {} is incomplete, {}'.\
+                              format(sfile, build))
+            if list(fs.attrs['source']) != _source_id(self.file):
+                fs.close()
+                raise IOError('Summary file {} is older than {}, {}'.\
+                              format(sfile, self.file, build))
+            self._fs = fs
+            self._summary = fs['summary']
+
+    def summary(self, stat='median', dist_ind=slice(None)):
+        """
+        A statistic of the samples of every sight line, read from the summary
+        file made by build_summary().
+        Input:
+        - stat, string. One of 'median', 'std', 'p16', 'p84'
+        - dist_ind, integer/slice/list. The distance bins
+        Return:
+        - values, ndarray. (Nsightlines,) for an integer dist_ind, else
+                           (Nsightlines, len(dist_ind))
+        """
+        self._open_summary()
+        k = summary_stats.index(stat)
+        if not isinstance(dist_ind, (int, np.integer, slice)):
+            # h5py needs increasing indices
+            dist_ind, inv = np.unique(np.arange(self.Nbins)[dist_ind],\
+                                      return_inverse=True)
+            return(self._summary[:, list(dist_ind), k][:, inv])
+        if isinstance(dist_ind, (int, np.integer)):
+            dist_ind = int(dist_ind) % self.Nbins
+        return(self._summary[:, dist_ind, k])
+
+    def maps(self, dist_inds, Nside=None, stat='median'):
+        """
+        Uniform NESTED maps of a summary statistic, one per distance bin.
+        Input:
+        - dist_inds, sequence. The distance bins
+        - Nside, integer. Nside of the maps, default the largest in the file
+        - stat, string. The statistic, see summary()
+        Return:
+        - maps, ndarray. (len(dist_inds), Npix)
+        """
+        if Nside is None:
+            Nside = int(np.max(self.pixel_info['nside']))
+        if getattr(self, '_raster', None) is None or self._raster.Nside != Nside:
+            self._raster = Rasteriser(self.pixel_info['healpix_index'],\
+                                      self.pixel_info['nside'], Nside)
+        return(self._raster.cube(self.summary(stat, list(dist_inds))))
+
+    def query(self, l, b, d, stat='median', chunk_rows=200000):
+        """
+        A statistic of the reddening to positions (l, b, d), from the sight
+        line containing (l, b), linearly interpolated in distance modulus
+        between the distance bins. Distances outside 63 pc to 63 kpc take the
+        value of the nearest bin. The summary is read in row chunks, only
+        those containing a queried sight line.
+        Input:
+        - l, b, arrays. Galactic coordinates in degrees
+        - d, array. Distance in pc
+        - stat, string. The statistic, see summary()
+        - chunk_rows, integer. Number of sight lines read at a time
+        Return:
+        - values, array. E(B-V) in mag, NaN outside the map
+        """
+        l, b, d = np.broadcast_arrays(np.atleast_1d(l), np.atleast_1d(b),\
+                                      np.atleast_1d(d))
+        if getattr(self, '_lookup', None) is None:
+            self._lookup = PixelLookup(self.pixel_info['healpix_index'],\
+                                       self.pixel_info['nside'])
+        leaf = self._lookup.find(l, b)
+
+        # fractional distance bin from the distance modulus
+        mu = 5*np.log10(np.clip(d, 1e-3, None)) - 5
+        t = np.interp(mu, mu_bins[:self.Nbins], np.arange(self.Nbins))
+        i0 = np.clip(np.floor(t).astype(int), 0, self.Nbins-2)
+        w = t - i0
+
+        self._open_summary()
+        k = summary_stats.index(stat)
+        values = np.full(np.shape(leaf), np.nan)
+        order = np.argsort(leaf)
+        sorted_leaf = leaf[order]
+        for start in range(0, self.Nsightlines, chunk_rows):
+            a, c = np.searchsorted(sorted_leaf, [start, start + chunk_rows])
+            if a == c:
+                continue
+            sel = order[a:c]
+            block = self._summary[start:start+chunk_rows, :, k]
+            rows = leaf[sel] - start
+            values[sel] = (1 - w[sel])*block[rows, i0[sel]] +\
+                          w[sel]*block[rows, i0[sel]+1]
+        return(values)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def close(self):
+        self._cache.clear()
+        if self._summary is not None:
+            self._fs.close()
+            self._summary = None
+        self.f.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#########################################
+#                calls                  #
+#########################################
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print('Need input arguments: file (workers)')
+        sys.exit()
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    build_summary(sys.argv[1], workers=workers)
@@ -0,0 +1,486 @@
+"""
+Module for fitting extinction profiles along many sight lines at once. The
+stars are binned into a padded (Npix, Nbins) profile matrix, and all sight
+lines are fitted together using array operations instead of pixel loops.
+Derivatives along distance are made with linear operators that depend only on
+the distance grids, so one operator is shared by all sight lines.
+"""
+
+import numpy as np
+import os
+from scipy import interpolate
+from numpy.polynomial import legendre
+import time
+
+import shared_arrays
+
+##########################
+
+def profile_matrix(pixpos, Bin_ind, dist, Ag, Npix, Nbins):
+    """
+    Bin the stars into a padded profile matrix of mean extinction and mean
+    distance per (pixel, distance bin).
+
+    Parameters:
+    -----------
+    - pixpos, array.    The pixel number of each star.
+    - Bin_ind, array.   The distance bin index of each star, from searchsorted.
+    - dist, array.      The distance to each star, in pc.
+    - Ag, array.        The extinction of each star, in mag.
+    - Npix, integer.    The number of pixels in the map.
+    - Nbins, integer.   The number of distance bins.
+
+    Return:
+    -----------
+    - R, ndarray.       (Npix, Nbins) array with the mean distance in each bin.
+    - Ag_mean, ndarray. (Npix, Nbins) array with the mean extinction in each bin.
+    - N, ndarray.       (Npix, Nbins) array with the number of stars in each bin.
+    """
+    ind = np.logical_and(Bin_ind >= 0, Bin_ind < Nbins)
+    flat = pixpos[ind].astype(np.int64)*Nbins + Bin_ind[ind]
+    size = Npix*Nbins
+
+    N = np.bincount(flat, minlength=size).reshape(Npix, Nbins)
+    R = np.bincount(flat, weights=dist[ind], minlength=size).reshape(Npix, Nbins)
+    Ag_mean = np.bincount(flat, weights=Ag[ind], minlength=size).\
+                                                        reshape(Npix, Nbins)
+    filled = N > 0
+    R[filled] /= N[filled]
+    Ag_mean[filled] /= N[filled]
+    return(R, Ag_mean, N)
+
+def fit_mask(N):
+    """
+    The bins used in the sight line fits, True for bins with stars. Bin 0
+    holds the stars at dist <= 0 (negative parallax) and is left out, as
+    R_list[1:] in Make_Map.Ag_func.
+    """
+    mask = np.asarray(N) > 0
+    mask[:, 0] = False
+    return(mask)
+
+def powlaw(x, params):
+    """
+    Evaluate the power law Ag(r) = a*r^b for all sight lines at once. The
+    power law is 0 at r <= 0.
+
+    Parameters:
+    -----------
+    - x, ndarray.       (Npix, Nbins) distances, or a 1d distance array shared
+                        by all sight lines.
+    - params, ndarray.  (Npix, 2) array with the parameters (a, b).
+
+    Return:
+    -----------
+    - Ag, ndarray.      (Npix, Nbins) array with the evaluated power law.
+    """
+    a = params[:, 0, None]
+    b = params[:, 1, None]
+    x, b = np.broadcast_arrays(np.asarray(x, dtype=float), b)
+    xb = np.power(x, b, out=np.zeros(x.shape), where=x > 0)
+    return(a * xb)
+
+def log_likelihood(data, Ag, sigma, mask):
+    """
+    Gaussian log likelihood of each sight line, summed over the filled bins.
+
+    Parameters:
+    -----------
+    - data, ndarray.    (Npix, Nbins) array with the binned extinction.
+    - Ag, ndarray.      (Npix, Nbins) array with the model extinction.
+    - sigma, scalar.    The uncertainty of the extinction.
+    - mask, ndarray.    (Npix, Nbins) bool array, True for bins with stars.
+
+    Return:
+    -----------
+    - L, array.         The log likelihood of each sight line, length Npix.
+    """
+    L = np.where(mask, -0.5*((data - Ag)/sigma)**2, 0.0)
+    return(np.sum(L, axis=1))
+
+def log_prior(params):
+    """
+    Flat prior requiring positive parameters, for all sight lines.
+    """
+    ok = np.all(params >= 0, axis=1)
+    return(np.where(ok, 0.0, -1e30))
+
+def mcmc(x, data, mask, Niter=10000, sigma=0.46, mean=(0.5, 0.5),\
+         cov=((1., 0.81), (0.81, 1.)), burnin=None, adapt=100, seed=None):
+    """
+    Metropolis sampling of the power law parameters for all sight lines at
+    once. The chains are advanced together as (Npix, 2) arrays. Each chain
+    adapts its own step length towards an acceptance rate between 0.2 and 0.5,
+    and its proposal covariance from its own history at the end of burn-in.
+    Sight lines with no filled bins have no likelihood and are not sampled,
+    their parameters, errors and acceptance rate are NaN.
+
+    Parameters:
+    -----------
+    - x, ndarray.       (Npix, Nbins) array with the mean distance in each bin.
+    - data, ndarray.    (Npix, Nbins) array with the mean extinction in each bin.
+    - mask, ndarray.    (Npix, Nbins) bool array, True for bins with stars.
+    - Niter, integer.   Number of sampling steps. Default is 10000
+    - sigma, scalar.    The uncertainty of the extinction, default is 0.46 mag
+                        from Andrae etal 2018.
+    - mean, sequence.   Start parameters for all chains.
+    - cov, sequence.    Initial proposal covariance matrix.
+    - burnin, integer.  Number of steps to discard. Default is Niter/2.
+    - adapt, integer.   Steps between each step length update.
+    - seed, integer.    Seed of the random generator, optional.
+
+    Return:
+    -----------
+    - params, ndarray.  (Npix, 2) array with the posterior mean of (a, b).
+    - params_err, ndarray. (Npix, 2) array with the posterior std of (a, b).
+    - accept_rate, array. The acceptance rate of each chain.
+    """
+    Npix = len(data)
+    Nparams = len(mean)
+    has_data = np.any(mask, axis=1)
+    if not np.all(has_data):
+        print('Skip {} sight lines with no stars'.format(np.sum(~has_data)))
+        params = np.full((Npix, Nparams), np.nan)
+        params_err = np.full((Npix, Nparams), np.nan)
+        accept_rate = np.full(Npix, np.nan)
+        if np.any(has_data):
+            x = np.asarray(x)
+            if x.ndim == 2:
+                x = x[has_data]
+            params[has_data], params_err[has_data], accept_rate[has_data] =\
+                        mcmc(x, data[has_data], mask[has_data], Niter, sigma,\
+                             mean, cov, burnin, adapt, seed)
+        return(params, params_err, accept_rate)
+
+    rng = np.random.default_rng(seed)
+    if burnin is None:
+        burnin = Niter//2
+
+    # per chain Cholesky factor of the proposal covariance
+    L = np.tile(np.linalg.cholesky(np.asarray(cov, dtype=float)), (Npix, 1, 1))
+    steplength = np.ones(Npix)
+
+    curr = np.tile(np.asarray(mean, dtype=float), (Npix, 1))
+    curr_post = log_likelihood(data, powlaw(x, curr), sigma, mask)\
+                + log_prior(curr)
+
+    counter = np.zeros(Npix)
+    window = np.zeros(Npix)
+    s1 = np.zeros((Npix, Nparams))
+    s2 = np.zeros((Npix, Nparams, Nparams))
+    Nsamples = 0
+
+    t0 = time.time()
+    for i in range(Niter):
+        # draw parameters:
+        z = rng.standard_normal((Npix, Nparams))
+        step = np.einsum('nij,nj->ni', L, z)
+        prop = curr + steplength[:, None]*step
+        prop_post = log_likelihood(data, powlaw(x, prop), sigma, mask)\
+                    + log_prior(prop)
+
+        # accept/reject all chains at once:
+        draw = np.log(rng.uniform(0, 1, Npix))
+        accept = (prop_post - curr_post) > draw
+        curr[accept] = prop[accept]
+        curr_post[accept] = prop_post[accept]
+        counter += accept
+        window += accept
+
+        if (i+1) % adapt == 0 and i < burnin:
+            rate = window/adapt
+            steplength[rate < 0.2] /= 2.
+            steplength[rate > 0.5] *= 2.
+            window[:] = 0
+
+        if i >= burnin//2 and i < burnin:
+            # collect history to estimate the proposal covariance
+            s1 += curr
+            s2 += curr[:, :, None]*curr[:, None, :]
+            Nsamples += 1
+        elif i == burnin and Nsamples > 1:
+            m = s1/Nsamples
+            c = s2/Nsamples - m[:, :, None]*m[:, None, :]
+            c += 1e-10*np.eye(Nparams)
+            L = np.linalg.cholesky(c * 2.38**2/Nparams)
+            steplength[:] = 1.
+            s1[:] = 0.
+            s2[:] = 0.
+            Nsamples = 0
+
+        if i >= burnin:
+            s1 += curr
+            s2 += curr[:, :, None]*curr[:, None, :]
+            Nsamples += 1
+
+        if (i+1) % 1000 == 0:
+            print('Step {}, time so far: {}s, mean acceptance rate: {}'.\
+                  format(i+1, time.time()-t0, np.mean(counter)/(i+1)))
+    #
+    params = s1/Nsamples
+    var = np.einsum('nii->ni', s2)/Nsamples - params**2
+    params_err = np.sqrt(np.clip(var, 0, None))
+    return(params, params_err, counter/Niter)
+
+def _mcmc_rows(args):
+    """
+    Pool task, sample the sight lines start to stop of the shared arrays.
+    """
+    start, stop, kwargs = args
+    x = shared_arrays.get('x')[start:stop]
+    data = shared_arrays.get('data')[start:stop]
+    mask = shared_arrays.get('mask')[start:stop]
+    return(mcmc(x, data, mask, **kwargs))
+
+def mcmc_parallel(x, data, mask, processes=None, Nblocks=None, seed=None,\
+                  **kwargs):
+    """
+    Run mcmc() on blocks of sight lines over a process pool. The profile
+    matrices are put in shared memory once, and each worker samples its
+    block of rows from there.
+
+    Parameters:
+    -----------
+    - x, data, mask, ndarrays. As mcmc().
+    - processes, integer. Number of worker processes, default is all cores.
+    - Nblocks, integer. Number of blocks, default is 4 per process.
+    - seed, integer.    Seed of the random generator, each block gets its own.
+    - kwargs,           Other arguments of mcmc().
+
+    Return:
+    -----------
+    - params, params_err, accept_rate. As mcmc().
+    """
+    Npix = len(data)
+    if processes is None:
+        processes = os.cpu_count()
+    if Nblocks is None:
+        Nblocks = 4*processes
+    edges = np.linspace(0, Npix, min(Nblocks, Npix)+1).astype(int)
+    seeds = np.random.SeedSequence(seed).generate_state(len(edges)-1)
+    tasks = [(edges[i], edges[i+1], dict(kwargs, seed=int(seeds[i])))\
+             for i in range(len(edges)-1)]
+
+    with shared_arrays.SharedArrays() as shared:
+        shared.publish('x', x)
+        shared.publish('data', data)
+        shared.publish('mask', mask)
+        with shared.pool(processes) as pool:
+            parts = pool.map(_mcmc_rows, tasks)
+    params = np.concatenate([p[0] for p in parts])
+    params_err = np.concatenate([p[1] for p in parts])
+    accept_rate = np.concatenate([p[2] for p in parts])
+    return(params, params_err, accept_rate)
+
+def interp_matrix(r, x):
+    """
+    Linear interpolation operator from the grid r to the grid x, as np.interp
+    with the values clamped outside r.
+
+    Parameters:
+    -----------
+    - r, array.         Increasing distances the profiles are sampled at.
+    - x, array.         The distances to interpolate to.
+
+    Return:
+    -----------
+    - L, ndarray.       (len(x), len(r)) interpolation matrix.
+    """
+    r = np.asarray(r, dtype=float)
+    x = np.clip(np.asarray(x, dtype=float), r[0], r[-1])
+    j = np.clip(np.searchsorted(r, x, side='right') - 1, 0, len(r)-2)
+    w = (x - r[j])/(r[j+1] - r[j])
+    L = np.zeros((len(x), len(r)))
+    rows = np.arange(len(x))
+    L[rows, j] = 1. - w
+    L[rows, j+1] += w
+    return(L)
+
+def diff_matrix(r, x, method='spline'):
+    """
+    Linear operator giving the derivative dA/dr at x of a profile A sampled
+    at r, so that dA/dr(x) = D @ A. The operator is built once per grid and
+    applied to all sight lines.
+
+    Parameters:
+    -----------
+    - r, array.         Increasing distances the profiles are sampled at.
+    - x, array.         The distances to evaluate the derivative at.
+    - method, string.   'spline' for the derivative of the interpolating cubic
+                        spline (as splrep/splev with s=0), 'fd' for second
+                        order finite differences on r interpolated linearly
+                        to x.
+
+    Return:
+    -----------
+    - D, ndarray.       (len(x), len(r)) derivative matrix.
+    """
+    r = np.asarray(r, dtype=float)
+    n = len(r)
+    if method == 'spline':
+        # spline through each unit vector, the columns of the operator
+        spl = interpolate.make_interp_spline(r, np.eye(n), k=3)
+        D = spl.derivative()(np.asarray(x, dtype=float))
+    elif method == 'fd':
+        D = np.gradient(np.eye(n), r, axis=0)
+        if not np.array_equal(x, r):
+            D = interp_matrix(r, x) @ D
+    else:
+        raise ValueError('Unknown method {}, use "spline" or "fd"'.\
+                         format(method))
+    return(D)
+
+def resample_profiles(A, r, r_common):
+    """
+    Linearly interpolate profiles sampled at their own distances to a common
+    distance grid, for all sight lines at once.
+
+    Parameters:
+    -----------
+    - A, ndarray.       (Nsightlines, Nbins) profiles.
+    - r, ndarray.       (Nsightlines, Nbins) distances of each profile.
+    - r_common, array.  The common distance grid.
+
+    Return:
+    -----------
+    - A_common, ndarray. (Nsightlines, len(r_common)) resampled profiles.
+    """
+    Ns, Nbins = np.shape(A)
+    ind = np.argsort(r, axis=1)
+    r = np.take_along_axis(r, ind, axis=1)
+    A = np.take_along_axis(A, ind, axis=1)
+
+    # clamp to each sight line's range as np.interp, then search all sight
+    # lines in one call by giving each row its own offset
+    x = np.clip(r_common[None, :], r[:, :1], r[:, -1:])
+    span = np.max(r) - np.min(r) + 1.
+    offset = span*np.arange(Ns)[:, None]
+    j = np.searchsorted((r + offset).ravel(), (x + offset).ravel(),\
+                        side='right').reshape(np.shape(x)) - 1
+    j = np.clip(j - Nbins*np.arange(Ns)[:, None], 0, Nbins-2)
+
+    r0 = np.take_along_axis(r, j, axis=1)
+    r1 = np.take_along_axis(r, j+1, axis=1)
+    A0 = np.take_along_axis(A, j, axis=1)
+    A1 = np.take_along_axis(A, j+1, axis=1)
+    dr = r1 - r0
+    w = np.divide(x - r0, dr, out=np.zeros(np.shape(x)), where=dr > 0)
+    return(A0 + w*(A1 - A0))
+
+def diff_profiles(A, r, x, method='spline', r_common=None):
+    """
+    The differential extinction dA/dr on the grid x for all sight lines at
+    once.
+
+    Parameters:
+    -----------
+    - A, ndarray.       (Nsightlines, Nbins) cumulative extinction profiles.
+    - r, array.         Distances of the bins. Either a 1d array shared by all
+                        sight lines, or (Nsightlines, Nbins) distances which
+                        are first resampled to r_common.
+    - x, array.         The common distance grid of the derivatives.
+    - method, string.   'spline' or 'fd', see diff_matrix().
+    - r_common, array.  The grid to resample to if r is 2d. Default is the
+                        mean of r over the sight lines.
+
+    Return:
+    -----------
+    - dA, ndarray.      (Nsightlines, len(x)) derivatives.
+    """
+    A = np.atleast_2d(A)
+    r = np.asarray(r, dtype=float)
+    if r.ndim == 2:
+        if r_common is None:
+            r_common = np.sort(np.mean(r, axis=0))
+        A = resample_profiles(A, r, np.asarray(r_common, dtype=float))
+        r = r_common
+    D = diff_matrix(r, x, method)
+    return(A @ D.T)
+
+def poly_basis(x, deg, domain, der=0):
+    """
+    Legendre polynomial basis on x, with x scaled from domain to [-1, 1] for
+    numerical stability.
+
+    Parameters:
+    -----------
+    - x, array.         The distances to evaluate the basis at.
+    - deg, integer.     Degree of the polynomial.
+    - domain, sequence. (r_min, r_max) mapped to [-1, 1].
+    - der, integer.     Order of the derivative of the basis, 0 or more.
+
+    Return:
+    -----------
+    - V, ndarray.       (len(x), deg+1) basis matrix, so that V @ coef gives the
+                        polynomial (or its derivative) at x.
+    """
+    scale = 2./(domain[1] - domain[0])
+    t = (np.asarray(x, dtype=float) - domain[0])*scale - 1.
+    V = legendre.legvander(t, deg)
+    if der > 0:
+        # derivative coefficients of each basis polynomial, in d/dr
+        C = legendre.legder(np.eye(deg+1), m=der, scl=scale, axis=0)
+        V = legendre.legvander(t, deg-der) @ C
+    return(V)
+
+def poly_fit(x, y, deg, w=None, mask=None, domain=None):
+    """
+    Weighted least squares polynomial fit of all sight lines in one call.
+    Bins where mask is False (or y is not finite) are left out of the fit of
+    that sight line.
+
+    Parameters:
+    -----------
+    - x, array.         Distances, either a 1d array shared by all sight lines
+                        or (Nsightlines, Nbins).
+    - y, ndarray.       (Nsightlines, Nbins) extinction profiles.
+    - deg, integer.     Degree of the polynomial.
+    - w, ndarray.       Optional weights (1/sigma) per bin, as np.polyfit.
+    - mask, ndarray.    Optional (Nsightlines, Nbins) bool array of used bins.
+    - domain, sequence. (r_min, r_max) of the basis. Default is the range of x.
+
+    Return:
+    -----------
+    - coef, ndarray.    (Nsightlines, deg+1) Legendre coefficients.
+    - domain, tuple.    The domain of the basis, used by poly_eval().
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.asarray(x, dtype=float)
+    if mask is None:
+        mask = np.ones(np.shape(y), dtype=bool)
+    mask = mask & np.isfinite(y) & np.isfinite(x)
+    if domain is None:
+        domain = (np.min(x[np.isfinite(x)]), np.max(x[np.isfinite(x)]))
+    if w is None:
+        w = np.ones(np.shape(y))
+    w = np.where(mask, np.broadcast_to(w, np.shape(y)), 0.)
+    yw = np.where(mask, y, 0.)*w
+
+    V = poly_basis(np.where(np.isfinite(x), x, domain[0]), deg, domain)
+    if (x.ndim == 1) and np.all(w == w[:1]):
+        # same design for all sight lines, one pseudo inverse
+        P = np.linalg.pinv(V*w[0, :, None])
+        coef = yw @ P.T
+    else:
+        A = V*w[:, :, None]
+        coef = np.einsum('nij,nj->ni', np.linalg.pinv(A), yw)
+    return(coef, tuple(domain))
+
+def poly_eval(coef, x, domain, der=0):
+    """
+    Evaluate the fitted polynomials, or their derivative, of all sight lines
+    on the grid x as one matrix product.
+
+    Parameters:
+    -----------
+    - coef, ndarray.    (Nsightlines, deg+1) coefficients from poly_fit().
+    - x, array.         The distance grid.
+    - domain, tuple.    The domain from poly_fit().
+    - der, integer.     Order of the derivative, default 0.
+
+    Return:
+    -----------
+    - Ag, ndarray.      (Nsightlines, len(x)) evaluated polynomials.
+    """
+    deg = np.shape(coef)[-1] - 1
+    return(coef @ poly_basis(x, deg, domain, der).T)
@@ -5,10 +5,16 @@ import healpy as hp
 import pandas as pd
 import matplotlib.pyplot as plt
 import h5py
-import sys, os, time
+import sys, os, time, json
 
 from scipy.optimize import curve_fit
 
+import los_fit
+import alm_cache
+from extinction_map import ExtinctionMap
+from pixel_index import NSIDE_HI, hires_pixels, pixels_at
+from chunked import PixelBinStats, reduce_catalogue, gal_pixel_bins
+
 ##########################
 
 def Read_H5(file, name):
@@ -18,13 +24,18 @@ def Read_H5(file, name):
     f.close()
     return(data)
 
-def PixelCoord(Nside, theta, phi):
+def PixelCoord(Nside, theta, phi, file=None):
+    # RING pixels from the cached Nside 4096 NESTED indices, by bit shifting
     if np.min(theta) < 0:
         theta = np.pi/2 - theta
     else:
         pass
     #
-    pixpos = hp.pixelfunc.ang2pix(Nside, theta, phi)
+    if Nside > NSIDE_HI:
+        pixpos = hp.pixelfunc.ang2pix(Nside, theta, phi)
+    else:
+        pix_hi = hires_pixels(theta, phi, file=file)
+        pixpos = pixels_at(pix_hi, Nside)
     return(pixpos)
 
 def parallax2dist(p, p_err):
@@ -42,10 +53,21 @@ def dust_map():
 
 class Make_Map():
     
-    def __init__(self, Nside, Rmax):
+    def __init__(self, Nside, Rmax, chunksize=None, processes=None):
         self.Nside = Nside
         self.Rmax = Rmax
         self.Npix = hp.nside2npix(Nside)
+        self.chunksize = chunksize
+        self.processes = processes
+        self.bin = np.arange(0, Rmax+10, 100)
+        self.Nbins = len(self.bin)+1
+        self.x = np.arange(0, 10001, 1)
+        self.order = 4
+        self.fx_array = np.zeros((self.Npix, self.order+1))
+        if chunksize is not None:
+            # the catalogue is streamed in blocks when the map is made
+            print('Stream the catalogue in blocks of {} stars'.format(chunksize))
+            return
         
         print('Load data')
         self.parallax = Read_H5('Data/Parallax_v2.h5', 'parallax')
@@ -60,22 +82,16 @@ class Make_Map():
         self.theta = self.latitude * np.pi/180
 
         # get pixels:
-        self.pixpos = PixelCoord(Nside, self.theta, self.phi)
+        self.pixpos = PixelCoord(Nside, self.theta, self.phi,\
+                                 'Data/Pixel_gal_nest4096_v2.h5')
 
         # get distance:                           
         self.dist, self.dist_err = parallax2dist(self.parallax, self.parallax_error)
-        self.bin = np.arange(0, Rmax+10, 100)
         
         print(self.bin, len(self.bin))
-        self.x = np.arange(0, 10001, 1)
         
         self.Bin_ind = np.searchsorted(self.bin, self.dist)
         self.ind_sort = np.argsort(self.Bin_ind)
-        self.Nbins = len(self.bin)+1
-        self.order = 4
-        
-        # Arrays:
-        self.fx_array = np.zeros((self.Npix, self.order+1))
         print(self.x)
 
         #####
@@ -96,25 +112,23 @@ class Make_Map():
 
 
         Ag_map = self.make_map()
-        print(np.shape(Ag_map))
+        print(len(Ag_map))
         
         if one == False:
             for r in self.bin:
                 if r > 0:
                     
                     print(r)
-                    ind = np.where(self.x == r)[0]
-                    map = Ag_map[:, ind[0]]
+                    map = Ag_map.slice(r)
                     self.draw_map(map, r)
-                    smap = self.smoothin(Ag_map[:, ind[0]], self.Nside)
+                    smap = self.smoothing(map, self.Nside)
                     self.draw_map(smap, r, s=True)
                 #
             #
         
         elif (one == True) and (R_slice != None):
 
-            ind = np.where(self.x == R_slice)[0]
-            map = Ag_map[:, ind[0]]
+            map = Ag_map.slice(R_slice)
             self.draw_map(map, R_slice)
             smap = self.smoothing(map,self.Nside)
             self.draw_map(smap, R_slice, s=True)
@@ -128,43 +142,120 @@ class Make_Map():
 
 
     def make_map(self):
-        #if pixels or angles?
-        
-        # sort after pixel:
-        pixpos = self.pixpos[self.ind_sort]
-        Bin_ind = self.Bin_ind[self.ind_sort]
-        dist = self.dist[self.ind_sort]
-        Ag = self.Ag[self.ind_sort]
-
-        Ag_array = np.zeros((self.Npix, len(self.x)))
-        counter = 0
+        """
+        Fit the power law extinction profile of all pixels at once with the
+        batched sampler. Return a parametric map that evaluates the extinction
+        at any distance on demand, instead of a dense (Npix, len(x)) array.
+        """
         t0 = time.time()
-        for pix in range(1000, self.Npix):
-            ind1 = np.where(self.pixpos == pix)[0]
-            Ag = self.Ag[ind1]
-            Ag_low = self.Ag_low[ind1]
-            Ag_upp = self.Ag_upp[ind1]
-            dist = self.dist[ind1]
-            Bin_ind = self.Bin_ind[ind1]
-            # Find interpolation polynomial
-            fit = self.Ag_func(Ag, Ag_low, Ag_upp, dist, Bin_ind)
-            #self.fx_array[j, :] = fit
-            if fit[0] > 0.95:
-                counter += 1
+        params, params_err = self.fit_sightlines()
 
-            Ag_array[pix] = self.extrapolate_extinction(self.x, fit)
-            
-            if pix%1000 == 0:
-                t2 = time.time()
-                print('time so far:', (t2-t0))
-                print('pixel:', pix, hp.pixelfunc.pix2ang(self.Nside, pix))
-            #
-            sys.exit()
-        #    
+        Ag_map = ExtinctionMap(params, los_fit.powlaw, params_err)
         t1 = time.time()
         print('Time used:', (t1-t0)/60)
-        print(counter)
-        return(Ag_array)
+        return(Ag_map)
+
+    def fit_sightlines(self, Niter=10000):
+        """
+        Bin the stars into a (Npix, Nbins) profile matrix and sample the power
+        law parameters for all sight lines simultaneously.
+        Return:
+        - params, array. (Npix, 2) array with the mean of the parameters (a, b)
+        - params_err, array. (Npix, 2) array with the std of the parameters.
+        """
+        if self.chunksize is None:
+            R, Ag_mean, N = los_fit.profile_matrix(self.pixpos, self.Bin_ind,\
+                                        self.dist, self.Ag, self.Npix, self.Nbins)
+        else:
+            stats = reduce_catalogue(self.Nside, self.bin, 'Data/',\
+                                     self.chunksize, self.processes)
+            R, Ag_mean, N = stats.profile()
+        mask = los_fit.fit_mask(N)
+        print('Sample {} sight lines with {} filled bins'.\
+              format(self.Npix, np.sum(mask)))
+        if self.processes is None:
+            params, params_err, accept = los_fit.mcmc(R, Ag_mean, mask,\
+                                        Niter=Niter, mean=self.mean_array(),\
+                                        cov=self.cov_matrix())
+        else:
+            params, params_err, accept = los_fit.mcmc_parallel(R, Ag_mean,\
+                                        mask, self.processes, Niter=Niter,\
+                                        mean=self.mean_array(),\
+                                        cov=self.cov_matrix())
+        print('Mean acceptance rate:', np.mean(accept))
+        self.params = params
+        self.params_err = params_err
+        return(params, params_err)
+
+    def update_map(self, block, name, remove=False, Niter=10000,\
+                   statsfile='Data/Ag_stats_Nside{}.h5',\
+                   mapfile='Data/Ag_params_Nside{}.h5'):
+        """
+        Update the stored (pixel, bin) statistics and the parametric map with
+        a batch of new (or removed) stars. Only the sight lines of the pixels
+        with changed stars are fitted again, so the time used is proportional
+        to the batch. The statistics are made from the full catalogue in
+        Data/ the first time, and the batch is then applied on top of it, so
+        a batch of added stars must not be in the catalogue files already, or
+        it is counted twice. Batches applied later are recognised by their
+        hash and not applied twice. The catalogue versions applied are
+        recorded in both files.
+        Input:
+        - block, dict. The batch, with the columns 'parallax', 'a_g_val', 'l'
+                       and 'b' as in the catalogue files
+        - name, string. Name of the catalogue version of the batch
+        - remove, bool. If True, remove the stars of the batch
+        - Niter, integer. Number of MCMC steps for the refitted sight lines
+        Return:
+        - Ag_map, ExtinctionMap. The updated map
+        """
+        statsfile = statsfile.format(self.Nside)
+        mapfile = mapfile.format(self.Nside)
+        if os.path.isfile(statsfile):
+            stats = PixelBinStats.read(statsfile)
+        else:
+            print('No statistics in {}, reduce the catalogue in Data/ first. '\
+                  'The batch {} must not be part of it.'.format(statsfile, name))
+            stats = reduce_catalogue(self.Nside, self.bin, 'Data/',\
+                                     self.chunksize or 10000000, self.processes)
+        pixels = stats.apply(*gal_pixel_bins(block, self.Nside, self.bin),\
+                             name, remove)
+        params = np.zeros((self.Npix, 2))
+        params_err = np.zeros((self.Npix, 2))
+        if os.path.isfile(mapfile):
+            Ag_map = ExtinctionMap.read(mapfile)
+            params = Ag_map.params
+            if Ag_map.params_err is not None:
+                params_err = Ag_map.params_err
+        else:
+            # no map yet, fit all sight lines
+            pixels = np.arange(self.Npix)
+
+        if len(pixels) > 0:
+            R, Ag_mean, N = stats.profile(pixels)
+            mask = los_fit.fit_mask(N)
+            print('Sample {} changed sight lines'.format(len(pixels)))
+            if self.processes is None:
+                p, p_err, accept = los_fit.mcmc(R, Ag_mean, mask, Niter=Niter,\
+                                            mean=self.mean_array(),\
+                                            cov=self.cov_matrix())
+            else:
+                p, p_err, accept = los_fit.mcmc_parallel(R, Ag_mean, mask,\
+                                            self.processes, Niter=Niter,\
+                                            mean=self.mean_array(),\
+                                            cov=self.cov_matrix())
+            params[pixels] = p
+            params_err[pixels] = p_err
+
+        Ag_map = ExtinctionMap(params, los_fit.powlaw, params_err)
+        stats.write(statsfile)
+        Ag_map.write(mapfile)
+        f = h5py.File(mapfile, 'a')
+        f.attrs['versions'] = json.dumps(stats.versions)
+        f.close()
+        self.params = params
+        self.params_err = params_err
+        return(Ag_map)
 
     def Ag_func(self, Ag, Ag_low, Ag_upp, dist, Bin_ind):
         """
@@ -373,7 +464,7 @@ class Make_Map():
         Smooths the extinction map
         """
         FWHM = 2.5*(64/Nside) * (np.pi/180) # radians
-        smap = hp.sphtfunc.smoothing(map, fwhm=FWHM)
+        smap = alm_cache.smoothing(map, FWHM)
         return(smap)
 
     def power_spectrum(self, map):
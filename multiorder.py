@@ -0,0 +1,185 @@
+"""
+Module for adaptive resolution (multi-order) HEALPix extinction maps. Starting
+from a coarse Nside, a NESTED pixel is split into its four children as long as
+one of its distance bins holds more stars than a threshold. The leaves are
+stored like the Green et.al. 2019 maps, as (nside, healpix_index) with a
+distance profile for each leaf, and any position is looked up in the leaf
+covering it.
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+import time
+
+##########################
+
+def nside2order(Nside):
+    return(int(np.log2(Nside)))
+
+class MultiOrderMap():
+    """
+    Store of leaf pixels (nside, ipix) with a profile along distance.
+    Contain functions:
+    - build(), build the map from a star catalogue
+    - lookup(), the leaf covering given positions
+    - profile(), the distance profiles at given positions
+    - write(), read()
+    Input:
+    - nside, array.     Nside of each leaf
+    - ipix, array.      NESTED pixel index of each leaf at its own nside
+    - N, array.         (Nleaf, Nbins) number of stars per leaf and bin
+    - sum_Ag, array.    (Nleaf, Nbins) summed extinction per leaf and bin
+    - sum_r, array.     (Nleaf, Nbins) summed distance per leaf and bin
+    - Nside_max, integer. The highest allowed Nside.
+    """
+    def __init__(self, nside, ipix, N, sum_Ag, sum_r, Nside_max):
+        self.Nside_max = Nside_max
+        self.order_max = nside2order(Nside_max)
+
+        # sort the leaves after their first pixel at Nside_max
+        shift = 2*(self.order_max - np.log2(nside).astype(np.int64))
+        start = np.left_shift(ipix.astype(np.int64), shift)
+        ind = np.argsort(start)
+        self.nside = np.asarray(nside)[ind]
+        self.ipix = np.asarray(ipix, dtype=np.int64)[ind]
+        self.start = start[ind]
+        self.N = N[ind]
+        self.sum_Ag = sum_Ag[ind]
+        self.sum_r = sum_r[ind]
+        self.Nleaf = len(self.nside)
+
+    @classmethod
+    def build(cls, lon, lat, Bin_ind, dist, Ag, Nbins, threshold=50,\
+              Nside_min=8, Nside_max=1024):
+        """
+        Build the multi-order map by splitting pixels with too many stars.
+        Input:
+        - lon, lat, arrays. Galactic position of the stars, in degrees
+        - Bin_ind, array. The distance bin of each star, 0 to Nbins-1
+        - dist, array. The distance to the stars in pc
+        - Ag, array. The extinction of the stars
+        - Nbins, integer. Number of distance bins
+        - threshold, integer. Split a pixel if any bin has more stars
+        - Nside_min, Nside_max, integers. The coarsest and finest Nside
+        Return:
+        - map, MultiOrderMap.
+        """
+        t0 = time.time()
+        order_min = nside2order(Nside_min)
+        order_max = nside2order(Nside_max)
+        pix_hi = hp.ang2pix(Nside_max, lon, lat, nest=True, lonlat=True)
+
+        ok = (Bin_ind >= 0) & (Bin_ind < Nbins)
+        pix_hi = pix_hi[ok]
+        Bin_ind = Bin_ind[ok]
+        dist = dist[ok]
+        Ag = Ag[ok]
+
+        nside, ipix, N, sum_Ag, sum_r = [], [], [], [], []
+        active = np.arange(12*4**order_min)
+        for order in range(order_min, order_max+1):
+            pix = np.right_shift(pix_hi, 2*(order_max - order))
+            # star count, summed Ag and r for the filled (pixel, bin) only
+            key, inv = np.unique(pix*Nbins + Bin_ind, return_inverse=True)
+            n = np.bincount(inv)
+            s_Ag = np.bincount(inv, weights=Ag)
+            s_r = np.bincount(inv, weights=dist)
+            key_pix = key//Nbins
+            key_bin = key % Nbins
+
+            # the largest bin count in each filled pixel
+            first = np.concatenate(([0], np.where(np.diff(key_pix) > 0)[0]+1))
+            n_max = np.maximum.reduceat(n, first)
+            if order < order_max:
+                split = key_pix[first][n_max > threshold]
+            else:
+                split = np.zeros(0, dtype=np.int64)
+            leaf = np.setdiff1d(active, split, assume_unique=True)
+            print('Nside {}: {} leaves, {} pixels split'.\
+                  format(2**order, len(leaf), len(split)))
+
+            n_leaf = np.zeros((len(leaf), Nbins), dtype=np.int64)
+            Ag_leaf = np.zeros((len(leaf), Nbins))
+            r_leaf = np.zeros((len(leaf), Nbins))
+            row = np.searchsorted(leaf, key_pix)
+            in_leaf = row < len(leaf)
+            in_leaf[in_leaf] = leaf[row[in_leaf]] == key_pix[in_leaf]
+            n_leaf[row[in_leaf], key_bin[in_leaf]] = n[in_leaf]
+            Ag_leaf[row[in_leaf], key_bin[in_leaf]] = s_Ag[in_leaf]
+            r_leaf[row[in_leaf], key_bin[in_leaf]] = s_r[in_leaf]
+
+            nside.append(np.full(len(leaf), 2**order))
+            ipix.append(leaf)
+            N.append(n_leaf)
+            sum_Ag.append(Ag_leaf)
+            sum_r.append(r_leaf)
+
+            if len(split) == 0:
+                break
+            # keep only the stars in split pixels, and go to the children
+            keep = np.isin(pix, split)
+            pix_hi = pix_hi[keep]
+            Bin_ind = Bin_ind[keep]
+            dist = dist[keep]
+            Ag = Ag[keep]
+            active = (4*split[:, None] + np.arange(4)).ravel()
+
+        print('Multi-order map built in {} s'.format(time.time()-t0))
+        return(cls(np.concatenate(nside), np.concatenate(ipix),\
+                   np.concatenate(N), np.concatenate(sum_Ag),\
+                   np.concatenate(sum_r), Nside_max))
+
+    def lookup(self, lon, lat):
+        """
+        Find the leaf covering each position.
+        Input:
+        - lon, lat, arrays. Galactic position in degrees
+        Return:
+        - leaf, array. The leaf index of each position
+        """
+        pix_hi = hp.ang2pix(self.Nside_max, lon, lat, nest=True, lonlat=True)
+        return(np.searchsorted(self.start, pix_hi, side='right') - 1)
+
+    def profile(self, lon, lat):
+        """
+        The mean extinction and mean distance profiles at given positions.
+        Return:
+        - Ag_mean, array. (Npos, Nbins) mean extinction in each bin
+        - R_mean, array. (Npos, Nbins) mean distance in each bin
+        - N, array. (Npos, Nbins) number of stars in each bin
+        """
+        leaf = self.lookup(lon, lat)
+        N = self.N[leaf]
+        Ag_mean = np.zeros(np.shape(N))
+        R_mean = np.zeros(np.shape(N))
+        ok = N > 0
+        Ag_mean[ok] = self.sum_Ag[leaf][ok]/N[ok]
+        R_mean[ok] = self.sum_r[leaf][ok]/N[ok]
+        return(Ag_mean, R_mean, N)
+
+    def write(self, filename):
+        """
+        Write the map to a .h5 file, with a Green19 style 'pixel_info'.
+        """
+        pixel_info = np.empty(self.Nleaf, dtype=[('nside', 'i4'),\
+                                                 ('healpix_index', 'i8')])
+        pixel_info['nside'] = self.nside
+        pixel_info['healpix_index'] = self.ipix
+        f = h5py.File(filename, 'w')
+        f.create_dataset('pixel_info', data=pixel_info)
+        f.create_dataset('N', data=self.N, compression='gzip')
+        f.create_dataset('sum_Ag', data=self.sum_Ag, compression='gzip')
+        f.create_dataset('sum_r', data=self.sum_r, compression='gzip')
+        f.attrs['Nside_max'] = self.Nside_max
+        f.close()
+
+    @classmethod
+    def read(cls, filename):
+        f = h5py.File(filename, 'r')
+        pixel_info = np.asarray(f['pixel_info'])
+        map = cls(pixel_info['nside'], pixel_info['healpix_index'],\
+                  np.asarray(f['N']), np.asarray(f['sum_Ag']),\
+                  np.asarray(f['sum_r']), int(f.attrs['Nside_max']))
+        f.close()
+        return(map)
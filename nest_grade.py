@@ -0,0 +1,174 @@
+"""
+Module for changing the resolution of HEALPix maps in NESTED ordering. The
+4**k sub pixels of a pixel at Nside/2**k are consecutive in NESTED ordering,
+so a degrade is a reshape to (Npix_out, 4**k) and a mean over the last axis,
+and an upgrade is a repeat. Pixels that are UNSEEN or NaN are left out of the
+mean, and a pixel with no valid sub pixels is UNSEEN. Several maps, as
+(Nmaps, Npix) arrays, are done at once.
+"""
+
+import numpy as np
+import healpy as hp
+from functools import lru_cache
+
+##########################
+
+@lru_cache(maxsize=16)
+def _nest2ring_index(Nside):
+    # ring index of each nested pixel, map_nest = map_ring[index]
+    return(hp.nest2ring(Nside, np.arange(hp.nside2npix(Nside))))
+
+@lru_cache(maxsize=16)
+def _ring2nest_index(Nside):
+    # nested index of each ring pixel, map_ring = map_nest[index]
+    return(hp.ring2nest(Nside, np.arange(hp.nside2npix(Nside))))
+
+def to_nest(maps):
+    maps = np.asarray(maps)
+    return(maps[..., _nest2ring_index(hp.npix2nside(maps.shape[-1]))])
+
+def to_ring(maps):
+    maps = np.asarray(maps)
+    return(maps[..., _ring2nest_index(hp.npix2nside(maps.shape[-1]))])
+
+def bad_pixels(maps, badval=hp.UNSEEN):
+    """
+    True where the pixel is NaN or badval, with the tolerance of healpy.
+    """
+    return(np.isnan(maps) | (np.abs(maps - badval) <= 1e-5*np.abs(badval)))
+
+def _sums(maps, k):
+    """
+    Sum and number of valid sub pixels of each pixel k levels up.
+    """
+    good = ~bad_pixels(maps)
+    shape = maps.shape[:-1] + (maps.shape[-1]//4**k, 4**k)
+    s = np.where(good, maps, 0.).reshape(shape).sum(axis=-1)
+    n = good.reshape(shape).sum(axis=-1)
+    return(s, n)
+
+def _means(s, n, power=None, badval=hp.UNSEEN):
+    """
+    The masked mean sum/n. With power, divided by n**(power/2), which is
+    (Nside_in/Nside_out)**power as in healpy for a full pixel. For power=2
+    the degraded variance is then the variance of the mean of the valid sub
+    pixels.
+    """
+    ok = n > 0
+    out = np.full(s.shape, badval, dtype=float)
+    out[ok] = s[ok]/n[ok]
+    if power:
+        out[ok] /= n[ok]**(power/2.)
+    return(out)
+
+def degrade(maps, Nside_out, power=None, badval=hp.UNSEEN):
+    """
+    Degrade NESTED maps to Nside_out, with the mean of the valid sub pixels.
+
+    Parameters:
+    -----------
+    - maps, ndarray.    (Npix,) or (Nmaps, Npix) NESTED maps.
+    - Nside_out, integer. The new resolution, below the resolution of maps.
+    - power, scalar.    As in healpy.ud_grade, power=2 for variance and
+                        covariance maps, -2 to keep the sum.
+    - badval, scalar.   The value of pixels with no valid sub pixels.
+
+    Return:
+    -----------
+    - out, ndarray.     The degraded maps.
+    """
+    maps = np.asarray(maps, dtype=float)
+    ratio = hp.npix2nside(maps.shape[-1])//Nside_out
+    k = int(np.log2(ratio))
+    s, n = _sums(maps, k)
+    return(_means(s, n, power, badval))
+
+def upgrade(maps, Nside_out, power=None):
+    """
+    Upgrade NESTED maps to Nside_out, each sub pixel gets the value of its
+    parent. With power the values are divided by (Nside_in/Nside_out)**power,
+    as in healpy. Bad pixels stay bad.
+    """
+    maps = np.asarray(maps, dtype=float)
+    Nside_in = hp.npix2nside(maps.shape[-1])
+    out = np.repeat(maps, (Nside_out//Nside_in)**2, axis=-1)
+    if power:
+        bad = bad_pixels(out)
+        out = np.where(bad, out, out/(float(Nside_in)/Nside_out)**power)
+    return(out)
+
+def ud_grade(maps, Nside_out, order_in='RING', order_out=None, power=None,\
+             badval=hp.UNSEEN):
+    """
+    Change the resolution of maps, in the same call as healpy.ud_grade but
+    done in NESTED ordering and leaving UNSEEN and NaN pixels out of the
+    means. RING maps are reordered with cached index arrays.
+
+    Parameters:
+    -----------
+    - maps, ndarray.    (Npix,) or (Nmaps, Npix) maps.
+    - Nside_out, integer. The new resolution.
+    - order_in, string. 'RING' or 'NESTED'.
+    - order_out, string. 'RING' or 'NESTED', default is order_in.
+    - power, scalar.    As in healpy.ud_grade.
+    - badval, scalar.   The value of pixels with no valid sub pixels.
+
+    Return:
+    -----------
+    - out, ndarray.     The maps at Nside_out.
+    """
+    if order_out is None:
+        order_out = order_in
+    maps = np.asarray(maps, dtype=float)
+    if order_in.upper()[:4] == 'RING':
+        maps = to_nest(maps)
+    Nside_in = hp.npix2nside(maps.shape[-1])
+    if Nside_out < Nside_in:
+        out = degrade(maps, Nside_out, power, badval)
+    elif Nside_out > Nside_in:
+        out = upgrade(maps, Nside_out, power)
+    else:
+        out = maps
+    if order_out.upper()[:4] == 'RING':
+        out = to_ring(out)
+    return(out)
+
+def pyramid(maps, Nsides, order_in='RING', order_out=None, power=None,\
+            badval=hp.UNSEEN):
+    """
+    Degrade maps to several lower resolutions in one pass. Each level is
+    made from the sums and counts of the level above, so every level is the
+    exact masked mean of the input pixels.
+
+    Parameters:
+    -----------
+    - maps, ndarray.    (Npix,) or (Nmaps, Npix) maps.
+    - Nsides, list.     The resolutions, all below the resolution of maps.
+    - order_in, order_out, power, badval, see ud_grade().
+
+    Return:
+    -----------
+    - out, list.        The maps at each Nside, in the order of Nsides.
+    """
+    if order_out is None:
+        order_out = order_in
+    maps = np.asarray(maps, dtype=float)
+    if order_in.upper()[:4] == 'RING':
+        maps = to_nest(maps)
+
+    good = ~bad_pixels(maps)
+    s = np.where(good, maps, 0.)
+    n = good.astype(np.int64)
+    Nside = hp.npix2nside(maps.shape[-1])
+    levels = {}
+    for Ns in sorted(set(Nsides), reverse=True):
+        ratio = (Nside//Ns)**2
+        shape = s.shape[:-1] + (s.shape[-1]//ratio, ratio)
+        s = s.reshape(shape).sum(axis=-1)
+        n = n.reshape(shape).sum(axis=-1)
+        Nside = Ns
+        out = _means(s, n, power, badval)
+        if order_out.upper()[:4] == 'RING':
+            out = to_ring(out)
+        levels[Ns] = out
+    return([levels[Ns] for Ns in Nsides])
@@ -0,0 +1,90 @@
+"""
+Module for HEALPix pixel indices of the stars at any Nside. One high
+resolution NESTED pixel index is stored per star. In NESTED ordering the
+parent of a pixel at a coarser Nside is found by an integer right shift of
+2*log2(Nside_hi/Nside) bits, so re-pixelising the catalogue needs no
+trigonometry. RING indices are made only when asked for.
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+import hashlib
+import os, time
+
+##########################
+
+NSIDE_HI = 4096
+
+def hires_pixels(theta, phi, Nside_hi=NSIDE_HI, file=None):
+    """
+    The NESTED pixel index of each star at Nside_hi. If file is given, the
+    indices are read from it when it exists and was made from the same
+    (theta, phi) columns, identified by a hash of their values, else computed
+    and written to it.
+
+    Parameters:
+    -----------
+    - theta, array.     Colatitude angle in radians, [0, pi]
+    - phi, array.       Longitude angle in radians
+    - Nside_hi, integer. The high resolution Nside, default is 4096
+    - file, string.     Optional .h5 file caching the indices
+
+    Return:
+    -----------
+    - pix_hi, array.    NESTED pixel index at Nside_hi
+    """
+    assert hp.isnsideok(Nside_hi, nest=True), 'Nside_hi must be a power of 2'
+    key = None
+    if file is not None:
+        # only hash the columns when they are checked against a cache file
+        theta = np.ascontiguousarray(theta, dtype=np.float64)
+        phi = np.ascontiguousarray(phi, dtype=np.float64)
+        key = hashlib.sha1(memoryview(theta).cast('B'))
+        key.update(memoryview(phi).cast('B'))
+        key = key.hexdigest()
+
+    if (file is not None) and os.path.isfile(file):
+        f = h5py.File(file, 'r')
+        if (f.attrs.get('key') == key) and (f.attrs['Nside'] == Nside_hi):
+            pix_hi = np.asarray(f['pix_nest'])
+            f.close()
+            return(pix_hi)
+        f.close()
+
+    t0 = time.time()
+    pix_hi = hp.ang2pix(Nside_hi, theta, phi, nest=True)
+    print('Pixel index at Nside {} in {} s'.format(Nside_hi, time.time()-t0))
+    if file is not None:
+        f = h5py.File(file, 'w')
+        f.create_dataset('pix_nest', data=pix_hi.astype(np.int64))
+        f.attrs['Nside'] = Nside_hi
+        f.attrs['key'] = key
+        f.close()
+    return(pix_hi)
+
+def pixels_at(pix_hi, Nside, Nside_hi=NSIDE_HI, nest=False):
+    """
+    The pixel index at a coarser Nside from the high resolution NESTED index.
+
+    Parameters:
+    -----------
+    - pix_hi, array.    NESTED pixel index at Nside_hi
+    - Nside, integer.   The wanted Nside, Nside <= Nside_hi
+    - Nside_hi, integer. The Nside of pix_hi
+    - nest, bool.       If True return NESTED indices, else RING.
+
+    Return:
+    -----------
+    - pix, array.       The pixel index at Nside
+    """
+    assert hp.isnsideok(Nside, nest=True) and hp.isnsideok(Nside_hi, nest=True),\
+        'Nside {} and Nside_hi {} must be powers of 2'.format(Nside, Nside_hi)
+    if Nside > Nside_hi:
+        raise ValueError('Nside {} is larger than Nside_hi {}'.\
+                         format(Nside, Nside_hi))
+    shift = 2*(int(np.log2(Nside_hi)) - int(np.log2(Nside)))
+    pix = np.right_shift(pix_hi, shift)
+    if nest is False:
+        pix = hp.nest2ring(Nside, pix)
+    return(pix)
@@ -0,0 +1,138 @@
+"""
+Module for fitting linear scalings between maps, data = a*template, with a
+Gaussian likelihood. The log likelihood is quadratic in a,
+-0.5*(S_dd - 2a S_td + a^2 S_tt), so it is given by the three sums S over the
+pixels. The posterior of a is then found analytically for a Gaussian prior,
+or on a grid of a for any other prior. Several data maps (e.g. Planck bands)
+and several templates (e.g. distance slices of the Greens et.al. 2019 map)
+are fitted at once, by matrix products over the pixels.
+"""
+
+import numpy as np
+from scipy.integrate import trapezoid
+
+##########################
+
+def _as_2d(x):
+    x = np.asarray(x, dtype=float)
+    return(x.reshape(-1, x.shape[-1]))
+
+def sufficient_stats(templates, data, sigma=10., mask=None):
+    """
+    The sums over pixels of the quadratic log likelihood.
+
+    Parameters:
+    -----------
+    - templates, ndarray. (Npix,) or (Ntemplates, Npix), the maps to scale.
+    - data, ndarray.    (Npix,) or (Ndata, Npix), the maps to fit.
+    - sigma, scalar/ndarray. The uncertainty of the data, scalar, (Npix,) or
+                        (Ndata, Npix).
+    - mask, array.      Boolean (Npix,), the pixels to use. Default is all.
+
+    Return:
+    -----------
+    - S_tt, S_td, S_dd, ndarrays. (Ndata, Ntemplates) sums of w*t^2, w*t*d and
+                        w*d^2, with w = 1/sigma^2.
+    """
+    T = _as_2d(templates)
+    D = _as_2d(data)
+    w = np.broadcast_to(1./np.asarray(sigma, dtype=float)**2, D.shape).copy()
+    if mask is not None:
+        w[:, ~np.asarray(mask, dtype=bool)] = 0.
+    S_tt = w @ (T**2).T
+    S_td = (w*D) @ T.T
+    S_dd = np.broadcast_to(np.sum(w*D**2, axis=1)[:,None], S_tt.shape)
+    return(S_tt, S_td, S_dd)
+
+def gaussian_posterior(templates, data, sigma=10., mask=None, mu0=0.,\
+                       sigma0=np.inf):
+    """
+    The Gaussian posterior of the scaling a of each (data, template) pair,
+    for a Gaussian prior N(mu0, sigma0). sigma0=inf is a flat prior, giving
+    the weighted least squares solution.
+
+    Return:
+    -----------
+    - mean, std, ndarrays. (Ndata, Ntemplates) mean and standard deviation of
+                        the posterior of a.
+    """
+    S_tt, S_td, S_dd = sufficient_stats(templates, data, sigma, mask)
+    precision = S_tt + 1./sigma0**2
+    mean = (S_td + mu0/sigma0**2)/precision
+    std = 1./np.sqrt(precision)
+    return(mean, std)
+
+def gaussian_log_prior(a, mu, sigma, positive=True):
+    """
+    Vectorised Gaussian log prior, -inf for a <= 0 if positive.
+    """
+    lp = -0.5*((a - mu)/sigma)**2
+    if positive:
+        lp = np.where(a > 0, lp, -np.inf)
+    return(lp)
+
+def grid_posterior(templates, data, sigma=10., mask=None, log_prior=None,\
+                   a_grid=None, Ngrid=2001, width=10., prior_range=None):
+    """
+    The posterior of the scaling a of each (data, template) pair on a grid of
+    a, for any prior. The log likelihood on the grid comes from the three sums
+    of sufficient_stats(), so the cost does not depend on the number of pixels.
+
+    Parameters:
+    -----------
+    - templates, data, sigma, mask, see sufficient_stats().
+    - log_prior, function. Vectorised ln(P(a)), default is flat. It gets a
+                        (Ndata, Ntemplates, Ngrid) array, so a prior per data
+                        map can use parameters of shape (Ndata, 1, 1).
+    - a_grid, array.    The grid, default is Ngrid points within width
+                        standard deviations of the likelihood peak of each
+                        pair, and Ngrid more in prior_range if given.
+    - Ngrid, integer.   Number of grid points.
+    - width, scalar.    Half width of the default grid, in standard deviations.
+    - prior_range, tuple. (a_min, a_max), where the prior has its support,
+                        scalars or arrays broadcastable to (Ndata, Ntemplates).
+                        Needed with the default grid when the prior may be
+                        zero around the likelihood peak.
+
+    Return:
+    -----------
+    - post, dict.       'a': the grid, 'pdf': the normalised posterior,
+                        'mean', 'std' and 'map' (the posterior maximum), as
+                        (Ndata, Ntemplates) arrays, the grid and pdf with an
+                        extra last axis for the grid points.
+
+    Raise:
+    -----------
+    - ValueError, if the posterior is zero on the whole grid of a pair.
+    """
+    S_tt, S_td, S_dd = sufficient_stats(templates, data, sigma, mask)
+    if a_grid is None:
+        a_hat = S_td/S_tt
+        a_err = 1./np.sqrt(S_tt)
+        a = a_hat[...,None] + a_err[...,None]*np.linspace(-width, width, Ngrid)
+        if prior_range is not None:
+            a_min = np.broadcast_to(prior_range[0], S_tt.shape)
+            a_max = np.broadcast_to(prior_range[1], S_tt.shape)
+            a_prior = np.linspace(a_min, a_max, Ngrid, axis=-1)
+            a = np.sort(np.concatenate([a, a_prior], axis=-1), axis=-1)
+    else:
+        a = np.broadcast_to(np.asarray(a_grid, dtype=float),\
+                            S_tt.shape + (len(a_grid),))
+
+    log_post = -0.5*(S_dd[...,None] - 2*a*S_td[...,None] + a**2*S_tt[...,None])
+    if log_prior is not None:
+        log_post = log_post + log_prior(a)
+    empty = ~np.any(np.isfinite(log_post), axis=-1)
+    if np.any(empty):
+        raise ValueError('Posterior is zero on the whole grid of the '\
+                         '(data, template) pairs {}, give a_grid or '\
+                         'prior_range covering the prior support'.\
+                         format(np.argwhere(empty).tolist()))
+    log_post = log_post - np.max(log_post, axis=-1, keepdims=True)
+    pdf = np.exp(log_post)
+    pdf /= trapezoid(pdf, a, axis=-1)[...,None]
+
+    mean = trapezoid(a*pdf, a, axis=-1)
+    std = np.sqrt(trapezoid((a - mean[...,None])**2*pdf, a, axis=-1))
+    a_map = np.take_along_axis(a, np.argmax(pdf, axis=-1)[...,None], -1)[...,0]
+    return({'a': a, 'pdf': pdf, 'mean': mean, 'std': std, 'map': a_map})
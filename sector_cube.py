@@ -0,0 +1,130 @@
+"""
+Module for binning stars in angular sectors and distance. All stars are
+digitized once into (phi, theta, distance) bin indices, and the number of
+stars, summed extinction and summed distance are reduced per bin in one
+grouped operation. Wider sectors are made by rebinning the finer cube, without
+going back to the star catalogue.
+"""
+
+import numpy as np
+
+##########################
+
+def digitize(x, edges):
+    """
+    Bin index of each value for bins open on the left, (edges[i], edges[i+1]].
+    Values outside the edges get index -1.
+    """
+    ind = np.searchsorted(edges, x, side='left') - 1
+    ind[(ind < 0) | (ind >= len(edges)-1)] = -1
+    return(ind)
+
+class SectorCube():
+    """
+    Counts, summed extinction and summed distance in (phi, theta, r) sectors.
+    Contain functions:
+    - from_catalogue(), digitize and reduce all stars
+    - rebin(), merge neighbouring sectors/distance bins
+    - sector_index(), the cube indices of sectors given by their start angles
+    - mean_Ag, mean_r, mean values per sector
+    Input:
+    - dphi, scalar.     The sector width in phi, in degrees
+    - dtheta, scalar.   The sector width in theta, in degrees
+    - r_edges, array.   The distance bin edges, in pc
+    """
+    def __init__(self, dphi, dtheta, r_edges):
+        self.dphi = dphi
+        self.dtheta = dtheta
+        self.phi = np.arange(0.0, 360.0, dphi)
+        self.theta = np.arange(0.0, 180.0, dtheta)
+        self.r_edges = np.asarray(r_edges, dtype=float)
+        self.shape = (len(self.phi), len(self.theta), len(self.r_edges)-1)
+
+        self.N = np.zeros(self.shape, dtype=np.int64)
+        self.sum_Ag = np.zeros(self.shape)
+        self.sum_r = np.zeros(self.shape)
+
+    def from_catalogue(self, phi, theta, dist, Ag):
+        """
+        Add stars to the cube.
+        Input:
+        - phi, array. Longitude angle of the stars in degrees, [0, 360]
+        - theta, array. Colatitude angle of the stars in degrees, [0, 180]
+        - dist, array. Distance to the stars in pc
+        - Ag, array. Extinction of the stars
+        """
+        phi_edges = np.append(self.phi, self.phi[-1] + self.dphi)
+        theta_edges = np.append(self.theta, self.theta[-1] + self.dtheta)
+        i = digitize(phi, phi_edges)
+        j = digitize(theta, theta_edges)
+        k = digitize(dist, self.r_edges)
+        ok = (i >= 0) & (j >= 0) & (k >= 0)
+
+        flat = np.ravel_multi_index((i[ok], j[ok], k[ok]), self.shape)
+        size = self.N.size
+        self.N += np.bincount(flat, minlength=size).reshape(self.shape)
+        self.sum_Ag += np.bincount(flat, weights=Ag[ok],\
+                                   minlength=size).reshape(self.shape)
+        self.sum_r += np.bincount(flat, weights=dist[ok],\
+                                  minlength=size).reshape(self.shape)
+        return(self)
+
+    def sector_index(self, phi, theta):
+        """
+        The cube indices of the sectors starting at the angles phi and theta,
+        [phi, phi+dphi) and [theta, theta+dtheta). Angles outside the cube
+        get index -1.
+        Input:
+        - phi, array. Start longitude of the sectors in degrees
+        - theta, array. Start colatitude of the sectors in degrees
+        Return:
+        - i, j, arrays. The phi and theta indices in the cube
+        """
+        phi_edges = np.append(self.phi, self.phi[-1] + self.dphi)
+        theta_edges = np.append(self.theta, self.theta[-1] + self.dtheta)
+        i = np.searchsorted(phi_edges, np.asarray(phi), side='right') - 1
+        j = np.searchsorted(theta_edges, np.asarray(theta), side='right') - 1
+        i[(i < 0) | (i >= self.shape[0])] = -1
+        j[(j < 0) | (j >= self.shape[1])] = -1
+        return(i, j)
+
+    def rebin(self, fphi=1, ftheta=1, fr=1):
+        """
+        Merge neighbouring bins into a coarser cube. The sectors become fphi
+        and ftheta times wider, and fr distance bins are merged into one.
+        Input:
+        - fphi, ftheta, fr, integers. The rebinning factors
+        Return:
+        - cube, SectorCube. The coarser cube.
+        """
+        r_edges = self.r_edges[::fr]
+        if r_edges[-1] != self.r_edges[-1]:
+            r_edges = np.append(r_edges, self.r_edges[-1])
+        cube = SectorCube(self.dphi*fphi, self.dtheta*ftheta, r_edges)
+        factors = (fphi, ftheta, fr)
+        cube.N = self._block_sum(self.N, factors, cube.shape)
+        cube.sum_Ag = self._block_sum(self.sum_Ag, factors, cube.shape)
+        cube.sum_r = self._block_sum(self.sum_r, factors, cube.shape)
+        return(cube)
+
+    def _block_sum(self, a, factors, shape):
+        # pad each axis with empty bins up to a multiple of the factor
+        pad = [(0, n*f - m) for n, f, m in zip(shape, factors, a.shape)]
+        a = np.pad(a, pad)
+        a = a.reshape(shape[0], factors[0], shape[1], factors[1],\
+                      shape[2], factors[2])
+        return(a.sum(axis=(1, 3, 5)))
+
+    @property
+    def mean_Ag(self):
+        return(self._mean(self.sum_Ag))
+
+    @property
+    def mean_r(self):
+        return(self._mean(self.sum_r))
+
+    def _mean(self, total):
+        mean = np.zeros(self.shape)
+        ok = self.N > 0
+        mean[ok] = total[ok]/self.N[ok]
+        return(mean)
@@ -0,0 +1,129 @@
+"""
+Module for sharing NumPy arrays with pool workers through
+multiprocessing.shared_memory. The main process publishes named arrays once
+(catalogue columns, pixel indices, frequency maps), and the workers attach to
+them without copying, instead of pickling the arrays into every task. The
+shared memory is unlinked when the owner is closed, at exit, or by the
+multiprocessing resource tracker if the owner process crashes.
+"""
+
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os, sys, weakref
+
+##########################
+
+# arrays attached in this (worker) process, and their shared memory handles
+_arrays = {}
+_handles = []
+
+def _release(segments):
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # arrays still in use keep the mapping, the name is removed
+            pass
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    del segments[:]
+
+class SharedArrays():
+    """
+    Owner of a set of named arrays in shared memory.
+    Contain functions:
+    - publish(), copy an array into shared memory
+    - specs(), the description workers attach with
+    - pool(), a process pool with the arrays attached in every worker
+    - close(), free the shared memory
+    Can be used as a context manager, freeing the memory at the end.
+    """
+    def __init__(self):
+        self.arrays = {}
+        self._specs = {}
+        self._segments = []
+        # free the memory when closed, garbage collected or at exit
+        self._finalizer = weakref.finalize(self, _release, self._segments)
+
+    def publish(self, name, array):
+        """
+        Copy an array into shared memory under name.
+        Input:
+        - name, string. The name workers use to get the array
+        - array, ndarray. The data
+        Return:
+        - shared, ndarray. The array in shared memory
+        """
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._segments.append(shm)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[...] = array
+        self.arrays[name] = shared
+        self._specs[name] = (shm.name, array.shape, array.dtype.str)
+        return(shared)
+
+    def __getitem__(self, name):
+        return(self.arrays[name])
+
+    def specs(self):
+        return(dict(self._specs))
+
+    def pool(self, processes=None, seed=None):
+        """
+        A process pool where every worker has attached the published arrays,
+        available with get(name). The workers get different random seeds.
+        """
+        return(mp.Pool(processes, initializer=init_worker,\
+                       initargs=(self.specs(), seed)))
+
+    def close(self):
+        self.arrays = {}
+        self._specs = {}
+        self._finalizer()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+def attach(specs):
+    """
+    Attach to published arrays, without copying.
+    Input:
+    - specs, dict. From SharedArrays.specs()
+    Return:
+    - arrays, dict. The arrays by name
+    """
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=shm_name, track=False)
+        else:
+            # the pool workers share the owner's resource tracker, so the
+            # segment is already tracked once
+            shm = shared_memory.SharedMemory(name=shm_name)
+        _handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return(arrays)
+
+def init_worker(specs, seed=None):
+    """
+    Pool initializer, attach the arrays and give the worker its own seed of
+    the numpy random generator, so forked workers do not repeat draws.
+    """
+    _arrays.update(attach(specs))
+    if seed is None:
+        np.random.seed()
+    else:
+        np.random.seed((seed + os.getpid()) % 2**32)
+
+def get(name):
+    """
+    An array attached in this worker.
+    """
+    return(_arrays[name])
@@ -9,6 +9,9 @@ from math import atan2
 import sys, os, time
 import h5py
 
+from gal_coord import eq2gal
+from los_fit import profile_matrix, diff_profiles
+
 ################################################################################
 
 
@@ -174,62 +177,34 @@ class Star():
         ang = np.linspace(0, 360, Nra)
         r = np.linspace(self.Rmax/self.Nbins, self.Rmax*(1+1/self.Nbins), self.Nbins)
         print(ra)
-        ra_bin = np.searchsorted(ang, ra)
         print(df)
-        print(ra_bin, np.max(ra_bin))
-        #sys.exit()
         Ndiff = self.Nbins*3
         dec_ang = np.linspace(0, 180, Ndec)
         rm, tm = np.meshgrid(self.bin, dec_ang)
         drm, dtm = np.meshgrid(np.linspace(0, self.Rmax+10, Ndiff+1), dec_ang)
-        Ag_grid = np.zeros((len(ang), len(dec_ang), self.Nbins))
-        dAg_grid = np.zeros((len(ang), len(dec_ang), Ndiff))
-        print(np.shape(Ag_grid[0,:,:]), np.shape(dAg_grid))
-        
-        for i in range(len(ang)-1):
-            
-            print('-->', i, i+1, ang[i], ang[i+1])#, len(ind2))
-            for j in range(len(dec_ang)-1):
-                #print(j, j+1, dec_ang[j], dec_ang[j+1])
-                ind2 = np.where((ra >= ang[i]) & (ra < ang[i+1]) &\
-                                (dec >= dec_ang[j]) & (dec<dec_ang[j+1]))[0]
-                    
-                data = pd.DataFrame({'bin': Bin_ind[ind2],
-                                     'r': self.dist[ind2],
-                                     'Ag': self.Ag[ind2]})
 
-                #print(len(ind2))#print(data)
-            
-                Ag_data = data.groupby('bin')['Ag'].agg([np.mean,np.std,np.size])
-                R_data = data.groupby('bin')['r'].agg([np.mean, np.std])
-                temp_dist = np.zeros((self.Nbins))
-                #
-                #print(Ag_data)
-                #print(R_data)
-                #print(np.array(Ag_data.index.values).astype(int))
-                #print(len(np.array(Ag_data.index.values).astype(int)))
-                dist_index = np.array(Ag_data.index.values).astype(int)
-                Ag_grid[i,j, dist_index] = Ag_data['mean']
-                temp_dist[dist_index] = R_data['mean']
-                
-                ii = np.where(temp_dist[1:] == 0)[0]
-                #print(temp_dist[ii+1])
-                if len(ii) > 0:
-                    #r = temp_dist[ii] + self.dx
-                    for k in ii:
-                        r = temp_dist[k] + self.dx
-                        temp_dist[k+1] = r
-                    print(ii)
-                else:
-                    pass
-                #print(temp_dist[ii+1])
-                #print(Ag_grid[i,j,:])
-                diff_Ag = self.diff_Ag(Ag_grid[i,j,:], temp_dist, Ndiff)
-                dAg_grid[i, j, :] = diff_Ag
-                #print(Ag_data['mean'])
-            #
-            #print(Ag_grid[i,:,:])
-            #print(np.mean(dec[np.where((ra >= ang[i]) & (ra < ang[i+1]))]))
+        # bin all (RA, Dec) cells at once, one profile per cell
+        ra_bin = np.searchsorted(ang, ra, side='right') - 1
+        dec_bin = np.searchsorted(dec_ang, dec, side='right') - 1
+        ok = (ra_bin >= 0) & (ra_bin < Nra-1) & (dec_bin >= 0) & (dec_bin < Ndec-1)
+        cell = ra_bin[ok]*Ndec + dec_bin[ok]
+        R, Ag_mean, N = profile_matrix(cell, Bin_ind[ok].astype(np.int64),\
+                                       dist[ok], Ag[ok], Nra*Ndec, self.Nbins)
+        Ag_grid = Ag_mean.reshape(Nra, Ndec, self.Nbins)
+        print(np.shape(Ag_grid[0,:,:]))
+
+        # empty bins get the distance of the previous bin plus a bin width
+        for k in range(1, self.Nbins):
+            R[:,k] = np.where(R[:,k] == 0, R[:,k-1] + self.dx, R[:,k])
+
+        # differential extinction of all cells on a common distance grid
+        dAg = diff_profiles(Ag_mean, R, drm[0,:-1], method='spline',\
+                            r_common=self.bin)
+        dAg_grid = dAg.reshape(Nra, Ndec, Ndiff)
+        print(np.shape(dAg_grid))
+
+        for i in range(len(ang)-1):
+            print('-->', i, i+1, ang[i], ang[i+1])
             # plot:
             #plt.figure('ra: {}'.format(ang[i+1]))
             #plt.plot(Ag_data['mean'])
@@ -303,21 +278,9 @@ Ag_tot[i, j] = Ag1
 
 def coord_trans(ra, dec):
     """
-    Transform RA and DEC to galactic coordinates, in deg!
+    Transform RA and DEC to galactic coordinates, in deg! Input in radians.
     """
-    degrees = np.pi/180.
-    el0 = 32.93191857 * degrees # a
-    r0 = 282.859481208 * degrees # b
-    d0 = 62.8717488056 * degrees # c
-    
-    l1 = np.cos(dec)*np.cos(ra - r0)
-    l2 = np.sin(dec)*np.sin(d0) + np.cos(dec)*np.cos(ra - r0)*np.cos(d0)
-    l3 = np.sin(dec)*np.cos(d0) - np.cos(dec)*np.sin(ra - r0)*np.sin(d0)
-    #print(l1,l2, l3)
-    B = np.arcsin(l3)/degrees
-    
-    L = (np.arctan2(l1, l2) + el0)/degrees
-    #print(L, B)
+    L, B = eq2gal(np.degrees(ra), np.degrees(dec))
     return(L,B)
 
 
@@ -0,0 +1,243 @@
+"""
+Module for making a synthetic Gaia catalogue in the same schema as the reduced
+'Data/*_v2.h5' files, for testing and benchmarking the extinction map code
+without the real data. The stars follow an exponential disk around the Sun,
+and the extinction is the line integral through a known 3D dust field, an
+exponential dust disk plus Gaussian clouds, so the maps can be compared to the
+truth.
+"""
+
+import numpy as np
+import h5py
+import os, sys, time
+from scipy.special import erf
+
+from gal_coord import gal2eq
+
+##########################
+
+# (file name, data name) of the columns, as written by Datareduction.py
+columns = [('RightAscension', 'ra'), ('Declination', 'dec'),\
+           ('Parallax', 'parallax'), ('Parallax_error', 'parallax_error'),\
+           ('Mean_mag_G', 'phot_g_mean_mag'), ('Mean_mag_BP', 'phot_bp_mean_mag'),\
+           ('Mean_mag_RP', 'phot_rp_mean_mag'), ('Extinction', 'a_g_val'),\
+           ('Extinction_lower', 'a_g_percentile_lower'),\
+           ('Extinction_upper', 'a_g_percentile_upper'),\
+           ('Reddening', 'e_bp_min_rp_val'),\
+           ('Reddening_lower', 'e_bp_min_rp_percentile_lower'),\
+           ('Reddening_upper', 'e_bp_min_rp_percentile_upper'),\
+           ('gal_longitude', 'l'), ('gal_latitude', 'b')]
+
+class DustField():
+    """
+    Known 3D dust field in heliocentric galactic cartesian coordinates, with x
+    towards the galactic centre. The extinction density is
+    rho0*exp(-|z|/h) + sum_c amp_c*exp(-|x - x_c|^2/(2 sigma_c^2)), in mag/pc.
+    Contain functions:
+    - density(), the extinction density at (x, y, z)
+    - extinction(), the integrated extinction to (l, b, d), analytic
+    - write(), read()
+    Input:
+    - rho0, scalar.     Extinction density in the plane, mag/pc
+    - h, scalar.        Scale height of the dust disk, pc
+    - clouds, array.    (Ncloud, 5) array with (x, y, z, sigma, amp) per cloud
+    """
+    def __init__(self, rho0=1e-3, h=100., clouds=None):
+        self.rho0 = rho0
+        self.h = h
+        if clouds is None:
+            clouds = np.zeros((0, 5))
+        self.clouds = np.asarray(clouds, dtype=float)
+
+    @classmethod
+    def random(cls, Ncloud=30, Rmax=3000, rho0=1e-3, h=100., seed=None):
+        """
+        Dust disk with Ncloud random clouds within Rmax, of width 20-80 pc and
+        0.2-2 mag extinction through the centre.
+        """
+        rng = np.random.default_rng(seed)
+        r = Rmax*rng.uniform(0.05, 0.9, Ncloud)**(1/3.)
+        phi = rng.uniform(0, 2*np.pi, Ncloud)
+        z = rng.normal(0, h, Ncloud)
+        sigma = rng.uniform(20, 80, Ncloud)
+        A_c = rng.uniform(0.2, 2., Ncloud)
+        amp = A_c/(sigma*np.sqrt(2*np.pi))
+        clouds = np.array([r*np.cos(phi), r*np.sin(phi), z, sigma, amp]).T
+        return(cls(rho0, h, clouds))
+
+    def density(self, x, y, z):
+        rho = self.rho0*np.exp(-np.abs(z)/self.h)
+        for xc, yc, zc, sigma, amp in self.clouds:
+            d2 = (x - xc)**2 + (y - yc)**2 + (z - zc)**2
+            rho = rho + amp*np.exp(-d2/(2*sigma**2))
+        return(rho)
+
+    def extinction(self, l, b, d):
+        """
+        The extinction from the Sun to distance d in direction (l, b), by the
+        analytic line integral of the density.
+        Input:
+        - l, b, arrays. Galactic coordinates in degrees
+        - d, array. Distance in pc
+        Return:
+        - A, array. The extinction in mag
+        """
+        l = np.radians(l)
+        b = np.radians(b)
+        u = np.array([np.cos(b)*np.cos(l), np.cos(b)*np.sin(l), np.sin(b)])
+
+        # dust disk, rho0*d*(1 - exp(-x))/x with x = d|sin b|/h
+        x = d*np.abs(u[2])/self.h
+        f = np.ones(np.shape(x))
+        ok = x > 1e-8
+        f[ok] = -np.expm1(-x[ok])/x[ok]
+        A = self.rho0*d*f
+
+        # clouds, Gaussian integrated along the ray from 0 to d
+        for xc, yc, zc, sigma, amp in self.clouds:
+            t0 = xc*u[0] + yc*u[1] + zc*u[2]
+            p2 = np.clip(xc**2 + yc**2 + zc**2 - t0**2, 0, None)
+            s = sigma*np.sqrt(2.)
+            A += amp*np.exp(-p2/(2*sigma**2))*sigma*np.sqrt(np.pi/2.)*\
+                 (erf((d - t0)/s) + erf(t0/s))
+        return(A)
+
+    def write(self, f):
+        """
+        Write the parameters as attributes and a dataset of an open .h5 file.
+        """
+        f.attrs['rho0'] = self.rho0
+        f.attrs['h'] = self.h
+        f.create_dataset('clouds', data=self.clouds)
+
+    @classmethod
+    def read(cls, filename):
+        f = h5py.File(filename, 'r')
+        dust = cls(f.attrs['rho0'], f.attrs['h'], np.asarray(f['clouds']))
+        f.close()
+        return(dust)
+
+def draw_positions(N, rng, Rmin=10, Rmax=3000, h_star=300., L_star=2600.,\
+                   R_sun=8200.):
+    """
+    Draw N star positions from an exponential disk, with scale height h_star
+    and scale length L_star from the galactic centre, within Rmin < d < Rmax
+    of the Sun.
+    Return:
+    - l, b, arrays. Galactic coordinates in degrees
+    - d, array. Distance in pc
+    """
+    l = np.empty(0)
+    b = np.empty(0)
+    d = np.empty(0)
+    while len(d) < N:
+        M = 2*(N - len(d)) + 1000
+        x = rng.uniform(-Rmax, Rmax, M)
+        y = rng.uniform(-Rmax, Rmax, M)
+        z = rng.laplace(0, h_star, M)
+        r = np.sqrt(x**2 + y**2 + z**2)
+        R_gc = np.hypot(R_sun - x, y)
+        keep = (r > Rmin) & (r < Rmax) &\
+               (rng.uniform(0, 1, M) < np.exp(-(R_gc - R_sun + Rmax)/L_star))
+        x, y, z, r = x[keep], y[keep], z[keep], r[keep]
+        l = np.append(l, np.degrees(np.arctan2(y, x)) % 360.)
+        b = np.append(b, np.degrees(np.arcsin(z/r)))
+        d = np.append(d, r)
+    return(l[:N], b[:N], d[:N])
+
+def make_catalogue(Nstars, path='Data/synthetic/', Rmax=3000, sigma_Ag=0.46,\
+                   dust=None, seed=None, chunksize=1000000):
+    """
+    Write a synthetic catalogue of Nstars stars to path, one .h5 file per
+    column named as the reduced Gaia files ('Extinction_v2.h5' etc.). Right
+    ascension and declination are in radians, galactic coordinates in
+    degrees. The dust field and the true distance and extinction of each star
+    are written to 'synthetic_truth.h5'. The stars are made in chunks, so the
+    memory use does not grow with Nstars.
+
+    Parameters:
+    -----------
+    - Nstars, integer.  Number of stars, 1e5 to 1e8.
+    - path, string.     The output directory.
+    - Rmax, scalar.     The largest distance of the stars in pc.
+    - sigma_Ag, scalar. The noise of the extinction, 0.46 mag from Andrae
+                        etal 2018.
+    - dust, DustField.  The dust field. Default is DustField.random().
+    - seed, integer.    Seed of the random generator.
+    - chunksize, integer. Number of stars made at a time.
+    Return:
+    -----------
+    - dust, DustField.  The dust field used.
+    """
+    t0 = time.time()
+    Nstars = int(Nstars)
+    rng = np.random.default_rng(seed)
+    if dust is None:
+        dust = DustField.random(Rmax=Rmax, seed=seed)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    files = {}
+    for file, name in columns:
+        f = h5py.File(path + file + '_v2.h5', 'w')
+        files[name] = (f, f.create_dataset(name, (Nstars,), dtype=np.float32))
+    f_ind = h5py.File(path + 'Index_v2.h5', 'w')
+    f_ind.create_dataset('indices', data=np.arange(Nstars))
+    f_ind.close()
+    truth = h5py.File(path + 'synthetic_truth.h5', 'w')
+    dust.write(truth)
+    d_true = truth.create_dataset('dist_true', (Nstars,), dtype=np.float32)
+    A_true = truth.create_dataset('a_g_true', (Nstars,), dtype=np.float32)
+
+    for i in range(0, Nstars, chunksize):
+        n = min(chunksize, Nstars - i)
+        l, b, d = draw_positions(n, rng, Rmax=Rmax)
+        A = dust.extinction(l, b, d)
+        ra, dec = gal2eq(l, b)
+
+        # parallax with 1-20% error, so the stars pass the reduction cuts,
+        # and the zero point subtracted as undone by parallax2dist()
+        frac = rng.uniform(0.01, 0.2, n)
+        p_true = 1000./d
+        p = p_true*(1 + np.clip(frac*rng.normal(0, 1, n), -0.5, 0.5)) - 0.029
+        Ag = np.clip(A + rng.normal(0, sigma_Ag, n), 1e-3, None)
+        E = Ag/2.
+        G = np.clip(rng.normal(4.5, 2.0, n) + 5*np.log10(d) - 5 + A, 6, 18)
+        BP_RP = rng.uniform(0.5, 1.5, n) + A/2.
+
+        data = {'ra': np.radians(ra), 'dec': np.radians(dec),\
+                'parallax': p, 'parallax_error': frac*p_true,\
+                'phot_g_mean_mag': G, 'phot_bp_mean_mag': G + 0.4*BP_RP,\
+                'phot_rp_mean_mag': G - 0.6*BP_RP, 'a_g_val': Ag,\
+                'a_g_percentile_lower': np.clip(Ag - sigma_Ag, 0, None),\
+                'a_g_percentile_upper': Ag + sigma_Ag,\
+                'e_bp_min_rp_val': E,\
+                'e_bp_min_rp_percentile_lower': np.clip(E - sigma_Ag/2., 0, None),\
+                'e_bp_min_rp_percentile_upper': E + sigma_Ag/2.,\
+                'l': l, 'b': b}
+        for name in data:
+            files[name][1][i:i+n] = data[name]
+        d_true[i:i+n] = d
+        A_true[i:i+n] = A
+        print('Made {} of {} stars, time so far: {} s'.\
+              format(i+n, Nstars, time.time()-t0))
+
+    for name in files:
+        files[name][0].close()
+    truth.close()
+    print('Synthetic catalogue written to {} in {} s'.format(path, time.time()-t0))
+    return(dust)
+
+
+#########################################
+#                calls                  #
+#########################################
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print('Need input arguments: Nstars (path) (seed)')
+        sys.exit()
+    Nstars = int(float(sys.argv[1]))
+    path = sys.argv[2] if len(sys.argv) > 2 else 'Data/synthetic/'
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    make_catalogue(Nstars, path, seed=seed)
@@ -0,0 +1,175 @@
+"""
+Module for 3D Cartesian extinction cubes. The stars are assigned to voxels of
+a regular grid in one histogramming pass, and the number of stars, mean
+extinction and mean distance per voxel are stored. The cube can be built in
+chunks over the catalogue, written to and read from HDF5, and sliced along
+any plane for plotting.
+"""
+
+import numpy as np
+import healpy as hp
+import h5py
+from scipy import ndimage
+
+##########################
+
+class VoxelCube():
+    """
+    Aggregate star extinction into a regular 3D grid in galactic/euclidian
+    coordinates centred on the Sun.
+    Contain functions:
+    - add(), add a chunk of stars
+    - from_catalogue(), build the cube chunked over a catalogue
+    - mean_Ag, mean_r, the mean values per voxel
+    - plane(), axis aligned slice
+    - oblique_plane(), slice along an arbitrary plane
+    - write(), read()
+    Input:
+    - Rmax, scalar.     Half width of the cube, in pc
+    - box_size, scalar. The side length of a voxel, in pc.
+    """
+    def __init__(self, Rmax=3000, box_size=100):
+        self.Rmax = Rmax
+        self.box_size = box_size
+        self.edges = np.arange(-Rmax, Rmax+box_size/2., box_size)
+        self.Ngrid = len(self.edges) - 1
+        self.shape = (self.Ngrid, self.Ngrid, self.Ngrid)
+
+        self.N = np.zeros(self.shape, dtype=np.int64)
+        self.sum_Ag = np.zeros(self.shape)
+        self.sum_r = np.zeros(self.shape)
+
+    def voxel_index(self, xyz):
+        """
+        Flat voxel index for each position, -1 for positions outside the cube.
+        """
+        ijk = np.floor((xyz + self.Rmax)/self.box_size).astype(np.int64)
+        inside = np.all((ijk >= 0) & (ijk < self.Ngrid), axis=1)
+        flat = np.ravel_multi_index(ijk[inside].T, self.shape)
+        index = np.full(len(xyz), -1, dtype=np.int64)
+        index[inside] = flat
+        return(index)
+
+    def add(self, xyz, Ag, dist):
+        """
+        Add a chunk of stars to the cube.
+        Input:
+        - xyz, array. (N, 3) array with euclidian positions in pc
+        - Ag, array. The extinction of the stars
+        - dist, array. The distance to the stars
+        """
+        index = self.voxel_index(xyz)
+        ok = index >= 0
+        size = self.N.size
+        self.N += np.bincount(index[ok], minlength=size).reshape(self.shape)
+        self.sum_Ag += np.bincount(index[ok], weights=Ag[ok],\
+                                   minlength=size).reshape(self.shape)
+        self.sum_r += np.bincount(index[ok], weights=dist[ok],\
+                                  minlength=size).reshape(self.shape)
+
+    def from_catalogue(self, dist, lon, colat, Ag, chunksize=10000000):
+        """
+        Build the cube from a star catalogue, chunked to limit the memory used
+        by the positions.
+        Input:
+        - dist, array. Distances in pc
+        - lon, array. Longitude angles in radians, [0, 2pi]
+        - colat, array. Colatitude angles in radians, [0, pi]
+        - Ag, array. Extinction of the stars.
+        - chunksize, integer. Number of stars per chunk.
+        """
+        for i in range(0, len(dist), chunksize):
+            s = slice(i, i+chunksize)
+            xyz = hp.pixelfunc.ang2vec(colat[s], lon[s]) * dist[s, None]
+            self.add(xyz, Ag[s], dist[s])
+        return(self)
+
+    @property
+    def mean_Ag(self):
+        return(self._mean(self.sum_Ag))
+
+    @property
+    def mean_r(self):
+        return(self._mean(self.sum_r))
+
+    def _mean(self, total):
+        mean = np.zeros(self.shape)
+        ok = self.N > 0
+        mean[ok] = total[ok]/self.N[ok]
+        return(mean)
+
+    def centres(self):
+        return(0.5*(self.edges[1:] + self.edges[:-1]))
+
+    def plane(self, axis, value=0.0, quantity='Ag'):
+        """
+        Axis aligned slice through the cube.
+        Input:
+        - axis, integer. The axis normal to the plane, 0=x, 1=y, 2=z
+        - value, scalar. The position of the plane along the axis, in pc
+        - quantity, string. 'Ag', 'r' or 'N'
+        Return:
+        - plane, array. (Ngrid, Ngrid) slice of the selected quantity
+        """
+        k = int(np.clip((value + self.Rmax)//self.box_size, 0, self.Ngrid-1))
+        cube = self._quantity(quantity)
+        return(np.take(cube, k, axis=axis))
+
+    def oblique_plane(self, origin, u, v, Nsteps=None, quantity='Ag'):
+        """
+        Slice the cube along an arbitrary plane spanned by u and v through
+        origin, sampling the nearest voxel. Points outside the cube are 0.
+        Input:
+        - origin, array. Position of the plane centre, in pc
+        - u, v, arrays. Vectors spanning the plane, normalised inside
+        - Nsteps, integer. Number of samples along each direction.
+        - quantity, string. 'Ag', 'r' or 'N'
+        Return:
+        - plane, array. (Nsteps, Nsteps) slice of the selected quantity
+        - s, array. The coordinates along u and v, in pc
+        """
+        if Nsteps is None:
+            Nsteps = self.Ngrid
+        u = np.asarray(u, dtype=float)/np.linalg.norm(u)
+        v = np.asarray(v, dtype=float)/np.linalg.norm(v)
+        h = self.box_size/2.
+        s = np.linspace(-self.Rmax + h, self.Rmax - h, Nsteps)
+        S, T = np.meshgrid(s, s, indexing='ij')
+        xyz = np.asarray(origin, dtype=float) + S[..., None]*u + T[..., None]*v
+        coords = (xyz + self.Rmax)/self.box_size - 0.5
+        cube = self._quantity(quantity)
+        plane = ndimage.map_coordinates(cube, np.moveaxis(coords, -1, 0),\
+                                        order=0, mode='constant', cval=0.0)
+        return(plane, s)
+
+    def _quantity(self, quantity):
+        if quantity == 'Ag':
+            return(self.mean_Ag)
+        elif quantity == 'r':
+            return(self.mean_r)
+        elif quantity == 'N':
+            return(self.N)
+        else:
+            raise ValueError('quantity must be "Ag", "r" or "N"')
+
+    def write(self, filename):
+        """
+        Write the cube to a .h5 file, with the grid as attributes.
+        """
+        f = h5py.File(filename, 'w')
+        f.create_dataset('N', data=self.N, compression='gzip')
+        f.create_dataset('sum_Ag', data=self.sum_Ag, compression='gzip')
+        f.create_dataset('sum_r', data=self.sum_r, compression='gzip')
+        f.attrs['Rmax'] = self.Rmax
+        f.attrs['box_size'] = self.box_size
+        f.close()
+
+    @classmethod
+    def read(cls, filename):
+        f = h5py.File(filename, 'r')
+        cube = cls(f.attrs['Rmax'], f.attrs['box_size'])
+        cube.N = np.asarray(f['N'])
+        cube.sum_Ag = np.asarray(f['sum_Ag'])
+        cube.sum_r = np.asarray(f['sum_r'])
+        f.close()
+        return(cube)